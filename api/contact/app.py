@@ -1,33 +1,53 @@
+import os
+
 from typing import List, Optional, Annotated
 
 from fastapi import (
-    FastAPI, Request, Response, HTTPException,
+    FastAPI, Request, Response, HTTPException, WebSocket,
     Query, Depends, Path, status,
 )
 from fastapi.exception_handlers import request_validation_exception_handler
 from fastapi.exceptions import RequestValidationError
-from fastapi.openapi.docs import get_swagger_ui_html
-from pydantic import ValidationError
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter, ValidationError
 
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
+from api.docs import serve_docs
+from api.ratelimit import limiter
 
-from sqlmodel import (
-    Session, select
-)
+from sqlalchemy import delete, literal, update
+from sqlalchemy.orm import joinedload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from api.contact.models import (
     Agenda, AgendaRead,
     Contact, ContactCreate, ContactRead, ContactUpdate,
-    AgendaList, ContactList, AgendaReadWithItems,
+    AgendaList, ContactList, AgendaReadWithItems, ContactImport,
+)
+from api.contact.transfer import (
+    CSV, NDJSON, RecordError, TooLarge, export_rows, read_records,
+)
+from api.db import get_async_session, get_async_read_session, insert
+from api.events import broker, event_stream, websocket_stream
+from api.pagination import decode_cursor, paginate
+from api.responses import etag_matches
+from api.versions import at_versions, if_match_versions, version_etag
+
+# Contacts validated and inserted together by an import.
+IMPORT_BATCH = 500
+# An import is read in full before it's written, these bound what's held.
+CONTACT_IMPORT_MAX_BYTES = int(
+    os.getenv("CONTACT_IMPORT_MAX_BYTES", 16 * 1024 * 1024)
+)
+CONTACT_IMPORT_MAX_RECORDS = int(
+    os.getenv("CONTACT_IMPORT_MAX_RECORDS", 50000)
 )
-from api.db import get_session
 
 app = FastAPI(
     title="Contact List API",
     description="An API for storing contacts.",
     docs_url=None,
+    openapi_url=None,
     openapi_tags=[
         {
             "name": "Agenda operations",
@@ -40,10 +60,68 @@ app = FastAPI(
     ]
 )
 
-limiter = Limiter(key_func=get_remote_address)
-# Limiter requires the request to be in the args for your routes!
+# Limits are counted by RateLimitMiddleware on the main app.
 app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+serve_docs(app, title="4Geeks Playground - Contact List API")
+
+
+def agenda_changed(slug: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_412_PRECONDITION_FAILED,
+        detail=f"""Agenda "{slug}" has changed since it was read.""",
+    )
+
+
+def publish(agenda_id: int, type: str, **data):
+    """Tells the agenda's event streams what changed."""
+    broker.publish(f"agenda:{agenda_id}", {"type": type, **data})
+
+
+async def agenda_id_or_404(session: AsyncSession, slug: str) -> int:
+    agenda_id = (await session.exec(
+        select(Agenda.id).where(Agenda.slug == slug)
+    )).first()
+    if not agenda_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"""Agenda "{slug}" doesn't exist."""
+        )
+    return agenda_id
+
+
+async def contact_exists(
+    session: AsyncSession,
+    slug: str,
+    contact_id: int,
+) -> bool:
+    return bool((await session.exec(
+        select(Contact.id).join(
+            Agenda, Contact.agenda_id == Agenda.id
+        ).where(Contact.id == contact_id, Agenda.slug == slug)
+    )).first())
+
+
+async def agenda_not_modified(
+    request: Request,
+    slug: str,
+    session: AsyncSession,
+) -> Optional[Response]:
+    """A 304 if the agenda is still at a version the client has.
+
+    One indexed lookup, so unchanged polls never load any contacts.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return None
+    current = (await session.exec(
+        select(Agenda.id, Agenda.version).where(Agenda.slug == slug)
+    )).first()
+    if current and etag_matches(if_none_match, [version_etag(*current)]):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={"ETag": version_etag(*current)},
+        )
+    return None
 
 
 @app.exception_handler(RequestValidationError)
@@ -51,16 +129,6 @@ async def validation_exception_handler(request, exc):
     return await request_validation_exception_handler(request, exc)
 
 
-@app.get("/docs", include_in_schema=False)
-async def swagger_ui_html():
-    return get_swagger_ui_html(
-        title="4Geeks Playground - Contact List API",
-        openapi_url="/contact/openapi.json",
-        swagger_favicon_url="/favicon.ico",
-        # swagger_css_url="/static/swagger-ui.css",
-    )
-
-
 @app.get(
     "/agendas",
     response_model=AgendaList,
@@ -69,16 +137,21 @@ async def swagger_ui_html():
     description="Gets all Agendas from the database.",
 )
 @limiter.limit("120/minute")
-def read_agendas(
+async def read_agendas(
     request: Request,
     offset: int = 0,
-    limit: int = Query(default=100, le=100),
-    session: Session = Depends(get_session)
+    limit: int = Query(default=100, ge=1, le=100),
+    cursor: Optional[str] = None,
+    session: AsyncSession = Depends(get_async_read_session)
 ):
+    agendas, next_cursor = paginate((await session.exec(
+        select(Agenda).where(
+            Agenda.id > decode_cursor(cursor)
+        ).order_by(Agenda.id).offset(offset).limit(limit + 1)
+    )).all(), limit)
     return {
-        "agendas": session.exec(
-            select(Agenda).offset(offset).limit(limit)
-        ).all()
+        "agendas": agendas,
+        "next_cursor": next_cursor,
     }
 
 
@@ -90,15 +163,19 @@ def read_agendas(
     description="Gets a specific Agenda from the database.",
 )
 @limiter.limit("120/minute")
-def read_agenda(
+async def read_agenda(
     request: Request,
+    response: Response,
     slug: Annotated[str, Path(title="slug")],
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_read_session)
 ):
-    agenda = session.exec(select(Agenda).where(
-        Agenda.slug == slug)
-    ).first()
+    if not_modified := await agenda_not_modified(request, slug, session):
+        return not_modified
+    agenda = (await session.exec(select(Agenda).where(
+        Agenda.slug == slug
+    ).options(joinedload(Agenda.contacts)))).unique().first()
     if agenda:
+        response.headers["ETag"] = version_etag(agenda.id, agenda.version)
         return agenda
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -115,23 +192,25 @@ def read_agenda(
     description="Creates an Agenda in the database.",
 )
 @limiter.limit("15/minute")
-def create_agenda(
+async def create_agenda(
     request: Request,
     slug: Annotated[str, Path(title="slug")],
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ) -> None:
-    user_exists = session.exec(select(Agenda).where(
-        Agenda.slug == slug)).first()
-    if user_exists:
+    db_agenda = (await session.exec(
+        insert(session, Agenda).values(
+            slug=slug
+        ).on_conflict_do_nothing(
+            index_elements=[Agenda.slug]
+        ).returning(Agenda)
+    )).scalar_one_or_none()
+    if not db_agenda:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"""Agenda "{slug}" already exists."""
         )
-    db_user = Agenda(slug=slug)
-    session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
-    return db_user
+    await session.commit()
+    return db_agenda
 
 
 @app.delete(
@@ -141,29 +220,78 @@ def create_agenda(
     description="Deletes a specific Agenda from the database.",
 )
 @limiter.limit("15/minute")
-def delete_agenda(
+async def delete_agenda(
     request: Request,
     slug: Annotated[str, Path(title="slug")],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     tags=["Agenda operations"],
     summary="Delete Agenda.",
     description="Deletes a specific agenda from the database.",
 ):
-    user = session.exec(select(Agenda).where(
-        Agenda.slug == slug)
-    ).first()
-    if not user:
+    versions = if_match_versions(request.headers.get("if-match"))
+    # The agenda's contacts go with it, through ON DELETE CASCADE.
+    agenda_id = (await session.exec(
+        delete(Agenda).where(
+            Agenda.slug == slug,
+            at_versions(Agenda, versions),
+        ).returning(Agenda.id)
+    )).scalar_one_or_none()
+    if not agenda_id:
+        if versions is not None and (await session.exec(
+            select(Agenda.id).where(Agenda.slug == slug)
+        )).first():
+            raise agenda_changed(slug)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"""Agenda "{slug}" doesn't exist."""
         )
-    session.delete(user)
-    session.commit()
+    await session.commit()
+    publish(agenda_id, "agenda.deleted")
+    broker.close(f"agenda:{agenda_id}")
     return Response(
         status_code=status.HTTP_204_NO_CONTENT
     )
 
 
+@app.get(
+    "/agendas/{slug}/events",
+    tags=["Agenda operations"],
+    summary="Stream Agenda Changes.",
+    description=(
+        "Server-sent events for every change to an Agenda's Contacts, "
+        "instead of polling. `resync` means events were missed, reload "
+        "the Agenda."
+    ),
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}}},
+)
+@limiter.limit("30/minute")
+async def stream_agenda_events(
+    request: Request,
+    slug: Annotated[str, Path(title="slug")],
+    session: AsyncSession = Depends(get_async_read_session)
+):
+    # The session is closed before the stream starts.
+    return event_stream(f"agenda:{await agenda_id_or_404(session, slug)}")
+
+
+@app.websocket("/agendas/{slug}/events")
+async def websocket_agenda_events(
+    websocket: WebSocket,
+    slug: Annotated[str, Path(title="slug")],
+    session: AsyncSession = Depends(get_async_read_session)
+):
+    try:
+        agenda_id = await agenda_id_or_404(session, slug)
+    except HTTPException:
+        await websocket.close()
+        return
+    # Dependencies of a websocket live as long as it does, don't hold
+    # on to a connection for that long.
+    await session.close()
+    await websocket_stream(websocket, f"agenda:{agenda_id}")
+
+
 @app.get(
     "/agendas/{slug}/contacts",
     response_model=ContactList,
@@ -172,21 +300,43 @@ def delete_agenda(
     description="Gets the contacts from a specific agenda from the database.",
 )
 @limiter.limit("60/minute")
-def read_agenda_contacts(
+async def read_agenda_contacts(
     request: Request,
+    response: Response,
     slug: Annotated[str, Path(title="slug")],
-    session: Session = Depends(get_session)
+    offset: int = 0,
+    limit: int = Query(default=100, ge=1, le=100),
+    cursor: Optional[str] = None,
+    session: AsyncSession = Depends(get_async_read_session)
 ):
-    agenda = session.exec(select(Agenda).where(
-        Agenda.slug == slug)
-    ).first()
-    if not agenda:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"""Agenda "{slug}" doesn't exist."""
-        )
+    if not_modified := await agenda_not_modified(request, slug, session):
+        return not_modified
+    # The agenda's version comes along with each contact, for the ETag.
+    rows = (await session.exec(
+        select(Contact, Agenda.version).join(
+            Agenda, Contact.agenda_id == Agenda.id
+        ).where(
+            Agenda.slug == slug,
+            Contact.id > decode_cursor(cursor),
+        ).order_by(Contact.id).offset(offset).limit(limit + 1)
+    )).all()
+    if rows:
+        agenda = (rows[0][0].agenda_id, rows[0][1])
+    else:
+        # An empty page can't tell a missing agenda from an exhausted one.
+        agenda = (await session.exec(
+            select(Agenda.id, Agenda.version).where(Agenda.slug == slug)
+        )).first()
+        if not agenda:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"""Agenda "{slug}" doesn't exist."""
+            )
+    response.headers["ETag"] = version_etag(*agenda)
+    contacts, next_cursor = paginate([contact for contact, _ in rows], limit)
     return ContactList(
-        contacts=agenda.contacts
+        contacts=contacts,
+        next_cursor=next_cursor,
     )
 
 
@@ -199,30 +349,35 @@ def read_agenda_contacts(
     description="Creates a Contact for an Agenda.",
 )
 @limiter.limit("60/minute")
-def create_agenda_contact(
+async def create_agenda_contact(
     request: Request,
     slug: Annotated[str, Path(title="slug")],
     contact: ContactCreate,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
-    agenda = session.exec(select(Agenda).where(
-        Agenda.slug == slug)
-    ).first()
-    if not agenda:
+    # INSERT ... SELECT, so a missing agenda just inserts nothing.
+    db_contact = (await session.exec(
+        insert(session, Contact).from_select(
+            ["name", "phone", "email", "address", "agenda_id"],
+            select(
+                literal(contact.name),
+                literal(contact.phone or ""),
+                literal(contact.email or ""),
+                literal(contact.address or ""),
+                Agenda.id,
+            ).where(Agenda.slug == slug)
+        ).returning(Contact)
+    )).scalar_one_or_none()
+    if not db_contact:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"""Agenda "{slug}" doesn't exist."""
         )
-    db_contact = Contact.model_validate({
-        "name": contact.name,
-        "phone": contact.phone or "",
-        "email": contact.email or "",
-        "address": contact.address or "",
-        "agenda_id": agenda.id,
-    })
-    session.add(db_contact)
-    session.commit()
-    session.refresh(db_contact)
+    await session.commit()
+    publish(
+        db_contact.agenda_id, "contact.created",
+        contact=ContactRead.model_validate(db_contact).model_dump(),
+    )
     return db_contact
 
 
@@ -234,33 +389,47 @@ def create_agenda_contact(
     description="Atomically (piece-by-piece) updates a Contact on an Agenda.",
 )
 @limiter.limit("60/minute")
-def update_agenda_contact(
+async def update_agenda_contact(
     request: Request,
     slug: Annotated[str, Path(title="slug")],
     contact_id: Annotated[int, Path(title="contact id")],
     contact: ContactUpdate,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
-    db_contact = session.get(
-        Contact,
-        contact_id
+    versions = if_match_versions(request.headers.get("if-match"))
+    in_agenda = (
+        Contact.id == contact_id,
+        Contact.agenda_id == select(Agenda.id).where(
+            Agenda.slug == slug,
+            at_versions(Agenda, versions),
+        ).scalar_subquery(),
     )
+    values = contact.model_dump(exclude_none=True)
+    if values:
+        db_contact = (await session.exec(
+            update(Contact).where(
+                *in_agenda
+            ).values(**values).returning(Contact)
+        )).scalar_one_or_none()
+    else:
+        db_contact = (await session.exec(
+            select(Contact).where(*in_agenda)
+        )).first()
     if not db_contact:
+        if versions is not None and await contact_exists(
+            session, slug, contact_id
+        ):
+            raise agenda_changed(slug)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"""Contact #{contact.id} doesn't exist."""
+            detail=f"""Contact #{contact_id} doesn't exist in Agenda "{slug}"."""
         )
-    if slug != db_contact.agenda.slug:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"""Contact #{contact.id} doesn't exist in Agenda "{slug}"."""
+    await session.commit()
+    if values:
+        publish(
+            db_contact.agenda_id, "contact.updated",
+            contact=ContactRead.model_validate(db_contact).model_dump(),
         )
-    for k, v in contact:
-        if v is not None:
-            setattr(db_contact, k, v)
-    session.add(db_contact)
-    session.commit()
-    session.refresh(db_contact)
     return db_contact
 
 
@@ -271,25 +440,174 @@ def update_agenda_contact(
     description="Deletes a specific Contact on an Agenda.",
 )
 @limiter.limit("120/minute")
-def delete_agenda_contact(
+async def delete_agenda_contact(
     request: Request,
     slug: Annotated[str, Path(title="slug")],
     contact_id: Annotated[int, Path(title="contact id")],
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
-    db_contact = session.get(Contact, contact_id)
-    if not db_contact:
+    versions = if_match_versions(request.headers.get("if-match"))
+    agenda_id = (await session.exec(
+        delete(Contact).where(
+            Contact.id == contact_id,
+            Contact.agenda_id == select(Agenda.id).where(
+                Agenda.slug == slug,
+                at_versions(Agenda, versions),
+            ).scalar_subquery(),
+        ).returning(Contact.agenda_id)
+    )).scalar_one_or_none()
+    if not agenda_id:
+        if versions is not None and await contact_exists(
+            session, slug, contact_id
+        ):
+            raise agenda_changed(slug)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"""Contact #{db_contact.id} doesn't exist."""
+            detail=f"""Contact #{contact_id} doesn't exist in Agenda "{slug}"."""
+        )
+    await session.commit()
+    publish(agenda_id, "contact.deleted", id=contact_id)
+    return Response(
+        status_code=status.HTTP_204_NO_CONTENT
+    )
+
+
+async def insert_contacts(
+    session: AsyncSession,
+    agenda_id: int,
+    batch: List,
+) -> int:
+    lines, records = zip(*batch)
+    try:
+        contacts = TypeAdapter(List[ContactCreate]).validate_python(records)
+    except ValidationError as e:
+        raise RequestValidationError([
+            {
+                **error,
+                "loc": ("body", lines[error["loc"][0]], *error["loc"][1:]),
+            }
+            for error in e.errors()
+        ])
+    await session.exec(
+        insert(session, Contact),
+        params=[
+            {
+                "name": contact.name,
+                "phone": contact.phone or "",
+                "email": contact.email or "",
+                "address": contact.address or "",
+                "agenda_id": agenda_id,
+            }
+            for contact in contacts
+        ]
+    )
+    return len(contacts)
+
+
+@app.post(
+    "/agendas/{slug}/contacts/import",
+    response_model=ContactImport,
+    status_code=status.HTTP_201_CREATED,
+    tags=["Contact operations"],
+    summary="Import Agenda Contacts.",
+    description=(
+        "Imports Contacts into an Agenda from NDJSON (one object per line) "
+        "or CSV (with a header row). Nothing is imported if any line is "
+        "invalid, or if there are too many."
+    ),
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                NDJSON: {"schema": {"type": "string"}},
+                CSV: {"schema": {"type": "string"}},
+            },
+        },
+    },
+)
+@limiter.limit("15/minute")
+async def import_agenda_contacts(
+    request: Request,
+    slug: Annotated[str, Path(title="slug")],
+    session: AsyncSession = Depends(get_async_session)
+):
+    content_type = request.headers.get("content-type", "").split(";")[0]
+    if content_type not in (NDJSON, CSV):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Contacts can be imported as {NDJSON} or {CSV}.",
         )
-    if db_contact.agenda.slug != slug:
+    # Read in full first, a slow upload mustn't hold the write lock.
+    try:
+        records = [
+            record async for record in read_records(
+                request, content_type,
+                CONTACT_IMPORT_MAX_BYTES, CONTACT_IMPORT_MAX_RECORDS,
+            )
+        ]
+    except RecordError as e:
+        raise RequestValidationError([{
+            "type": "value_error",
+            "loc": ("body", e.line),
+            "msg": str(e),
+            "input": None,
+        }])
+    except TooLarge as e:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=str(e),
+        )
+    agenda_id = await agenda_id_or_404(session, slug)
+    imported = 0
+    for start in range(0, len(records), IMPORT_BATCH):
+        imported += await insert_contacts(
+            session, agenda_id, records[start:start + IMPORT_BATCH]
+        )
+    await session.commit()
+    # Too many to send one by one, subscribers reload the agenda.
+    publish(agenda_id, "contacts.imported", imported=imported)
+    return ContactImport(imported=imported)
+
+
+@app.get(
+    "/agendas/{slug}/contacts/export",
+    tags=["Contact operations"],
+    summary="Export Agenda Contacts.",
+    description="Streams every Contact of an Agenda as NDJSON or CSV.",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "content": {
+                NDJSON: {"schema": {"type": "string"}},
+                CSV: {"schema": {"type": "string"}},
+            },
+        },
+    },
+)
+@limiter.limit("15/minute")
+async def export_agenda_contacts(
+    request: Request,
+    slug: Annotated[str, Path(title="slug")],
+    format: Annotated[str, Query(pattern="^(ndjson|csv)$")] = "ndjson",
+    session: AsyncSession = Depends(get_async_read_session)
+):
+    agenda_id = (await session.exec(
+        select(Agenda.id).where(Agenda.slug == slug)
+    )).first()
+    if not agenda_id:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"""Contact #{db_contact.id} doesn't exist in Agenda "{slug}"."""
+            detail=f"""Agenda "{slug}" doesn't exist."""
         )
-    session.delete(db_contact)
-    session.commit()
-    return Response(
-        status_code=status.HTTP_204_NO_CONTENT
+    content_type = CSV if format == "csv" else NDJSON
+    # The session is closed before the body is sent, so the rows are
+    # streamed over a connection of their own, from the engine (replica)
+    # the lookup ran on. Read sessions aren't bound to one up front.
+    engine = (await session.connection()).engine
+    return StreamingResponse(
+        export_rows(engine, agenda_id, content_type),
+        media_type=content_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{slug}.{format}"',
+        },
     )
@@ -1,5 +1,6 @@
 from typing import List, Optional, Union
 
+from sqlalchemy import ForeignKey
 from sqlmodel import (
     SQLModel, Field, Relationship,
 )
@@ -7,6 +8,8 @@ from pydantic import (
     BaseModel
 )
 
+from api.versions import bump_version_on_change
+
 
 class AgendaBase(SQLModel):
     slug: str = Field(
@@ -24,9 +27,19 @@ class Agenda(AgendaBase, table=True):
         index=True,
         unique=True,
     )
+    # Bumped by the database whenever one of its contacts changes, and
+    # served as the ETag of its lists.
+    version: int = Field(
+        default=0,
+        sa_column_kwargs={"server_default": "0"},
+    )
+    # The database deletes an agenda's contacts, see `Contact.agenda_id`.
     contacts: List["Contact"] = Relationship(
         back_populates="agenda",
-        sa_relationship_kwargs={"cascade": "delete"}
+        sa_relationship_kwargs={
+            "cascade": "delete",
+            "passive_deletes": True,
+        }
     )
 
 
@@ -48,11 +61,15 @@ class Contact(ContactBase, table=True):
         primary_key=True,
     )
     agenda_id: int = Field(
-        foreign_key="agenda.id"
+        index=True,
+        sa_column_args=[ForeignKey("agenda.id", ondelete="CASCADE")],
     )
     agenda: Optional["Agenda"] = Relationship(back_populates="contacts")
 
 
+bump_version_on_change(Contact.__table__, "agenda_id", "agenda")
+
+
 class ContactRead(ContactBase):
     id: int
     name: str
@@ -85,7 +102,13 @@ class AgendaReadWithItems(AgendaBase):
 
 class AgendaList(BaseModel):
     agendas: List["AgendaRead"]
+    next_cursor: Optional[str] = None
 
 
 class ContactList(BaseModel):
     contacts: List["ContactRead"]
+    next_cursor: Optional[str] = None
+
+
+class ContactImport(BaseModel):
+    imported: int
@@ -1,39 +1,91 @@
+import asyncio
+import csv
+import io
+import json
+import sys
+
 import pytest
 from fastapi.testclient import TestClient
 from sqlmodel import (
     Session, SQLModel, create_engine, select
 )
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.pool import StaticPool
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from api.db import get_session
+import api.db
+from api.db import (
+    ReadReplicas, async_url, get_async_session, get_async_read_session,
+    use_sqlite_profile,
+)
 from api.contact.app import app
 from api.contact.models import (
     Agenda, Contact
 )
+from api.pagination import encode_cursor
+
+
+@pytest.fixture(name="db_url")
+def db_url_fixture(tmp_path):
+    # The app and the test talk to the same database through different
+    # drivers, so it has to live in a file instead of in memory.
+    return f"sqlite:///{tmp_path / 'test.sqlite'}"
 
 
 @pytest.fixture(name="session")
-def session_fixture():
+def session_fixture(db_url: str):
     engine = create_engine(
-        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+        db_url, connect_args={"check_same_thread": False}, poolclass=StaticPool
     )
     SQLModel.metadata.create_all(engine)
     with Session(engine) as session:
         yield session
 
 
-@pytest.fixture(name="client")
-def client_fixture(session: Session):
-    def get_session_override():
-        return session
+@pytest.fixture(name="async_engine")
+def async_engine_fixture(db_url: str):
+    async_engine = create_async_engine(async_url(db_url), poolclass=StaticPool)
+    use_sqlite_profile(async_engine)
+    yield async_engine
+    asyncio.run(async_engine.dispose())
+
 
-    app.dependency_overrides[get_session] = get_session_override
-    client = TestClient(app)
-    yield client
+@pytest.fixture(name="client")
+def client_fixture(session: Session, async_engine):
+    async def get_async_session_override():
+        async with AsyncSession(
+            async_engine, expire_on_commit=False
+        ) as async_session:
+            yield async_session
+        # The app committed through its own connection, make the test
+        # session reload instead of trusting its identity map.
+        session.expunge_all()
+
+    app.dependency_overrides[get_async_session] = get_async_session_override
+    app.dependency_overrides[get_async_read_session] = get_async_session_override
+    with TestClient(app) as client:
+        yield client
     app.dependency_overrides.clear()
 
 
-def test_create_agenda(client: TestClient):
+@pytest.fixture(name="queries")
+def queries_fixture(async_engine):
+    queries = []
+
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(
+        async_engine.sync_engine, "before_cursor_execute", record_query
+    )
+    yield queries
+    event.remove(
+        async_engine.sync_engine, "before_cursor_execute", record_query
+    )
+
+
+def test_create_agenda(client: TestClient, queries: list):
     response = client.post(
         "/agendas/grizelle"
     )
@@ -42,6 +94,13 @@ def test_create_agenda(client: TestClient):
     assert response.status_code == 201
     assert data["slug"] == "grizelle"
     assert data["id"] is not None
+    assert len(queries) == 1
+
+    response = client.post(
+        "/agendas/grizelle"
+    )
+
+    assert response.status_code == 400
 
 
 def test_get_agendas(session: Session, client: TestClient):
@@ -108,7 +167,7 @@ def test_post_contacts(session: Session, client: TestClient):
     assert len(sombra.contacts) == 2
 
 
-def test_put_contact(session: Session, client: TestClient):
+def test_put_contact(session: Session, client: TestClient, queries: list):
     sombra = Agenda(slug="sombra")
     session.add(sombra)
     session.commit()
@@ -140,6 +199,7 @@ def test_put_contact(session: Session, client: TestClient):
     ).first()
 
     assert resp.status_code == 200
+    assert len(queries) == 1
     assert len(sombra.contacts) == 1
     assert data["name"] == "Grizzle"
     assert data["phone"] == "1 (603) 555-1234"
@@ -166,7 +226,7 @@ def test_put_contact(session: Session, client: TestClient):
     assert data["address"] == "123 Nonesuch Pl, Catington CA"
 
 
-def test_delete_contacts(session: Session, client: TestClient):
+def test_delete_contacts(session: Session, client: TestClient, queries: list):
     sombra = Agenda(slug="sombra")
     session.add(sombra)
     session.commit()
@@ -191,6 +251,7 @@ def test_delete_contacts(session: Session, client: TestClient):
     ).first()
 
     assert resp.status_code == 204
+    assert len(queries) == 1
     assert len(sombra.contacts) == 0
 
 
@@ -214,11 +275,12 @@ def test_delete_agenda(session: Session, client: TestClient):
     session.commit()
     session.refresh(grizelle)
 
+    sombra_id = sombra.id
     resp = client.delete(
         f"/agendas/sombra",
     )
 
-    sombra = session.get(Agenda, sombra.id)
+    sombra = session.get(Agenda, sombra_id)
     grizelle = session.get(Contact, grizelle.id)
     agendas = session.exec(select(Agenda)).all()
 
@@ -226,3 +288,394 @@ def test_delete_agenda(session: Session, client: TestClient):
     assert sombra is None
     assert grizelle is None
     assert len(agendas) == 1
+
+
+def test_get_agenda(session: Session, client: TestClient, queries: list):
+    sombra = Agenda(slug="sombra")
+    session.add(sombra)
+    session.commit()
+    session.refresh(sombra)
+    session.add(Contact(name="Grizelle", agenda_id=sombra.id))
+    session.commit()
+
+    resp = client.get(
+        "/agendas/sombra"
+    )
+    data = resp.json()
+
+    assert resp.status_code == 200
+    assert data["slug"] == "sombra"
+    assert len(data["contacts"]) == 1
+    assert data["contacts"][0]["name"] == "Grizelle"
+    assert len(queries) == 1
+
+    queries.clear()
+    resp = client.get(
+        "/agendas/sombra/contacts"
+    )
+    data = resp.json()
+
+    assert resp.status_code == 200
+    assert len(data["contacts"]) == 1
+    assert len(queries) == 1
+
+
+def test_contact_in_other_agenda(session: Session, client: TestClient):
+    sombra = Agenda(slug="sombra")
+    session.add(sombra)
+    session.add(Agenda(slug="grizelle"))
+    session.commit()
+    session.refresh(sombra)
+    contact = Contact(name="Nekobasu", agenda_id=sombra.id)
+    session.add(contact)
+    session.commit()
+    session.refresh(contact)
+
+    resp = client.put(
+        f"/agendas/grizelle/contacts/{contact.id}",
+        json={"name": "Totoro"}
+    )
+    assert resp.status_code == 404
+
+    resp = client.delete(
+        f"/agendas/grizelle/contacts/{contact.id}",
+    )
+    assert resp.status_code == 404
+
+    resp = client.delete(
+        f"/agendas/sombra/contacts/{contact.id + 1}",
+    )
+    assert resp.status_code == 404
+
+
+def test_import_contacts(session: Session, client: TestClient):
+    sombra = Agenda(slug="sombra")
+    session.add(sombra)
+    session.commit()
+
+    resp = client.post(
+        "/agendas/sombra/contacts/import",
+        content="\n".join(
+            json.dumps({"name": f"Cat #{i}", "email": f"cat{i}@catemail.com"})
+            for i in range(1200)
+        ),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+
+    assert resp.status_code == 201
+    assert resp.json()["imported"] == 1200
+
+    resp = client.post(
+        "/agendas/sombra/contacts/import",
+        content=(
+            "name,phone,address\n"
+            "Grizelle,1 (603) 555-1234,\"123 Nonesuch Pl\n"
+            "Catington, CA\"\n"
+            "\n"
+            "Nekobasu,,\n"
+        ),
+        headers={"Content-Type": "text/csv"},
+    )
+
+    sombra = session.exec(select(Agenda).where(
+        Agenda.slug == "sombra")
+    ).first()
+    grizelle = session.exec(select(Contact).where(
+        Contact.name == "Grizelle")
+    ).first()
+
+    assert resp.status_code == 201
+    assert resp.json()["imported"] == 2
+    assert len(sombra.contacts) == 1202
+    assert grizelle.address == "123 Nonesuch Pl\nCatington, CA"
+    assert grizelle.email == ""
+
+
+def test_import_contacts_invalid(session: Session, client: TestClient):
+    sombra = Agenda(slug="sombra")
+    session.add(sombra)
+    session.commit()
+
+    resp = client.post(
+        "/agendas/sombra/contacts/import",
+        content='{"name": "Grizelle"}\n{"phone": "1 (603) 555-1234"}\n',
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    data = resp.json()
+
+    sombra = session.exec(select(Agenda).where(
+        Agenda.slug == "sombra")
+    ).first()
+
+    assert resp.status_code == 422
+    assert data["detail"][0]["loc"] == ["body", 2, "name"]
+    assert len(sombra.contacts) == 0
+
+    resp = client.post(
+        "/agendas/sombra/contacts/import",
+        content="name\nGrizelle\n",
+        headers={"Content-Type": "application/json"},
+    )
+
+    assert resp.status_code == 415
+
+
+def test_import_contacts_too_large(
+    session: Session, client: TestClient, monkeypatch
+):
+    sombra = Agenda(slug="sombra")
+    session.add(sombra)
+    session.commit()
+    content = "\n".join(
+        json.dumps({"name": f"Cat #{i}"}) for i in range(3)
+    )
+
+    # api.contact.app is the FastAPI app once the package is imported.
+    module = sys.modules["api.contact.app"]
+    monkeypatch.setattr(module, "CONTACT_IMPORT_MAX_RECORDS", 2)
+    resp = client.post(
+        "/agendas/sombra/contacts/import",
+        content=content,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+
+    assert resp.status_code == 413
+    assert resp.json()["detail"] == "Imports are limited to 2 contacts."
+
+    monkeypatch.setattr(module, "CONTACT_IMPORT_MAX_RECORDS", 3)
+    monkeypatch.setattr(module, "CONTACT_IMPORT_MAX_BYTES", len(content) - 1)
+    # Streamed without a length, so it's counted as it comes in.
+    resp = client.post(
+        "/agendas/sombra/contacts/import",
+        content=iter([content.encode()]),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+
+    assert resp.status_code == 413
+
+    sombra = session.exec(select(Agenda).where(
+        Agenda.slug == "sombra")
+    ).first()
+
+    assert len(sombra.contacts) == 0
+
+
+def test_export_contacts(session: Session, client: TestClient):
+    sombra = Agenda(slug="sombra")
+    session.add(sombra)
+    session.commit()
+    session.refresh(sombra)
+    for i in range(1200):
+        session.add(Contact(name=f"Cat #{i}", agenda_id=sombra.id))
+    session.add(Contact(name="Grizelle, the cat", agenda_id=sombra.id))
+    session.commit()
+
+    resp = client.get(
+        "/agendas/sombra/contacts/export"
+    )
+    lines = resp.text.splitlines()
+
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    assert len(lines) == 1201
+    assert json.loads(lines[0])["name"] == "Cat #0"
+
+    resp = client.get(
+        "/agendas/sombra/contacts/export?format=csv"
+    )
+    rows = list(csv.reader(io.StringIO(resp.text)))
+
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/csv")
+    assert rows[0] == ["id", "name", "phone", "email", "address"]
+    assert len(rows) == 1202
+    assert rows[-1][1] == "Grizelle, the cat"
+
+    resp = client.get(
+        "/agendas/grizelle/contacts/export"
+    )
+
+    assert resp.status_code == 404
+
+
+def test_export_contacts_from_replica(
+    session: Session, client: TestClient, async_engine, monkeypatch
+):
+    # The real read session, which only picks its engine on first use.
+    monkeypatch.setattr(
+        api.db, "read_replicas", ReadReplicas([async_engine], async_engine)
+    )
+    del app.dependency_overrides[get_async_read_session]
+    sombra = Agenda(slug="sombra")
+    session.add(sombra)
+    session.commit()
+    session.refresh(sombra)
+    session.add(Contact(name="Grizelle", agenda_id=sombra.id))
+    session.commit()
+
+    resp = client.get(
+        "/agendas/sombra/contacts/export"
+    )
+
+    assert resp.status_code == 200
+    assert json.loads(resp.text)["name"] == "Grizelle"
+
+
+def test_get_agendas_cursor(session: Session, client: TestClient):
+    for i in range(3):
+        session.add(Agenda(slug=f"cat{i}"))
+    session.commit()
+
+    resp = client.get(
+        "/agendas?limit=2"
+    )
+    data = resp.json()
+
+    assert [agenda["slug"] for agenda in data["agendas"]] == ["cat0", "cat1"]
+
+    resp = client.get(
+        f"/agendas?limit=2&cursor={data['next_cursor']}"
+    )
+    data = resp.json()
+
+    assert [agenda["slug"] for agenda in data["agendas"]] == ["cat2"]
+    assert data["next_cursor"] is None
+
+    for last_id in (-1, 2 ** 63, 10 ** 20):
+        resp = client.get(
+            "/agendas", params={"cursor": encode_cursor(last_id)}
+        )
+
+        assert resp.status_code == 400
+        assert resp.json()["detail"] == "Invalid cursor."
+
+
+def test_get_contacts_cursor(session: Session, client: TestClient, queries: list):
+    sombra = Agenda(slug="sombra")
+    grizelle = Agenda(slug="grizelle")
+    session.add(sombra)
+    session.add(grizelle)
+    session.commit()
+    for i in range(5):
+        session.add(Contact(name=f"Cat #{i}", agenda_id=sombra.id))
+        session.add(Contact(name=f"Kitten #{i}", agenda_id=grizelle.id))
+    session.commit()
+
+    names, cursor = [], None
+    while True:
+        queries.clear()
+        resp = client.get(
+            "/agendas/sombra/contacts",
+            params={"limit": 2, **({"cursor": cursor} if cursor else {})}
+        )
+        data = resp.json()
+        assert resp.status_code == 200
+        assert len(queries) == 1
+        names += [contact["name"] for contact in data["contacts"]]
+        cursor = data["next_cursor"]
+        if not cursor:
+            break
+
+    assert names == [f"Cat #{i}" for i in range(5)]
+
+    resp = client.get(
+        "/agendas/nekobasu/contacts"
+    )
+
+    assert resp.status_code == 404
+
+    resp = client.get(
+        "/agendas/sombra/contacts?offset=5"
+    )
+
+    assert resp.status_code == 200
+    assert resp.json()["contacts"] == []
+
+
+def test_agenda_etags(client: TestClient, queries: list):
+    client.post("/agendas/sombra")
+    contact = client.post(
+        "/agendas/sombra/contacts", json={"name": "Grizelle"}
+    ).json()
+
+    for url in ("/agendas/sombra", "/agendas/sombra/contacts"):
+        etag = client.get(url).headers["etag"]
+        queries.clear()
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert len(queries) == 1
+    assert client.get(
+        "/agendas/sombra/contacts", params={"cursor": "eyJpZCI6MX0"}
+    ).headers["etag"] == etag
+
+    client.put(
+        f"/agendas/sombra/contacts/{contact['id']}", json={"phone": "555"}
+    )
+    assert client.get(
+        "/agendas/sombra", headers={"If-None-Match": etag}
+    ).status_code == 200
+    assert client.put(
+        f"/agendas/sombra/contacts/{contact['id']}", json={"phone": "556"},
+        headers={"If-Match": etag},
+    ).status_code == 412
+    assert client.delete(
+        f"/agendas/sombra/contacts/{contact['id']}",
+        headers={"If-Match": etag},
+    ).status_code == 412
+    assert client.delete(
+        "/agendas/sombra", headers={"If-Match": etag}
+    ).status_code == 412
+
+    etag = client.get("/agendas/sombra").headers["etag"]
+    assert client.delete(
+        f"/agendas/sombra/contacts/{contact['id']}",
+        headers={"If-Match": etag},
+    ).status_code == 204
+    assert client.delete(
+        "/agendas/sombra", headers={"If-Match": etag}
+    ).status_code == 412
+    assert client.delete(
+        "/agendas/sombra", headers={"If-Match": "*"}
+    ).status_code == 204
+
+
+def test_agenda_events(client: TestClient):
+    client.post("/agendas/sombra")
+
+    with client.websocket_connect("/agendas/sombra/events") as websocket:
+        contact = client.post(
+            "/agendas/sombra/contacts", json={"name": "Sombra"}
+        ).json()
+        assert websocket.receive_json() == {
+            "type": "contact.created", "contact": contact
+        }
+
+        contact = client.put(
+            f"/agendas/sombra/contacts/{contact['id']}",
+            json={"phone": "555-0100"},
+        ).json()
+        assert websocket.receive_json() == {
+            "type": "contact.updated", "contact": contact
+        }
+
+        client.delete(f"/agendas/sombra/contacts/{contact['id']}")
+        assert websocket.receive_json() == {
+            "type": "contact.deleted", "id": contact["id"]
+        }
+
+        client.post(
+            "/agendas/sombra/contacts/import",
+            content='{"name": "Cat"}\n{"name": "Dog"}',
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        assert websocket.receive_json() == {
+            "type": "contacts.imported", "imported": 2
+        }
+
+        client.delete("/agendas/sombra")
+        assert websocket.receive_json() == {"type": "agenda.deleted"}
+        assert websocket.receive_json() == {"type": "closed"}
+
+
+def test_agenda_events_missing_agenda(client: TestClient):
+    assert client.get("/agendas/sombra/events").status_code == 404
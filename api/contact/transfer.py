@@ -0,0 +1,145 @@
+import codecs
+import csv
+import io
+import json
+
+from typing import AsyncIterator, Dict, Tuple
+
+from fastapi import Request
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import select
+
+from api.contact.models import Contact
+
+# Content types accepted by the import, and served by the export.
+NDJSON = "application/x-ndjson"
+CSV = "text/csv"
+
+COLUMNS = ("id", "name", "phone", "email", "address")
+
+
+class RecordError(ValueError):
+    def __init__(self, line: int, message: str):
+        super().__init__(message)
+        self.line = line
+
+
+class TooLarge(ValueError):
+    pass
+
+
+async def read_lines(request: Request, max_bytes: int) -> AsyncIterator[str]:
+    """Decodes the request body into lines as it streams in."""
+    if int(request.headers.get("content-length") or 0) > max_bytes:
+        raise TooLarge(f"Imports are limited to {max_bytes} bytes.")
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending, received = "", 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise TooLarge(f"Imports are limited to {max_bytes} bytes.")
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def read_records(
+    request: Request,
+    content_type: str,
+    max_bytes: int,
+    max_records: int,
+) -> AsyncIterator[Tuple[int, Dict]]:
+    """Yields `(line number, record)` from an NDJSON or CSV body.
+
+    Raises `TooLarge` once the body goes past `max_bytes`, or holds more
+    than `max_records` records.
+    """
+    records = 0
+    async for line_no, record in parse_records(
+        read_lines(request, max_bytes), content_type
+    ):
+        records += 1
+        if records > max_records:
+            raise TooLarge(f"Imports are limited to {max_records} contacts.")
+        yield line_no, record
+
+
+async def parse_records(
+    lines: AsyncIterator[str],
+    content_type: str
+) -> AsyncIterator[Tuple[int, Dict]]:
+    line_no = 0
+    if content_type == NDJSON:
+        async for line in lines:
+            line_no += 1
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise RecordError(line_no, f"Invalid JSON: {e.msg}.")
+            if not isinstance(record, dict):
+                raise RecordError(line_no, "Expected a JSON object.")
+            yield line_no, record
+        return
+
+    header = None
+    pending, quotes, start = [], 0, 1
+    async for line in lines:
+        line_no += 1
+        pending.append(line)
+        # An odd number of quotes means a quoted field spans lines.
+        quotes += line.count('"')
+        if quotes % 2:
+            continue
+        row = next(csv.reader(io.StringIO("".join(pending))), [])
+        record_start, start = start, line_no + 1
+        pending, quotes = [], 0
+        if not any(field.strip() for field in row):
+            continue
+        if header is None:
+            header = [field.strip().lower() for field in row]
+            continue
+        if len(row) > len(header):
+            raise RecordError(record_start, "More fields than columns.")
+        yield record_start, dict(zip(header, row))
+    if pending:
+        raise RecordError(start, "Unterminated quoted field.")
+
+
+async def export_rows(
+    engine: AsyncEngine,
+    agenda_id: int,
+    content_type: str,
+    batch_size: int = 500
+) -> AsyncIterator[str]:
+    """Streams an agenda's contacts from a server-side cursor."""
+    if content_type == CSV:
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(COLUMNS)
+    async with engine.connect() as conn:
+        result = await conn.stream(
+            select(
+                *(getattr(Contact, column) for column in COLUMNS)
+            ).where(
+                Contact.agenda_id == agenda_id
+            ).order_by(Contact.id).execution_options(yield_per=batch_size)
+        )
+        async for rows in result.partitions():
+            if content_type == CSV:
+                writer.writerows(rows)
+                yield out.getvalue()
+                out.seek(0)
+                out.truncate()
+            else:
+                yield "".join(
+                    json.dumps(dict(zip(COLUMNS, row))) + "\n"
+                    for row in rows
+                )
+    if content_type == CSV and out.tell():
+        yield out.getvalue()
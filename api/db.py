@@ -1,14 +1,312 @@
+import itertools
 import os
+import time
 
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
 from sqlmodel import (
     Session, create_engine
 )
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from api.metrics import Gauge, Histogram
+
+DB_URL = os.getenv("DB_URL", "sqlite:///./playground.sqlite")
+DB_SQLITE_PROFILE = os.getenv("DB_SQLITE_PROFILE", "default")
+DB_READ_URLS = [
+    url.strip()
+    for url in os.getenv("DB_READ_URL", "").split(",")
+    if url.strip()
+]
+DB_READ_RETRY = float(os.getenv("DB_READ_RETRY", 30))
+
+# Async drivers for each sync backend we deploy on.
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def async_url(url: str) -> str:
+    """Turns a sync `DB_URL` into the matching async driver URL."""
+    # Heroku still hands out `postgres://`, which SQLAlchemy won't parse.
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    db_url = make_url(url)
+    backend = db_url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        return url
+    return db_url.set(
+        drivername=ASYNC_DRIVERS[backend]
+    ).render_as_string(hide_password=False)
+
+
+def sqlite_pragmas(profile: str) -> list[str]:
+    """PRAGMAs to run on each new SQLite connection for a given profile."""
+    # Deletes cascade in the database, which SQLite only does when asked.
+    if profile != "tuned":
+        return ["PRAGMA foreign_keys=ON"]
+    return [
+        # WAL lets readers carry on while a writer commits, and NORMAL only
+        # fsyncs on checkpoints, which is still safe under WAL.
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        f"PRAGMA mmap_size={int(os.getenv('DB_SQLITE_MMAP_SIZE', 268435456))}",
+        # Negative sizes are in KiB rather than pages.
+        f"PRAGMA cache_size={int(os.getenv('DB_SQLITE_CACHE_SIZE', -65536))}",
+        "PRAGMA temp_store=MEMORY",
+        f"PRAGMA busy_timeout={int(os.getenv('DB_SQLITE_BUSY_TIMEOUT', 5000))}",
+        "PRAGMA foreign_keys=ON",
+    ]
+
+
+def use_sqlite_profile(
+    engine: Engine | AsyncEngine,
+    profile: str = DB_SQLITE_PROFILE
+) -> None:
+    """Applies a SQLite profile to every connection the engine opens."""
+    if isinstance(engine, AsyncEngine):
+        engine = engine.sync_engine
+    pragmas = sqlite_pragmas(profile)
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def sqlite_pool_options(url: str, profile: str = DB_SQLITE_PROFILE) -> dict:
+    """Pool options that let a SQLite profile pay off.
+
+    aiosqlite opens a new connection for every checkout by default, which
+    would rerun the profile's PRAGMAs (and spawn a thread) per request.
+    """
+    db_url = make_url(url)
+    if (
+        profile != "tuned"
+        or db_url.get_backend_name() != "sqlite"
+        or db_url.database in (None, "", ":memory:")
+        or not db_url.get_dialect().is_async
+    ):
+        return {}
+    return {"poolclass": AsyncAdaptedQueuePool}
+
+
+pool_checkout_seconds = Histogram(
+    "db_pool_checkout_seconds",
+    "Time spent waiting for a connection from the pool.",
+    (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+pool_connections = Gauge(
+    "db_pool_connections",
+    "Connections in the pool, by state.",
+)
+
+
+class TimedPool:
+    """Records how long each checkout waits on the pool."""
+    engine_name = ""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_checkout_seconds.observe(
+                time.perf_counter() - start,
+                engine=self.engine_name,
+            )
+
+
+def pool_options(url: str, name: str, **options) -> dict:
+    """`create_engine` pool options for `url`, sized from the env."""
+    db_url = make_url(url)
+    poolclass: type[Pool] = options.get(
+        "poolclass",
+        db_url.get_dialect().get_pool_class(db_url)
+    )
+    defaults = {
+        "pool_pre_ping": os.getenv(
+            "DB_POOL_PRE_PING", "false"
+        ).lower() in ("1", "true", "yes"),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", -1)),
+    }
+    # Only queue pools have a size; SQLite's memory and null pools don't.
+    if issubclass(poolclass, QueuePool):
+        defaults.update(
+            pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+            pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        )
+    return {
+        **defaults,
+        **options,
+        "poolclass": type(
+            f"Timed{poolclass.__name__}",
+            (TimedPool, poolclass),
+            {"engine_name": name}
+        ),
+    }
+
+
+def watch_pool(engine: Engine | AsyncEngine, name: str) -> None:
+    """Exposes the pool's checked out, idle and overflow counts."""
+    if not isinstance(engine.pool, QueuePool):
+        return
+    # `engine.pool` is swapped on dispose(), so always read it fresh.
+    pool_connections.watch(
+        lambda: engine.pool.checkedout(), engine=name, state="checked_out"
+    )
+    pool_connections.watch(
+        lambda: engine.pool.checkedin(), engine=name, state="idle"
+    )
+    pool_connections.watch(
+        lambda: max(engine.pool.overflow(), 0), engine=name, state="overflow"
+    )
+
+
+def insert(session: AsyncSession | Session, model: type):
+    """The session dialect's INSERT, which supports ON CONFLICT clauses."""
+    dialects = {"postgresql": postgresql, "sqlite": sqlite}
+    return dialects[session.bind.dialect.name].insert(model)
+
+
+def make_async_engine(url: str, name: str) -> AsyncEngine:
+    """Builds an async engine with the shared pool and SQLite settings."""
+    async_engine = create_async_engine(
+        url,
+        **pool_options(url, name, **sqlite_pool_options(url))
+    )
+    use_sqlite_profile(async_engine)
+    watch_pool(async_engine, name)
+    return async_engine
+
+
+class ReplicaSession(Session):
+    """Picks its replica on first use rather than when it's opened.
+
+    Requests that never query, like those answered from a cache or
+    rejected early, never check out a connection.
+    """
+
+    def __init__(self, replicas: "ReadReplicas", **kwargs):
+        super().__init__(**kwargs)
+        self.replicas = replicas
+
+    def get_bind(self, *args, **kwargs):
+        if self.bind is None:
+            self.bind = self.replicas.pick()
+        return self.bind
+
+
+def served_by_replica(session: AsyncSession) -> bool:
+    """Whether `session` read from a replica, which may lag behind writes."""
+    sync_session = session.sync_session
+    return (
+        isinstance(sync_session, ReplicaSession)
+        and sync_session.bind is not None
+        and sync_session.bind is not sync_session.replicas.primary.sync_engine
+    )
+
+
+class ReadReplicas:
+    """Round-robins read sessions over replica engines.
+
+    A replica that fails to hand out a connection is skipped for
+    `retry_after` seconds. When every replica is down, or none are
+    configured, reads go to the primary.
+    """
+
+    def __init__(
+        self,
+        engines: list[AsyncEngine],
+        primary: AsyncEngine,
+        retry_after: float = DB_READ_RETRY,
+    ):
+        self.engines = engines
+        self.primary = primary
+        self.retry_after = retry_after
+        self.down_until = [0.0] * len(engines)
+        self.turn = itertools.count()
+
+    def candidates(self):
+        now = time.monotonic()
+        healthy = [
+            index for index, until in enumerate(self.down_until)
+            if until <= now
+        ]
+        if not healthy:
+            return
+        start = next(self.turn) % len(healthy)
+        for index in healthy[start:] + healthy[:start]:
+            yield index, self.engines[index]
+
+    def pick(self) -> Engine:
+        """The first replica that hands out a connection, else the primary.
+
+        Runs inside the session's greenlet, so the async engines can be
+        driven through their sync facade. The connection goes straight
+        back to the pool, for the session's own checkout to reuse.
+        """
+        for index, replica in self.candidates():
+            try:
+                replica.sync_engine.connect().close()
+            except (DBAPIError, OSError):
+                self.down_until[index] = time.monotonic() + self.retry_after
+                continue
+            return replica.sync_engine
+        return self.primary.sync_engine
+
+    def session(self) -> AsyncSession:
+        return AsyncSession(
+            sync_session_class=ReplicaSession,
+            replicas=self,
+            expire_on_commit=False,
+        )
+
+
+ASYNC_DB_URL = os.getenv("DB_ASYNC_URL", async_url(DB_URL))
 
 engine = create_engine(
-    os.getenv("DB_URL", "sqlite:///./playground.sqlite")
+    DB_URL,
+    **pool_options(DB_URL, "sync")
+)
+use_sqlite_profile(engine)
+watch_pool(engine, "sync")
+
+async_engine = make_async_engine(ASYNC_DB_URL, "async")
+
+read_replicas = ReadReplicas(
+    [
+        make_async_engine(async_url(url), f"replica{i}")
+        for i, url in enumerate(DB_READ_URLS)
+    ],
+    async_engine,
 )
 
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+
+async def get_async_session():
+    # Objects must stay readable after commit, lazy refreshes can't
+    # happen outside the greenlet.
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+
+async def get_async_read_session():
+    """A session for handlers that only SELECT, served by a replica."""
+    async with read_replicas.session() as session:
+        yield session
@@ -0,0 +1,73 @@
+import json
+
+from typing import Optional
+
+from fastapi import FastAPI, Request, Response
+from fastapi.openapi.docs import get_swagger_ui_html
+
+from api.responses import PrecompressedContent
+
+OPENAPI_URL = "/openapi.json"
+
+
+class Docs:
+    """A sub-app's OpenAPI document and Swagger UI page, rendered once.
+
+    main.py builds them at startup, where it knows the mount path, so no
+    request ever waits on schema generation. Apps served on their own
+    (tests) build them on the first hit instead.
+    """
+
+    def __init__(self, app: FastAPI, title: str):
+        self.app = app
+        self.title = title
+        self.openapi: Optional[PrecompressedContent] = None
+        self.html: Optional[PrecompressedContent] = None
+
+    def build(self, root_path: str = ""):
+        root_path = root_path.rstrip("/")
+        # Swagger UI sends requests to the first server, the mount path.
+        if root_path and {"url": root_path} not in self.app.servers:
+            self.app.servers.insert(0, {"url": root_path})
+        self.app.openapi_schema = None
+        self.openapi = PrecompressedContent(
+            json.dumps(
+                self.app.openapi(), separators=(",", ":")
+            ).encode(),
+            media_type="application/json",
+        )
+        self.html = PrecompressedContent(
+            get_swagger_ui_html(
+                title=self.title,
+                openapi_url=f"{root_path}{OPENAPI_URL}",
+                swagger_favicon_url="/favicon.ico",
+            ).body,
+            media_type="text/html",
+        )
+
+    def built(self, request: Request):
+        if self.openapi is None:
+            self.build(request.scope.get("root_path", ""))
+
+    async def openapi_json(self, request: Request) -> Response:
+        self.built(request)
+        return self.openapi.response(request)
+
+    async def swagger_ui_html(self, request: Request) -> Response:
+        self.built(request)
+        return self.html.response(request)
+
+
+def serve_docs(app: FastAPI, title: str) -> Docs:
+    """Serves `/openapi.json` and `/docs` from memory.
+
+    The app is created with `openapi_url=None` and `docs_url=None`, so
+    FastAPI doesn't add its own.
+    """
+    docs = Docs(app, title)
+    app.add_api_route(
+        OPENAPI_URL, docs.openapi_json, include_in_schema=False
+    )
+    app.add_api_route("/docs", docs.swagger_ui_html, include_in_schema=False)
+    app.state.docs = docs
+    return docs
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import os
+
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, Optional, Set
+
+import anyio
+from fastapi import HTTPException, WebSocket, status
+from fastapi.responses import StreamingResponse
+
+from api.metrics import Counter, Gauge
+
+# Events held for a subscriber that isn't reading. Past it the backlog
+# is dropped for a single `resync`, the client reloads the resource.
+EVENTS_BUFFER = int(os.getenv("EVENTS_BUFFER", 64))
+# Open streams per worker, past it new ones get a 503.
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", 10000))
+# Seconds between keepalives on idle event streams.
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", 15))
+
+events_published = Counter(
+    "events_published_total",
+    "Change events published, by topic kind.",
+)
+events_dropped = Counter(
+    "events_dropped_total",
+    "Change events dropped from the buffer of a subscriber that fell behind.",
+)
+subscribers = Gauge(
+    "events_subscribers",
+    "Open change event streams.",
+)
+
+RESYNC = {"type": "resync"}
+CLOSED = {"type": "closed"}
+
+
+class Subscription:
+    """One stream's buffer of events, a bounded queue that never blocks.
+
+    Publishing never waits on a slow reader; it drops the backlog and
+    asks the reader to resync instead.
+    """
+
+    __slots__ = ("buffer", "size", "ready", "closed", "subscribed")
+
+    def __init__(self, size: int):
+        self.buffer = deque()
+        self.size = size
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.subscribed = True
+
+    def put(self, event: dict, kind: str):
+        if len(self.buffer) >= self.size:
+            events_dropped.inc(len(self.buffer), kind=kind)
+            self.buffer.clear()
+            event = RESYNC
+        self.buffer.append(event)
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def get(self, timeout: float) -> Optional[dict]:
+        """The next event, None after `timeout` idle seconds."""
+        if not self.buffer and not self.closed:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        if self.buffer:
+            return self.buffer.popleft()
+        return CLOSED
+
+
+class Broker:
+    """In-process pub/sub of change events, by topic.
+
+    Topics are `<kind>:<id>`, like `todo:12`. Only this worker's writes
+    are seen by its subscribers.
+    """
+
+    def __init__(
+        self,
+        buffer: int = EVENTS_BUFFER,
+        max_subscribers: int = EVENTS_MAX_SUBSCRIBERS,
+    ):
+        self.buffer = buffer
+        self.max_subscribers = max_subscribers
+        self.topics: Dict[str, Set[Subscription]] = {}
+        self.count = 0
+        subscribers.watch(lambda: self.count)
+
+    def publish(self, topic: str, event: dict):
+        kind = topic.partition(":")[0]
+        events_published.inc(kind=kind)
+        for subscription in self.topics.get(topic, ()):
+            subscription.put(event, kind)
+
+    def close(self, topic: str):
+        """Ends every stream on `topic`, once they've read what's left."""
+        for subscription in self.topics.pop(topic, ()):
+            subscription.close()
+
+    def subscribe(self, topic: str) -> Subscription:
+        if self.count >= self.max_subscribers:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many open event streams, try again later.",
+            )
+        subscription = Subscription(self.buffer)
+        self.topics.setdefault(topic, set()).add(subscription)
+        self.count += 1
+        return subscription
+
+    def unsubscribe(self, topic: str, subscription: Subscription):
+        """Releases `subscription`, any number of times."""
+        if not subscription.subscribed:
+            return
+        subscription.subscribed = False
+        self.count -= 1
+        topic_subscriptions = self.topics.get(topic)
+        if topic_subscriptions is not None:
+            topic_subscriptions.discard(subscription)
+            if not topic_subscriptions:
+                del self.topics[topic]
+
+    async def events(
+        self,
+        topic: str,
+        subscription: Subscription,
+        heartbeat: float = EVENTS_HEARTBEAT,
+    ) -> AsyncIterator[Optional[dict]]:
+        """Yields events, and None after each idle `heartbeat` seconds."""
+        try:
+            while True:
+                event = await subscription.get(heartbeat)
+                yield event
+                if event is CLOSED:
+                    return
+        finally:
+            self.unsubscribe(topic, subscription)
+
+
+def sse(event: Optional[dict]) -> bytes:
+    if event is None:
+        # A comment, which clients ignore, keeps proxies from timing out.
+        return b": keepalive\n\n"
+    return (
+        f"event: {event['type']}\n"
+        f"data: {json.dumps(event, separators=(',', ':'))}\n\n"
+    ).encode()
+
+
+class EventStreamResponse(StreamingResponse):
+    """Releases its subscription however the response ends.
+
+    The body's own cleanup only runs once it has started, a client that
+    disconnects before then would otherwise hold a subscription forever.
+    """
+
+    def __init__(self, topic: str, subscription: Subscription, **kwargs):
+        super().__init__(**kwargs)
+        self.topic = topic
+        self.subscription = subscription
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            broker.unsubscribe(self.topic, self.subscription)
+
+
+def event_stream(topic: str) -> StreamingResponse:
+    """A `text/event-stream` of `topic`'s events.
+
+    Subscribes right away, so nothing published after the handler
+    returns is missed.
+    """
+    subscription = broker.subscribe(topic)
+
+    async def stream():
+        # A first comment, so the client knows the stream is open.
+        yield b": connected\n\n"
+        async with aclosing(broker.events(topic, subscription)) as events:
+            async for event in events:
+                yield sse(event)
+
+    return EventStreamResponse(
+        topic,
+        subscription,
+        content=stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # Nginx would otherwise buffer the stream.
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+async def websocket_stream(websocket: WebSocket, topic: str):
+    """Sends `topic`'s events as JSON messages until either side closes."""
+    try:
+        subscription = broker.subscribe(topic)
+    except HTTPException:
+        # "Try again later".
+        await websocket.close(code=1013)
+        return
+
+    async def send_events(cancel_scope: anyio.CancelScope):
+        async with aclosing(broker.events(topic, subscription)) as events:
+            async for event in events:
+                if event is not None:
+                    await websocket.send_json(event)
+        await websocket.close()
+        cancel_scope.cancel()
+
+    async def wait_for_disconnect(cancel_scope: anyio.CancelScope):
+        # Anything the client sends is ignored.
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+        cancel_scope.cancel()
+
+    # Released here too, the client may leave before events are read.
+    try:
+        await websocket.accept()
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(send_events, task_group.cancel_scope)
+            task_group.start_soon(wait_for_disconnect, task_group.cancel_scope)
+    finally:
+        broker.unsubscribe(topic, subscription)
+
+
+broker = Broker()
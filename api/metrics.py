@@ -0,0 +1,94 @@
+import bisect
+import threading
+
+from typing import Callable, Dict, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+registry = []
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: Dict[Labels, float] = {}
+        registry.append(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+
+class Gauge:
+    """A gauge read from callbacks when the metrics are scraped."""
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.callbacks: Dict[Labels, Callable[[], float]] = {}
+        registry.append(self)
+
+    def watch(self, callback: Callable[[], float], **labels) -> None:
+        self.callbacks[tuple(sorted(labels.items()))] = callback
+
+    def samples(self):
+        for labels, callback in self.callbacks.items():
+            yield self.name, labels, callback()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Labels, list] = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                # One slot per bucket, then +Inf, then the running sum.
+                self.values[key] = [0] * (len(self.buckets) + 2)
+            counts = self.values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {k: list(v) for k, v in self.values.items()}
+        for labels, counts in values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                yield f"{self.name}_bucket", labels + (("le", str(bound)),), total
+            yield f"{self.name}_count", labels, total
+            yield f"{self.name}_sum", labels, counts[-1]
+
+
+def render() -> str:
+    """Renders every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,52 @@
+import base64
+import binascii
+import json
+
+from typing import Optional, Sequence, Tuple
+
+from fastapi import HTTPException, status
+
+
+# Ids are SQLite/Postgres signed 64-bit integers, anything past that
+# can't be bound into the keyset query.
+MAX_ID = 2 ** 63
+
+
+def encode_cursor(last_id: int) -> str:
+    """An opaque cursor pointing just past the row with `last_id`."""
+    return base64.urlsafe_b64encode(
+        json.dumps({"id": last_id}).encode()
+    ).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> int:
+    """The id a cursor points past, 0 when there is no cursor."""
+    if not cursor:
+        return 0
+    try:
+        last_id = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        )["id"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        last_id = None
+    if (
+        not isinstance(last_id, int) or isinstance(last_id, bool)
+        or not 0 <= last_id < MAX_ID
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor."
+        )
+    return last_id
+
+
+def paginate(rows: Sequence, limit: int) -> Tuple[Sequence, Optional[str]]:
+    """Splits `limit + 1` rows ordered by id into a page and its cursor.
+
+    The extra row only tells whether there is a next page, so the last
+    page doesn't hand out a cursor to an empty one.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    return page, encode_cursor(page[-1].id)
@@ -0,0 +1,414 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from collections import defaultdict
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+import anyio
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route, compile_path
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+RATELIMIT_STORAGE_URL = os.getenv("RATELIMIT_STORAGE_URL", "memory://")
+RATELIMIT_STRATEGY = os.getenv("RATELIMIT_STRATEGY", "fixed-window")
+
+UNITS = {
+    "second": 1,
+    "minute": 60,
+    "hour": 60 * 60,
+    "day": 60 * 60 * 24,
+}
+
+
+class Rate(NamedTuple):
+    limit: int
+    period: int
+    multiples: int
+    unit: str
+
+    def __str__(self) -> str:
+        return f"{self.limit} per {self.multiples} {self.unit}"
+
+
+def parse_rate(rate: str) -> Rate:
+    """Parses `15/minute`, `15 per minute` or `100/2 hours` into a Rate."""
+    match = re.fullmatch(
+        r"\s*(\d+)\s*(?:/|per)\s*(\d+)?\s*(second|minute|hour|day)s?\s*",
+        rate,
+    )
+    if not match:
+        raise ValueError(f"Invalid rate {rate!r}.")
+    limit, multiples, unit = match.groups()
+    multiples = int(multiples or 1)
+    return Rate(int(limit), UNITS[unit] * multiples, multiples, unit)
+
+
+class Storage:
+    """Counters that expire, shared by everything that hits the same store."""
+
+    def incr(self, key: str, expiry: int, amount: int = 1) -> int:
+        """Adds `amount` to `key`, returns the new count.
+
+        A new counter expires `expiry` seconds after its first increment.
+        """
+        raise NotImplementedError
+
+    def get(self, key: str) -> int:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class MemoryStorage(Storage):
+    """Counters in a dict, for a single process.
+
+    Expired counters are dropped when read, and swept whenever the dict
+    has doubled since the last sweep, so a check never scans.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.sweep_at = 1024
+
+    def incr(self, key: str, expiry: int, amount: int = 1) -> int:
+        now = time.monotonic()
+        with self.lock:
+            counter = self.counters.get(key)
+            if not counter or counter[1] <= now:
+                counter = self.counters[key] = [0, now + expiry]
+            counter[0] += amount
+            if len(self.counters) >= self.sweep_at:
+                self.sweep(now)
+            return counter[0]
+
+    def get(self, key: str) -> int:
+        counter = self.counters.get(key)
+        if not counter or counter[1] <= time.monotonic():
+            return 0
+        return counter[0]
+
+    def sweep(self, now: float):
+        self.counters = {
+            key: counter for key, counter in self.counters.items()
+            if counter[1] > now
+        }
+        self.sweep_at = max(1024, len(self.counters) * 2)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.counters = {}
+
+
+class SQLiteStorage(Storage):
+    """Counters in a SQLite file, shared by every worker on the host."""
+
+    # Expired rows are deleted once every this many increments.
+    SWEEP_EVERY = 1000
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=5
+        )
+        self.lock = threading.Lock()
+        self.writes = 0
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS ratelimit ("
+                " key TEXT PRIMARY KEY,"
+                " count INTEGER NOT NULL,"
+                " expires_at REAL NOT NULL"
+                ") WITHOUT ROWID"
+            )
+
+    def incr(self, key: str, expiry: int, amount: int = 1) -> int:
+        # Wall clock time, as other processes share the expiry times.
+        now = time.time()
+        with self.lock:
+            count, = self.connection.execute(
+                "INSERT INTO ratelimit (key, count, expires_at)"
+                " VALUES (:key, :amount, :expires_at)"
+                " ON CONFLICT (key) DO UPDATE SET"
+                "  count = CASE WHEN expires_at <= :now"
+                "   THEN :amount ELSE count + :amount END,"
+                "  expires_at = CASE WHEN expires_at <= :now"
+                "   THEN :expires_at ELSE expires_at END"
+                " RETURNING count",
+                {
+                    "key": key, "amount": amount,
+                    "expires_at": now + expiry, "now": now,
+                },
+            ).fetchone()
+            self.writes += 1
+            if self.writes % self.SWEEP_EVERY == 0:
+                self.connection.execute(
+                    "DELETE FROM ratelimit WHERE expires_at <= ?", (now,)
+                )
+        return count
+
+    def get(self, key: str) -> int:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT count FROM ratelimit WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        return row[0] if row else 0
+
+    def clear(self) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM ratelimit")
+
+
+class RedisStorage(Storage):
+    """Counters in Redis, or anything that speaks its SET/INCRBY/GET.
+
+    `client` is a redis-py style client, `redis.Redis.from_url(...)`.
+    """
+
+    def __init__(self, client, prefix: str = "ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+
+    def incr(self, key: str, expiry: int, amount: int = 1) -> int:
+        if expiry <= 0:
+            # Already over, and Redis won't take a zero expiry.
+            return amount
+        key = self.prefix + key
+        # Created with its expiry in the same transaction as the increment,
+        # a counter left without one would limit its client forever.
+        with self.client.pipeline(transaction=True) as pipe:
+            pipe.set(key, 0, ex=expiry, nx=True)
+            pipe.incrby(key, amount)
+            _, count = pipe.execute()
+        return int(count)
+
+    def get(self, key: str) -> int:
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(f"{self.prefix}*"):
+            self.client.delete(key)
+
+
+def storage_from_url(url: str) -> Storage:
+    """`memory://`, `sqlite:///path/to/file` or `redis://host:port/db`."""
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return MemoryStorage()
+    if scheme == "sqlite":
+        return SQLiteStorage(url.removeprefix("sqlite:///") or ":memory:")
+    if scheme in ("redis", "rediss", "unix"):
+        # Only needed when limits are kept in Redis.
+        import redis
+        return RedisStorage(redis.Redis.from_url(url))
+    raise ValueError(f"Unknown rate limit storage {url!r}.")
+
+
+class Window(NamedTuple):
+    allowed: bool
+    remaining: int
+    reset_at: float
+
+
+class FixedWindow:
+    """Counts hits per calendar window, one increment per check."""
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+
+    def hit(self, key: str, rate: Rate, amount: int = 1) -> Window:
+        now = time.time()
+        window = int(now // rate.period)
+        count = self.storage.incr(f"{key}:{window}", rate.period, amount)
+        return Window(
+            count <= rate.limit,
+            max(rate.limit - count, 0),
+            (window + 1) * rate.period,
+        )
+
+
+class SlidingWindowCounter:
+    """Weighs the previous window's count by how much of it still overlaps.
+
+    Close to a true sliding window, without keeping every hit: one
+    increment and one read per check.
+    """
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+
+    def hit(self, key: str, rate: Rate, amount: int = 1) -> Window:
+        now = time.time()
+        window = int(now // rate.period)
+        previous = self.storage.get(f"{key}:{window - 1}")
+        # Kept for two periods, it's the previous window for the next one.
+        current = self.storage.incr(f"{key}:{window}", rate.period * 2, amount)
+        weight = 1 - (now - window * rate.period) / rate.period
+        count = math.floor(previous * weight) + current
+        return Window(
+            count <= rate.limit,
+            max(rate.limit - count, 0),
+            (window + 1) * rate.period,
+        )
+
+
+STRATEGIES = {
+    "fixed-window": FixedWindow,
+    "sliding-window": SlidingWindowCounter,
+}
+
+
+def retry_after(reset_at: float) -> str:
+    return str(max(math.ceil(reset_at - time.time()), 0))
+
+
+def remote_address(scope: Scope) -> str:
+    client = scope.get("client")
+    return client[0] if client else "127.0.0.1"
+
+
+class Limiter:
+    """Per-route rates, counted in a storage shared by every app.
+
+    `limit` only marks the endpoint, RateLimitMiddleware does the
+    counting before the request is routed.
+
+        @app.get("/things")
+        @limiter.limit("15/minute")
+        async def read_things(): ...
+    """
+
+    def __init__(
+        self,
+        key_func: Callable[[Scope], str] = remote_address,
+        storage: Optional[Storage] = None,
+        strategy: str = RATELIMIT_STRATEGY,
+    ):
+        self.key_func = key_func
+        self.storage = storage or storage_from_url(RATELIMIT_STORAGE_URL)
+        self.strategy = STRATEGIES[strategy](self.storage)
+        self.enabled = True
+
+    def limit(self, rate: str):
+        rate = parse_rate(rate)
+
+        def decorator(func):
+            limits = getattr(func, "__rate_limits__", ())
+            func.__rate_limits__ = limits + (rate,)
+            return func
+
+        return decorator
+
+    def hit(self, scope: Scope, name: str, rate: Rate) -> Window:
+        return self.strategy.hit(
+            f"{name}/{self.key_func(scope)}/{rate.limit}/{rate.period}",
+            rate,
+        )
+
+
+class Policy(NamedTuple):
+    name: str
+    rates: Tuple[Rate, ...]
+    path_regex: re.Pattern
+
+
+def compile_policies(routes, prefix: str = "") -> Dict[str, dict]:
+    """Finds every limited route, mounted apps included.
+
+    Returns `{method: {"static": {path: policy}, "dynamic": [policy]}}`,
+    so a request with no path parameters is a single dict lookup.
+    """
+    policies = defaultdict(lambda: {"static": {}, "dynamic": []})
+    for route in routes:
+        if isinstance(route, Mount):
+            for method, compiled in compile_policies(
+                route.routes, prefix + route.path
+            ).items():
+                policies[method]["static"].update(compiled["static"])
+                policies[method]["dynamic"].extend(compiled["dynamic"])
+            continue
+        if not isinstance(route, Route):
+            continue
+        rates = getattr(route.endpoint, "__rate_limits__", None)
+        if not rates:
+            continue
+        endpoint = route.endpoint
+        path = prefix + route.path
+        path_regex, _, param_convertors = compile_path(path)
+        policy = Policy(
+            f"{endpoint.__module__}.{endpoint.__qualname__}",
+            rates,
+            path_regex,
+        )
+        for method in route.methods or ():
+            if param_convertors:
+                policies[method]["dynamic"].append(policy)
+            else:
+                policies[method]["static"][path] = policy
+    return dict(policies)
+
+
+class RateLimitMiddleware:
+    """Rejects requests over their route's limits before they're routed.
+
+    Policies are compiled once, when the middleware stack is built, so a
+    429 never gets to a dependency, a threadpool or a database session.
+    """
+
+    def __init__(self, app: ASGIApp, routes, limiter: Limiter):
+        self.app = app
+        self.limiter = limiter
+        self.policies = compile_policies(routes)
+        # Anything but memory is a round trip or a write lock that other
+        # workers may hold, keep it off the event loop.
+        self.blocking = not isinstance(limiter.storage, MemoryStorage)
+
+    def policy(self, scope: Scope) -> Optional[Policy]:
+        policies = self.policies.get(scope["method"])
+        if not policies:
+            return None
+        path = scope["path"]
+        policy = policies["static"].get(path)
+        if policy:
+            return policy
+        for policy in policies["dynamic"]:
+            if policy.path_regex.match(path):
+                return policy
+        return None
+
+    def check(self, scope: Scope, policy: Policy) -> Optional[Response]:
+        for rate in policy.rates:
+            window = self.limiter.hit(scope, policy.name, rate)
+            if not window.allowed:
+                return JSONResponse(
+                    {"error": f"Rate limit exceeded: {rate}"},
+                    status_code=429,
+                    headers={"Retry-After": retry_after(window.reset_at)},
+                )
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self.limiter.enabled:
+            return await self.app(scope, receive, send)
+        policy = self.policy(scope)
+        if policy:
+            if self.blocking:
+                response = await anyio.to_thread.run_sync(
+                    self.check, scope, policy
+                )
+            else:
+                response = self.check(scope, policy)
+            if response:
+                return await response(scope, receive, send)
+        await self.app(scope, receive, send)
+
+
+limiter = Limiter()
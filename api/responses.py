@@ -0,0 +1,314 @@
+import gzip
+import hashlib
+import os
+import stat
+import zlib
+
+from typing import Dict, Optional
+
+import anyio
+from fastapi import Request, Response, status
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Bodies smaller than this aren't worth compressing.
+MIN_COMPRESS_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 256))
+# Compressed on the fly by CompressionMiddleware. Audio already is, and
+# event streams can't wait for a compressor to fill up.
+COMPRESSIBLE = frozenset((
+    "application/json",
+    "application/javascript",
+    "application/x-ndjson",
+    "image/svg+xml",
+    "text/css",
+    "text/csv",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+))
+# Low levels, bodies compressed on every request have to be cheap.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """Parses an Accept-Encoding header into `{coding: q}`."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, *params = part.strip().split(";")
+        q = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = q
+    return accepted
+
+
+def etag_matches(if_none_match: Optional[str], etags) -> bool:
+    """Weak comparison of an If-None-Match header against our ETags."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = {
+        tag.strip().removeprefix("W/")
+        for tag in if_none_match.split(",")
+    }
+    return not candidates.isdisjoint(etags)
+
+
+def preferred_encoding(accept_encoding: str, codings=("br", "gzip")) -> str:
+    """The first of `codings` the client accepts, or `identity`."""
+    accepted = accepted_encodings(accept_encoding)
+    for coding in codings:
+        if coding == "br" and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get("*", 0)) > 0:
+            return coding
+    return "identity"
+
+
+class PrecompressedContent:
+    """A body compressed once up front and served from memory.
+
+    Each encoding gets its own strong ETag, as they're different bytes.
+    """
+
+    def __init__(
+        self,
+        body: bytes,
+        media_type: str,
+        cache_control: str = "public, max-age=300",
+    ):
+        self.media_type = media_type
+        self.cache_control = cache_control
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {"identity": (body, f'"{digest}"')}
+        if len(body) < MIN_COMPRESS_SIZE:
+            return
+        if brotli is not None:
+            self.variants["br"] = (
+                brotli.compress(body, quality=11), f'"{digest}-br"'
+            )
+        self.variants["gzip"] = (
+            gzip.compress(body, compresslevel=9, mtime=0), f'"{digest}-gz"'
+        )
+
+    def negotiate(self, accept_encoding: str) -> str:
+        return preferred_encoding(accept_encoding, tuple(
+            coding for coding in ("br", "gzip") if coding in self.variants
+        ))
+
+    def response(self, request: Request) -> Response:
+        coding = self.negotiate(request.headers.get("accept-encoding", ""))
+        body, etag = self.variants[coding]
+        headers = {
+            "ETag": etag,
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(
+            request.headers.get("if-none-match"),
+            [etag for _, etag in self.variants.values()]
+        ):
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers=headers,
+            )
+        if coding != "identity":
+            headers["Content-Encoding"] = coding
+        return Response(
+            content=body,
+            media_type=self.media_type,
+            headers=headers,
+        )
+
+
+class Compressor:
+    """Incremental gzip or brotli, flushed after each chunk so streamed
+    bodies (exports) still reach the client as they're produced."""
+
+    def __init__(self, coding: str):
+        if coding == "br":
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self.compressor = zlib.compressobj(GZIP_LEVEL, wbits=31)
+        self.coding = coding
+
+    def compress(self, chunk: bytes, last: bool = False) -> bytes:
+        if self.coding == "br":
+            out = self.compressor.process(chunk)
+            return out + (
+                self.compressor.finish() if last else self.compressor.flush()
+            )
+        return self.compressor.compress(chunk) + self.compressor.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+        )
+
+
+class CompressionMiddleware:
+    """Brotli or gzip for responses that are worth it.
+
+    Only `COMPRESSIBLE` types of at least `minimum_size` bytes, never
+    anything already encoded (PrecompressedContent, static siblings) or
+    partial (ranges). ETags are left alone, they name the resource's
+    version, and If-Match has to keep working with them.
+    """
+
+    def __init__(
+        self,
+        app,
+        minimum_size: int = MIN_COMPRESS_SIZE,
+        media_types=COMPRESSIBLE,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.media_types = media_types
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        coding = preferred_encoding(
+            Headers(scope=scope).get("accept-encoding", "")
+        )
+        start = None
+        compressor = None
+
+        async def compressing_send(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                media_type = headers.get("content-type", "").split(";")[0]
+                if (
+                    message["status"] in (204, 304)
+                    or media_type.strip() not in self.media_types
+                    or "content-encoding" in headers
+                    or "content-range" in headers
+                ):
+                    await send(message)
+                    return
+                if "accept-encoding" not in headers.get("vary", "").lower():
+                    MutableHeaders(scope=message).add_vary_header(
+                        "Accept-Encoding"
+                    )
+                if coding == "identity":
+                    await send(message)
+                    return
+                # Held until the first chunk says how big the body is.
+                start = message
+                return
+            if start is None:
+                if compressor is None:
+                    await send(message)
+                    return
+                body = message.get("body", b"")
+                last = not message.get("more_body", False)
+                await send({
+                    **message,
+                    "body": compressor.compress(body, last),
+                })
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            headers = MutableHeaders(scope=start)
+            if not more_body and len(body) < self.minimum_size:
+                await send(start)
+                start = None
+                await send(message)
+                return
+            compressor = Compressor(coding)
+            body = compressor.compress(body, last=not more_body)
+            headers["Content-Encoding"] = coding
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(body))
+            await send(start)
+            start = None
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, compressing_send)
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that sends the `.br` or `.gz` next to a file instead,
+    to clients that accept it, built by `pipenv run utils static`.
+
+    Siblings older than their file are ignored, so an edit without a
+    rebuild is never hidden behind a stale copy.
+    """
+
+    suffixes = {"br": ".br", "gzip": ".gz"}
+
+    async def get_response(self, path: str, scope) -> Response:
+        coding = preferred_encoding(
+            Headers(scope=scope).get("accept-encoding", "")
+        )
+        if coding != "identity":
+            response = await self.compressed_response(path, coding, scope)
+            if response is not None:
+                return response
+        response = await super().get_response(path, scope)
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+    async def compressed_response(
+        self,
+        path: str,
+        coding: str,
+        scope,
+    ) -> Optional[Response]:
+        _, original = await anyio.to_thread.run_sync(self.lookup_path, path)
+        if not original or not stat.S_ISREG(original.st_mode):
+            return None
+        full_path, sibling = await anyio.to_thread.run_sync(
+            self.lookup_path, path + self.suffixes[coding]
+        )
+        if (
+            not sibling or not stat.S_ISREG(sibling.st_mode)
+            or sibling.st_mtime < original.st_mtime
+        ):
+            return None
+        # The content type is guessed from the name without the suffix.
+        response = self.file_response(full_path, sibling, scope)
+        response.headers["Vary"] = "Accept-Encoding"
+        if response.status_code != status.HTTP_304_NOT_MODIFIED:
+            response.headers["Content-Encoding"] = coding
+        return response
+
+
+def compress_static(directory: str) -> int:
+    """Writes `.br` and `.gz` siblings of the files worth compressing."""
+    written = 0
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if (
+            name.endswith((".br", ".gz"))
+            or not os.path.isfile(path)
+            or os.path.getsize(path) < MIN_COMPRESS_SIZE
+        ):
+            continue
+        with open(path, "rb") as f:
+            body = f.read()
+        variants = {".gz": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants[".br"] = brotli.compress(body, quality=11)
+        for suffix, compressed in variants.items():
+            # Not worth a second file when it barely shrinks.
+            if len(compressed) > len(body) * 0.9:
+                continue
+            with open(path + suffix, "wb") as f:
+                f.write(compressed)
+            written += 1
+    return written
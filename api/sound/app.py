@@ -1,80 +1,150 @@
-import json
-from typing import List, Optional, Annotated
+import array
+from typing import List, Literal, Optional, Annotated
 
 from fastapi import (
     FastAPI, Request, Response, HTTPException,
-    Query, Depends, Path, status,
+    Query, Path, status,
 )
-from fastapi.openapi.docs import get_swagger_ui_html
-from fastapi.staticfiles import StaticFiles
 
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
-
-from sqlmodel import (
-    Session, select
-)
+from api.docs import serve_docs
+from api.ratelimit import limiter
 
 from api.sound.models import (
     Song, Songs,
     FX, FXs,
-    SoundData,
+    SoundData, Peaks,
 )
-from api.db import get_session
+from api.pagination import decode_cursor, paginate
+from api.sound.cache import SOUND_CACHE_REVALIDATE, FileCache
+from api.sound.catalog import Catalog
+from api.sound.files import AudioFiles
+from api.sound.library import CatalogManager
 
 app = FastAPI(
     title="Sound API",
     description="An API serving sound files.",
     docs_url=None,
+    openapi_url=None,
 )
 
-limiter = Limiter(key_func=get_remote_address)
-# Limiter requires the request to be in the args for your routes!
+# Limits are counted by RateLimitMiddleware on the main app.
 app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-app.mount("/files", StaticFiles(directory="api/sound/files"), name="files")
+serve_docs(app, title="4Geeks Playground - Sound API")
+files = AudioFiles(
+    directory="api/sound/files",
+    cache=FileCache(),
+    revalidate=SOUND_CACHE_REVALIDATE,
+)
+app.mount("/files", files, name="files")
+
+catalog = CatalogManager(files)
+
+
+@app.on_event("startup")
+async def watch_catalog():
+    await catalog.start()
+
 
-data = {
-    "sound_effects": None,
-    "songs": None,
-}
+@app.on_event("shutdown")
+async def stop_watching_catalog():
+    await catalog.stop()
 
-with (
-    open("api/sound/data/fx.json", "rt") as fx_file,
-    open("api/sound/data/songs.json", "rt") as song_file
+
+def search_catalog(
+    index: Catalog,
+    model: type,
+    category: Optional[str],
+    prefix: Optional[str],
+    q: Optional[str],
+    cursor: Optional[str],
+    limit: Optional[int],
 ):
-    data["sound_effects"] = json.load(fx_file)
-    data["songs"] = json.load(song_file)
+    limit = limit or 100
+    return paginate([
+        model(**sound) for sound in index.search(
+            category=category,
+            prefix=prefix,
+            q=q,
+            after=decode_cursor(cursor),
+            limit=limit + 1,
+        )
+    ], limit)
 
 
-@app.get("/docs", include_in_schema=False)
-async def swagger_ui_html():
-    return get_swagger_ui_html(
-        title="4Geeks Playground - Sound API",
-        openapi_url="/sound/openapi.json",
-        swagger_favicon_url="/favicon.ico",
+@app.get(
+    "/effects",
+    response_model=FXs,
+    summary="Get Sound Effects.",
+    description="""Gets the sound effects, filtered by category or name.
+`prefix` matches the start of the name, `q` any part of it.""",
+)
+async def get_all_fx(
+    request: Request,
+    category: Optional[str] = None,
+    prefix: Optional[str] = None,
+    q: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(default=None, ge=1, le=100),
+):
+    if (category, prefix, q, cursor, limit) == (None,) * 5:
+        return catalog.current.responses["effects"].response(request)
+    sound_effects, next_cursor = search_catalog(
+        catalog.current.effects, FX, category, prefix, q, cursor, limit
     )
+    return FXs(sound_effects=sound_effects, next_cursor=next_cursor)
 
 
 @app.get(
-    "/effects",
-    response_model=FXs
+    "/effects/{id}",
+    response_model=FX,
+    summary="Get Sound Effect.",
 )
-def get_all_fx():
-    return {
-        "sound_effects": data["sound_effects"]
-    }
+async def get_fx(id: int):
+    sound = catalog.current.effects.get(id)
+    if not sound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Sound effect #{id} doesn't exist."
+        )
+    return sound
 
 
 @app.get(
     "/songs",
-    response_model=Songs
+    response_model=Songs,
+    summary="Get Songs.",
+    description="""Gets the songs, filtered by category or name.
+`prefix` matches the start of the name, `q` any part of it.""",
 )
-def get_all_music():
-    return {
-        "songs": data["songs"]
-    }
+async def get_all_music(
+    request: Request,
+    category: Optional[str] = None,
+    prefix: Optional[str] = None,
+    q: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(default=None, ge=1, le=100),
+):
+    if (category, prefix, q, cursor, limit) == (None,) * 5:
+        return catalog.current.responses["songs"].response(request)
+    songs_page, next_cursor = search_catalog(
+        catalog.current.songs, Song, category, prefix, q, cursor, limit
+    )
+    return Songs(songs=songs_page, next_cursor=next_cursor)
+
+
+@app.get(
+    "/songs/{id}",
+    response_model=Song,
+    summary="Get Song.",
+)
+async def get_song(id: int):
+    sound = catalog.current.songs.get(id)
+    if not sound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Song #{id} doesn't exist."
+        )
+    return sound
 
 
 @app.get(
@@ -82,8 +152,32 @@ def get_all_music():
     response_model=SoundData
 )
 @limiter.limit("15/minute")
-def get_all_data(
-    request: Request,
-    session: Session = Depends(get_session)
-) -> None:
-    return data
+async def get_all_data(request: Request) -> None:
+    return catalog.current.responses["all"].response(request)
+
+
+@app.get(
+    "/{kind}/{id}/peaks",
+    response_model=Peaks,
+    summary="Get Sound Waveform.",
+    description="Gets the waveform of a sound, as (min, max) pairs.",
+)
+async def get_peaks(kind: Literal["effects", "songs"], id: int):
+    library = catalog.current
+    sound_metadata = library.sound_metadata(
+        (library.effects if kind == "effects" else library.songs).get(id)
+    )
+    if not sound_metadata or not sound_metadata.peaks:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No waveform for {kind} #{id}."
+        )
+    values = array.array("b", sound_metadata.peaks)
+    return Peaks(
+        id=id,
+        duration=sound_metadata.duration,
+        peaks=[
+            (round(low / 127, 3), round(high / 127, 3))
+            for low, high in zip(values[0::2], values[1::2])
+        ],
+    )
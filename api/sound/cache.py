@@ -0,0 +1,102 @@
+import mmap
+import os
+
+from collections import OrderedDict
+from typing import List, Optional, Tuple, Union
+
+import anyio
+
+from api.metrics import Counter, Gauge
+
+# Files up to this size are read into memory.
+SOUND_CACHE_MAX_FILE = int(os.getenv("SOUND_CACHE_MAX_FILE", 256 * 1024))
+# Files up to this size are mapped instead, and paged in by the OS.
+SOUND_CACHE_MAX_MMAP = int(os.getenv("SOUND_CACHE_MAX_MMAP", 4 * 1024 * 1024))
+# Total bytes held by the cache, read and mapped files alike.
+SOUND_CACHE_SIZE = int(os.getenv("SOUND_CACHE_SIZE", 64 * 1024 * 1024))
+# Seconds between stats of a file that's already been served.
+SOUND_CACHE_REVALIDATE = float(os.getenv("SOUND_CACHE_REVALIDATE", 10))
+
+cache_hits = Counter(
+    "sound_file_cache_hits_total",
+    "Sound file requests served from memory.",
+)
+cache_misses = Counter(
+    "sound_file_cache_misses_total",
+    "Cacheable sound file requests that had to load the file.",
+)
+cache_evictions = Counter(
+    "sound_file_cache_evictions_total",
+    "Sound files dropped from memory to make room.",
+)
+cache_bytes = Gauge(
+    "sound_file_cache_bytes",
+    "Bytes of sound files held in memory.",
+)
+
+Key = Tuple[str, int, float]
+
+
+class CachedFile:
+    """A file's bytes, plus the headers of its full response once known."""
+
+    def __init__(self, data: Union[bytes, mmap.mmap]):
+        self.data = data
+        self.size = len(data)
+        self.headers: Optional[List[Tuple[bytes, bytes]]] = None
+
+
+def load(path: str, size: int, max_file: int) -> Union[bytes, mmap.mmap]:
+    with open(path, "rb") as f:
+        if size <= max_file:
+            return f.read()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class FileCache:
+    """A size-bounded LRU of file contents, keyed by path, size and mtime.
+
+    Evicted maps aren't closed, a response may still be reading from one;
+    they're unmapped once the last reference goes.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = SOUND_CACHE_SIZE,
+        max_file: int = SOUND_CACHE_MAX_FILE,
+        max_mmap: int = SOUND_CACHE_MAX_MMAP,
+        name: str = "files",
+    ):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.max_mmap = max(max_mmap, max_file)
+        self.name = name
+        self.files: OrderedDict[Key, CachedFile] = OrderedDict()
+        self.bytes = 0
+        cache_bytes.watch(lambda: self.bytes, cache=name)
+
+    async def get(self, path: str, size: int, mtime: float) -> Optional[CachedFile]:
+        if size > self.max_mmap or size > self.max_bytes or size == 0:
+            return None
+        key = (path, size, mtime)
+        if key in self.files:
+            self.files.move_to_end(key)
+            cache_hits.inc(cache=self.name)
+            return self.files[key]
+        cache_misses.inc(cache=self.name)
+        try:
+            data = await anyio.to_thread.run_sync(
+                load, path, size, self.max_file
+            )
+        except (OSError, ValueError):
+            return None
+        if len(data) != size or key in self.files:
+            # The file changed under us, or another request loaded it.
+            return self.files.get(key)
+        cached = self.files[key] = CachedFile(data)
+        self.bytes += cached.size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.files.popitem(last=False)
+            self.bytes -= evicted.size
+            cache_evictions.inc(cache=self.name)
+        return cached
@@ -0,0 +1,89 @@
+import bisect
+
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+
+
+def trigrams(text: str) -> Set[str]:
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class Catalog:
+    """Lookups over a list of sounds, indexed once when it's loaded.
+
+    Sounds are dicts with at least `id`, `name` and `category`.
+    """
+
+    def __init__(self, sounds: Iterable[Dict]):
+        self.sounds = sorted(sounds, key=lambda sound: sound["id"])
+        self.by_id: Dict[int, Dict] = {
+            sound["id"]: sound for sound in self.sounds
+        }
+        self.by_category: Dict[str, List[int]] = defaultdict(list)
+        self.by_trigram: Dict[str, Set[int]] = defaultdict(set)
+        for sound in self.sounds:
+            self.by_category[sound["category"].lower()].append(sound["id"])
+            for trigram in trigrams(sound["name"]):
+                self.by_trigram[trigram].add(sound["id"])
+        # Sorted (lowercase name, id) pairs, for prefix searches.
+        self.names = sorted(
+            (sound["name"].lower(), sound["id"]) for sound in self.sounds
+        )
+
+    def get(self, id: int) -> Optional[Dict]:
+        return self.by_id.get(id)
+
+    def with_prefix(self, prefix: str) -> Set[int]:
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.names, (prefix,))
+        ids = set()
+        for name, id in self.names[start:]:
+            if not name.startswith(prefix):
+                break
+            ids.add(id)
+        return ids
+
+    def containing(self, text: str) -> Set[int]:
+        text = text.lower()
+        if len(text) < 3:
+            candidates = self.by_id.keys()
+        else:
+            candidates = set.intersection(*(
+                self.by_trigram.get(trigram, set())
+                for trigram in trigrams(text)
+            ))
+        # Trigrams can match out of order, so check the real thing.
+        return {
+            id for id in candidates
+            if text in self.by_id[id]["name"].lower()
+        }
+
+    def search(
+        self,
+        category: Optional[str] = None,
+        prefix: Optional[str] = None,
+        q: Optional[str] = None,
+        after: int = 0,
+        limit: Optional[int] = None,
+    ) -> List[Dict]:
+        """Sounds matching every given filter, ordered by id."""
+        filters = []
+        if category is not None:
+            filters.append(set(self.by_category.get(category.lower(), ())))
+        if prefix:
+            filters.append(self.with_prefix(prefix))
+        if q:
+            filters.append(self.containing(q))
+        ids = set.intersection(*filters) if filters else None
+        start = bisect.bisect_right(
+            self.sounds, after, key=lambda sound: sound["id"]
+        )
+        matches = []
+        for sound in self.sounds[start:]:
+            if ids is not None and sound["id"] not in ids:
+                continue
+            matches.append(sound)
+            if limit is not None and len(matches) == limit:
+                break
+        return matches
@@ -0,0 +1,365 @@
+import hashlib
+import os
+import secrets
+import stat
+import time
+
+from email.utils import formatdate
+from mimetypes import guess_type
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import anyio
+from fastapi import HTTPException, status
+from starlette.datastructures import Headers, QueryParams
+from starlette.types import Receive, Scope, Send
+
+from api.responses import etag_matches
+from api.sound.cache import CachedFile, FileCache
+from api.sound.variants import Variants
+
+# Clients asking for more pieces than this just get the whole file.
+MAX_RANGES = 16
+# Files can be replaced under the same name while running, so caches only
+# keep them briefly and then revalidate with the ETag.
+CACHE_CONTROL = "public, max-age=60"
+
+CRLF = "\r\n"
+
+Range = Tuple[int, int]
+
+
+class FileInfo(NamedTuple):
+    path: str
+    size: int
+    mtime: float
+    etag: str
+    media_type: str
+
+
+def parse_ranges(header: Optional[str], size: int) -> Optional[List[Range]]:
+    """Parses a `Range` header into sorted, merged, inclusive ranges.
+
+    Returns None when the header should be ignored, and an empty list when
+    none of the ranges can be satisfied.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if not first:
+                # A suffix range, the last N bytes.
+                start, end = max(size - int(last), 0), size - 1
+                if int(last) == 0:
+                    continue
+            else:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return None
+        if start < 0 or (last and first and int(last) < start):
+            return None
+        if start < size:
+            ranges.append((start, end))
+    ranges.sort()
+    merged: List[Range] = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+class AudioFiles:
+    """Serves files from `directory`, with byte ranges and strong ETags.
+
+    ETags are hashes of the file contents, computed once per file
+    version, so they survive redeploys that only touch mtimes.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        variants: Optional[Variants] = None,
+        cache: Optional[FileCache] = None,
+        revalidate: float = 0,
+        chunk_size: int = 64 * 1024,
+    ):
+        self.directory = os.path.realpath(directory)
+        self.variants = variants or Variants(directory, {})
+        self.cache = cache
+        # Seconds a file's stat is trusted before looking at it again.
+        self.revalidate = revalidate
+        self.chunk_size = chunk_size
+        self.etags: Dict[Tuple[str, int, int], str] = {}
+        self.infos: Dict[Tuple[str, str], Tuple[FileInfo, float]] = {}
+
+    def lookup(
+        self,
+        path: str,
+        directory: Optional[str] = None
+    ) -> Tuple[str, os.stat_result]:
+        directory = directory or self.directory
+        full_path = os.path.realpath(
+            os.path.join(directory, *path.split("/"))
+        )
+        if os.path.commonpath([full_path, directory]) != directory:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        try:
+            stat_result = os.stat(full_path)
+        except (FileNotFoundError, NotADirectoryError):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        if not stat.S_ISREG(stat_result.st_mode):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        return full_path, stat_result
+
+    def hash_file(self, path: str) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+        return f'"{digest.hexdigest()}"'
+
+    async def file_info(
+        self,
+        path: str,
+        directory: Optional[str] = None
+    ) -> FileInfo:
+        now = time.monotonic()
+        info, checked_until = self.infos.get((directory, path), (None, 0))
+        if info and now < checked_until:
+            return info
+        full_path, stat_result = await anyio.to_thread.run_sync(
+            self.lookup, path, directory
+        )
+        key = (full_path, stat_result.st_mtime_ns, stat_result.st_size)
+        if key not in self.etags:
+            self.etags[key] = await anyio.to_thread.run_sync(
+                self.hash_file, full_path
+            )
+        info = FileInfo(
+            path=full_path,
+            size=stat_result.st_size,
+            mtime=stat_result.st_mtime,
+            etag=self.etags[key],
+            media_type=guess_type(full_path)[0] or "application/octet-stream",
+        )
+        if self.revalidate:
+            self.infos[(directory, path)] = (info, now + self.revalidate)
+        return info
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        assert scope["type"] == "http"
+        if scope["method"] not in ("GET", "HEAD"):
+            raise HTTPException(status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+        path, root_path = scope["path"], scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        name = os.path.normpath(path.lstrip("/"))
+        info = await self.file_info(name)
+        if name not in self.variants:
+            await self.respond(info, scope, send)
+            return
+        try:
+            variant = self.variants.choose(
+                name,
+                QueryParams(scope["query_string"]).get("format"),
+                Headers(scope=scope).get("accept", ""),
+            )
+        except LookupError as e:
+            raise HTTPException(
+                status_code=status.HTTP_406_NOT_ACCEPTABLE,
+                detail=f"""No "{e}" variant of this file.""",
+            )
+        if variant:
+            info = (await self.file_info(
+                variant.path, self.variants.directory
+            ))._replace(media_type=variant.media_type)
+        await self.respond(info, scope, send, {"vary": "Accept"})
+
+    async def respond(
+        self,
+        info: FileInfo,
+        scope: Scope,
+        send: Send,
+        extra_headers: Optional[Dict[str, str]] = None,
+    ):
+        request_headers = Headers(scope=scope)
+        plain = not (
+            request_headers.get("range")
+            or request_headers.get("if-none-match")
+        )
+        cached = None
+        if self.cache and scope["method"] == "GET":
+            cached = await self.cache.get(info.path, info.size, info.mtime)
+        if cached and cached.headers and plain:
+            # Straight from memory, nothing left to work out.
+            await send({
+                "type": "http.response.start",
+                "status": status.HTTP_200_OK,
+                "headers": cached.headers,
+            })
+            await send({"type": "http.response.body", "body": cached.data[:]})
+            return
+
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": info.etag,
+            "last-modified": formatdate(info.mtime, usegmt=True),
+            "cache-control": CACHE_CONTROL,
+            **(extra_headers or {}),
+        }
+        if etag_matches(request_headers.get("if-none-match"), [info.etag]):
+            await self.start(send, status.HTTP_304_NOT_MODIFIED, headers)
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        ranges = None
+        if_range = request_headers.get("if-range")
+        if if_range is None or if_range.strip() == info.etag:
+            ranges = parse_ranges(request_headers.get("range"), info.size)
+        head = scope["method"] == "HEAD"
+
+        if ranges == []:
+            headers["content-range"] = f"bytes */{info.size}"
+            headers["content-length"] = "0"
+            await self.start(
+                send, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if ranges is None:
+            headers["content-type"] = info.media_type
+            headers["content-length"] = str(info.size)
+            await self.start(send, status.HTTP_200_OK, headers)
+            if cached and plain:
+                cached.headers = self.raw_headers(headers)
+            parts = [(b"", 0, info.size - 1)]
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            headers["content-type"] = info.media_type
+            headers["content-range"] = f"bytes {start}-{end}/{info.size}"
+            headers["content-length"] = str(end - start + 1)
+            await self.start(send, status.HTTP_206_PARTIAL_CONTENT, headers)
+            parts = [(b"", start, end)]
+        else:
+            boundary = secrets.token_hex(16)
+            parts = [
+                (
+                    (
+                        f"{CRLF if i else ''}--{boundary}\r\n"
+                        f"content-type: {info.media_type}\r\n"
+                        f"content-range: bytes {start}-{end}/{info.size}"
+                        "\r\n\r\n"
+                    ).encode(),
+                    start, end,
+                )
+                for i, (start, end) in enumerate(ranges)
+            ]
+            trailer = f"\r\n--{boundary}--\r\n".encode()
+            headers["content-type"] = (
+                f"multipart/byteranges; boundary={boundary}"
+            )
+            headers["content-length"] = str(
+                sum(len(p) + end - start + 1 for p, start, end in parts)
+                + len(trailer)
+            )
+            await self.start(send, status.HTTP_206_PARTIAL_CONTENT, headers)
+            parts.append((trailer, 0, -1))
+
+        if head:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if cached:
+            await self.send_cached_parts(cached, parts, send)
+            return
+        await self.send_parts(info, parts, scope, send)
+
+    def raw_headers(self, headers: dict) -> List[Tuple[bytes, bytes]]:
+        return [
+            (key.encode(), value.encode())
+            for key, value in headers.items()
+        ]
+
+    async def start(self, send: Send, status_code: int, headers: dict):
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": self.raw_headers(headers),
+        })
+
+    async def send_cached_parts(
+        self,
+        cached: CachedFile,
+        parts: List[Tuple[bytes, int, int]],
+        send: Send,
+    ):
+        """Sends the parts from memory, in one message."""
+        await send({
+            "type": "http.response.body",
+            "body": b"".join(
+                preamble + cached.data[start:end + 1]
+                for preamble, start, end in parts
+            ),
+        })
+
+    async def send_parts(
+        self,
+        info: FileInfo,
+        parts: List[Tuple[bytes, int, int]],
+        scope: Scope,
+        send: Send,
+    ):
+        """Sends each part's preamble, then its bytes from the file."""
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        # Parts are (preamble, start, end); empty ranges have end < start.
+        messages = []
+        for preamble, start, end in parts:
+            if preamble:
+                messages.append(("body", preamble, 0, 0))
+            if end >= start:
+                messages.append(("file", b"", start, end - start + 1))
+        if not messages:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        async with await anyio.open_file(info.path, "rb") as file:
+            for index, (kind, body, start, count) in enumerate(messages):
+                more_body = index < len(messages) - 1
+                if kind == "body":
+                    await send({
+                        "type": "http.response.body",
+                        "body": body,
+                        "more_body": more_body,
+                    })
+                elif zerocopy:
+                    # The server hands the range to sendfile(2) itself.
+                    await send({
+                        "type": "http.response.zerocopysend",
+                        "file": file.wrapped,
+                        "offset": start,
+                        "count": count,
+                        "more_body": more_body,
+                    })
+                else:
+                    await file.seek(start)
+                    while count > 0:
+                        chunk = await file.read(min(self.chunk_size, count))
+                        if not chunk:
+                            # The file shrank under us, end the body here.
+                            count = 0
+                        count -= len(chunk)
+                        await send({
+                            "type": "http.response.body",
+                            "body": chunk,
+                            "more_body": more_body or count > 0,
+                        })
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import os
+
+from typing import Dict, Optional, Tuple
+
+import anyio
+
+from api.responses import PrecompressedContent
+from api.sound.catalog import Catalog
+from api.sound.files import AudioFiles
+from api.sound.metadata import SIDECAR, SoundMetadata, read_sidecar
+from api.sound.models import FXs, Songs, SoundData
+from api.sound.variants import MANIFEST, VARIANTS_DIR, Variants
+
+DATA_DIR = "api/sound/data"
+FILES_DIR = "api/sound/files"
+# Seconds between checks for catalog changes, 0 turns reloading off.
+SOUND_CATALOG_POLL = float(os.getenv("SOUND_CATALOG_POLL", 2))
+
+logger = logging.getLogger(__name__)
+
+
+class Library:
+    """The sound catalog and everything derived from it, built in one go.
+
+    A library is never changed once built. Reloads build a new one, so a
+    request holding on to the old one keeps a consistent view.
+    """
+
+    def __init__(
+        self,
+        data_dir: str = DATA_DIR,
+        sidecar: str = SIDECAR,
+        variants_dir: str = VARIANTS_DIR,
+    ):
+        with (
+            open(os.path.join(data_dir, "fx.json"), "rt") as fx_file,
+            open(os.path.join(data_dir, "songs.json"), "rt") as song_file
+        ):
+            self.data = {
+                "sound_effects": json.load(fx_file),
+                "songs": json.load(song_file),
+            }
+
+        # Built by `utils.py metadata`, see api/sound/metadata.py.
+        self.metadata = read_sidecar(sidecar)
+        for sound in self.data["sound_effects"] + self.data["songs"]:
+            sound_metadata = self.sound_metadata(sound)
+            if sound_metadata:
+                sound.update(
+                    duration=sound_metadata.duration,
+                    sample_rate=sound_metadata.sample_rate,
+                    channels=sound_metadata.channels,
+                    bitrate=sound_metadata.bitrate,
+                )
+
+        self.effects = Catalog(self.data["sound_effects"])
+        self.songs = Catalog(self.data["songs"])
+        self.variants = Variants.load(variants_dir)
+
+        # Validated and encoded once per reload, not once per request.
+        self.responses = {
+            "effects": PrecompressedContent(
+                FXs(**self.data).model_dump_json(
+                    exclude={"next_cursor"}
+                ).encode(),
+                media_type="application/json",
+            ),
+            "songs": PrecompressedContent(
+                Songs(**self.data).model_dump_json(
+                    exclude={"next_cursor"}
+                ).encode(),
+                media_type="application/json",
+            ),
+            "all": PrecompressedContent(
+                SoundData(**self.data).model_dump_json().encode(),
+                media_type="application/json",
+            ),
+        }
+
+    def sound_metadata(self, sound: Optional[Dict]) -> Optional[SoundMetadata]:
+        if not sound:
+            return None
+        return self.metadata.get(sound["url"].removeprefix("/sound/files/"))
+
+
+def scan(paths: Tuple[str, ...], directories: Tuple[str, ...]) -> tuple:
+    """A fingerprint of the files the catalog is built from."""
+    entries = []
+    for path in paths:
+        try:
+            stat_result = os.stat(path)
+            entries.append(
+                (path, stat_result.st_mtime_ns, stat_result.st_size)
+            )
+        except FileNotFoundError:
+            entries.append((path, None, None))
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat_result = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append(
+                    (path, stat_result.st_mtime_ns, stat_result.st_size)
+                )
+    return tuple(sorted(entries, key=lambda entry: entry[0]))
+
+
+class CatalogManager:
+    """Keeps `current` up to date with the catalog files on disk.
+
+    Changes are picked up by polling, rebuilt in a worker thread and
+    swapped in with a single assignment, so readers never wait on a lock.
+    """
+
+    def __init__(
+        self,
+        files: AudioFiles,
+        data_dir: str = DATA_DIR,
+        files_dir: str = FILES_DIR,
+        sidecar: str = SIDECAR,
+        variants_dir: str = VARIANTS_DIR,
+        poll: float = SOUND_CATALOG_POLL,
+    ):
+        self.files = files
+        self.paths = (data_dir, sidecar, variants_dir)
+        self.poll = poll
+        self.watched = (
+            (
+                os.path.join(data_dir, "fx.json"),
+                os.path.join(data_dir, "songs.json"),
+                sidecar,
+                os.path.join(variants_dir, MANIFEST),
+            ),
+            (files_dir,),
+        )
+        self.task: Optional[asyncio.Task] = None
+        self.fingerprint = scan(*self.watched)
+        self.swap(Library(*self.paths))
+
+    def swap(self, library: Library):
+        self.current = library
+        self.files.variants = library.variants
+        # New or replaced files shouldn't wait out the revalidation delay.
+        self.files.infos = {}
+
+    def reload(self) -> bool:
+        """Rebuilds the library if its files changed, returns if it did."""
+        fingerprint = scan(*self.watched)
+        if fingerprint == self.fingerprint:
+            return False
+        # A half-written file raises here, and gets retried next poll.
+        library = Library(*self.paths)
+        self.fingerprint = fingerprint
+        self.swap(library)
+        return True
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.poll)
+            try:
+                if await anyio.to_thread.run_sync(self.reload):
+                    logger.info("Reloaded the sound catalog.")
+            except Exception:
+                logger.exception("Couldn't reload the sound catalog.")
+
+    async def start(self):
+        if self.poll > 0 and not self.task:
+            self.task = asyncio.create_task(self.watch())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
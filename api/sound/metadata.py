@@ -0,0 +1,335 @@
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Tuple
+
+SIDECAR = "api/sound/data/metadata.bin"
+MAGIC = b"SNDM\x01"
+# Points in each waveform, as (min, max) pairs.
+PEAK_POINTS = 512
+# Rate MP3s are decoded at for their peaks, plenty for a waveform.
+PEAK_DECODE_RATE = 8000
+
+ENTRY = struct.Struct("<fIBIH")
+
+
+class SoundMetadata(NamedTuple):
+    duration: float
+    sample_rate: int
+    channels: int
+    bitrate: int
+    # Interleaved (min, max) pairs, scaled to -127..127.
+    peaks: bytes = b""
+
+
+class WavFormat(NamedTuple):
+    encoding: int
+    channels: int
+    sample_rate: int
+    byte_rate: int
+    block_align: int
+    bits: int
+    data_offset: int
+    data_size: int
+
+
+# Bitrates (kbps) by bitrate index, for Layer III.
+MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by MPEG version bits.
+MP3_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG 1
+    2: (22050, 24000, 16000),  # MPEG 2
+    0: (11025, 12000, 8000),   # MPEG 2.5
+}
+
+
+def parse_wav(f: BinaryIO) -> Optional[WavFormat]:
+    """Reads the `fmt ` and `data` chunks of a RIFF WAVE file."""
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:] != b"WAVE":
+        return None
+    fmt = None
+    while chunk := f.read(8):
+        if len(chunk) < 8:
+            break
+        chunk_id, size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+        if chunk_id == b"fmt ":
+            body = f.read(size)
+            fmt = struct.unpack("<HHIIHH", body[:16])
+            if fmt[0] == 0xFFFE and len(body) >= 26:
+                # WAVE_FORMAT_EXTENSIBLE keeps the real one in the subformat.
+                fmt = (struct.unpack("<H", body[24:26])[0],) + fmt[1:]
+        elif chunk_id == b"data" and fmt:
+            return WavFormat(*fmt, f.tell(), size)
+        else:
+            f.seek(size, os.SEEK_CUR)
+        if size % 2:
+            f.seek(1, os.SEEK_CUR)
+    return None
+
+
+def mp3_frame(header: bytes) -> Optional[Tuple[int, int, int, int, int]]:
+    """(frame length, samples, sample rate, channels, bitrate) of a frame."""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 3
+    layer = (header[1] >> 1) & 3
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 3
+    if version == 1 or layer != 1 or rate_index == 3 \
+            or bitrate_index in (0, 15):
+        return None
+    bitrate = MP3_BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 1
+    channels = 1 if header[3] >> 6 == 3 else 2
+    samples = 1152 if version == 3 else 576
+    length = samples // 8 * bitrate // sample_rate + padding
+    return length, samples, sample_rate, channels, bitrate
+
+
+def parse_mp3(data: bytes) -> Optional[SoundMetadata]:
+    """Duration and format of an MPEG Layer III stream.
+
+    Uses the Xing/Info frame count when there is one, and otherwise walks
+    every frame header, which also gets VBR files right.
+    """
+    offset = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = 0
+        for byte in data[6:10]:
+            size = size << 7 | byte & 0x7F
+        offset = 10 + size + (10 if data[5] & 0x10 else 0)
+    # Resync on the first frame whose successor is also a frame.
+    while offset < len(data) - 4:
+        frame = mp3_frame(data[offset:offset + 4])
+        if frame and mp3_frame(data[offset + frame[0]:offset + frame[0] + 4]):
+            break
+        offset += 1
+    else:
+        return None
+
+    length, samples, sample_rate, channels, _ = frame
+    side_info = (32 if channels == 2 else 17) if samples == 1152 \
+        else (17 if channels == 2 else 9)
+    xing = offset + 4 + side_info
+    if data[xing:xing + 4] in (b"Xing", b"Info") and \
+            struct.unpack(">I", data[xing + 4:xing + 8])[0] & 1:
+        frames = struct.unpack(">I", data[xing + 8:xing + 12])[0]
+        audio_bytes = len(data) - offset - length
+    else:
+        frames, audio_bytes, position = 0, 0, offset
+        while frame := mp3_frame(data[position:position + 4]):
+            frames += 1
+            audio_bytes += frame[0]
+            position += frame[0]
+    if not frames:
+        return None
+    duration = frames * samples / sample_rate
+    return SoundMetadata(
+        duration=duration,
+        sample_rate=sample_rate,
+        channels=channels,
+        bitrate=round(audio_bytes * 8 / duration),
+    )
+
+
+def waveform(chunks, total_frames: int, points: int = PEAK_POINTS) -> bytes:
+    """Folds chunks of mono-mixed samples in -1..1 into (min, max) peaks.
+
+    Chunks can be any size; only one is held at a time.
+    """
+    import numpy as np
+
+    total_frames = max(total_frames, 1)
+    lows = np.full(points, np.inf)
+    highs = np.full(points, -np.inf)
+    position = 0
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        index = np.minimum(
+            (position + np.arange(len(chunk))) * points // total_frames,
+            points - 1
+        )
+        # Indexes only go up, so each point is one run within the chunk.
+        starts = np.flatnonzero(np.diff(index, prepend=-1))
+        runs = index[starts]
+        lows[runs] = np.minimum(
+            lows[runs], np.minimum.reduceat(chunk, starts)
+        )
+        highs[runs] = np.maximum(
+            highs[runs], np.maximum.reduceat(chunk, starts)
+        )
+        position += len(chunk)
+    filled = np.isfinite(lows)
+    lows[~filled] = 0
+    highs[~filled] = 0
+    peaks = np.empty(points * 2, dtype=np.int8)
+    peaks[0::2] = np.clip(np.round(lows * 127), -127, 127)
+    peaks[1::2] = np.clip(np.round(highs * 127), -127, 127)
+    return peaks.tobytes()
+
+
+def pcm_chunks(f: BinaryIO, wav: WavFormat, chunk_frames: int = 65536):
+    """Yields a WAV's samples in -1..1, mixed down to mono, chunk by chunk."""
+    import numpy as np
+
+    width = wav.block_align // wav.channels
+    remaining = wav.data_size
+    f.seek(wav.data_offset)
+    while remaining > 0:
+        raw = f.read(min(chunk_frames * wav.block_align, remaining))
+        raw = raw[:len(raw) - len(raw) % wav.block_align]
+        if not raw:
+            break
+        remaining -= len(raw)
+        if wav.encoding == 3:
+            samples = np.frombuffer(raw, dtype=f"<f{width}").astype(float)
+        elif width == 1:
+            samples = (np.frombuffer(raw, dtype=np.uint8) - 128.0) / 128
+        elif width == 3:
+            # 24-bit samples go in the top three bytes of 32-bit ints.
+            padded = np.zeros((len(raw) // 3, 4), dtype=np.uint8)
+            padded[:, 1:] = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+            samples = padded.view("<i4").ravel() / 2 ** 31
+        else:
+            samples = np.frombuffer(raw, dtype=f"<i{width}") \
+                / 2 ** (8 * width - 1)
+        yield samples.reshape(-1, wav.channels).mean(axis=1)
+
+
+def decoded_chunks(path: str, chunk_frames: int = 65536):
+    """Decodes any audio to mono 16-bit samples with ffmpeg, if installed."""
+    import numpy as np
+
+    process = subprocess.Popen(
+        [
+            "ffmpeg", "-nostdin", "-loglevel", "error", "-i", path,
+            "-f", "s16le", "-ac", "1", "-ar", str(PEAK_DECODE_RATE), "-",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        while raw := process.stdout.read(chunk_frames * 2):
+            raw = raw[:len(raw) - len(raw) % 2]
+            yield np.frombuffer(raw, dtype="<i2") / 32768
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    # Otherwise a file ffmpeg can't read gets a flat waveform.
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, "ffmpeg")
+
+
+def index_file(path: str, points: int = PEAK_POINTS) -> Optional[SoundMetadata]:
+    with open(path, "rb") as f:
+        wav = parse_wav(f)
+        if wav:
+            if wav.encoding not in (1, 3) or not wav.byte_rate:
+                return None
+            frames = wav.data_size // wav.block_align
+            return SoundMetadata(
+                duration=frames / wav.sample_rate,
+                sample_rate=wav.sample_rate,
+                channels=wav.channels,
+                bitrate=wav.byte_rate * 8,
+                peaks=waveform(pcm_chunks(f, wav), frames, points),
+            )
+        f.seek(0)
+        metadata = parse_mp3(f.read())
+    if not metadata:
+        return None
+    if shutil.which("ffmpeg"):
+        metadata = metadata._replace(peaks=waveform(
+            decoded_chunks(path),
+            round(metadata.duration * PEAK_DECODE_RATE),
+            points,
+        ))
+    return metadata
+
+
+def write_sidecar(path: str, entries: Dict[str, SoundMetadata]):
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=os.path.dirname(path) or ".", delete=False
+    ) as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(entries)))
+        for name, metadata in sorted(entries.items()):
+            encoded = name.encode()
+            f.write(struct.pack("<H", len(encoded)))
+            f.write(encoded)
+            f.write(ENTRY.pack(
+                metadata.duration, metadata.sample_rate, metadata.channels,
+                metadata.bitrate, len(metadata.peaks) // 2,
+            ))
+            f.write(metadata.peaks)
+    # Temporary files are private, the app needs to read this one.
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+
+
+def read_sidecar(path: str = SIDECAR) -> Dict[str, SoundMetadata]:
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+    if not data.startswith(MAGIC):
+        return {}
+    offset = len(MAGIC)
+    count, = struct.unpack_from("<I", data, offset)
+    offset += 4
+    entries = {}
+    for _ in range(count):
+        length, = struct.unpack_from("<H", data, offset)
+        name = data[offset + 2:offset + 2 + length].decode()
+        offset += 2 + length
+        duration, sample_rate, channels, bitrate, points = \
+            ENTRY.unpack_from(data, offset)
+        offset += ENTRY.size
+        entries[name] = SoundMetadata(
+            round(duration, 3), sample_rate, channels, bitrate,
+            data[offset:offset + points * 2],
+        )
+        offset += points * 2
+    return entries
+
+
+def build_metadata(
+    urls: List[str],
+    files_dir: str = "api/sound/files",
+    sidecar: str = SIDECAR,
+) -> Dict[str, SoundMetadata]:
+    """Indexes the sounds at `urls` into `sidecar`.
+
+    Raises `RuntimeError`, leaving the sidecar as it was, when an MP3
+    gets no waveform because ffmpeg isn't installed.
+    """
+    entries, missing = {}, []
+    for url in urls:
+        name = url.removeprefix("/sound/files/")
+        path = os.path.join(files_dir, name)
+        if not os.path.isfile(path):
+            print(f"Skipping {name!r}, it doesn't exist.")
+            continue
+        metadata = index_file(path)
+        if not metadata:
+            print(f"Skipping {name!r}, it isn't a WAV or MP3 we can read.")
+            continue
+        if not metadata.peaks:
+            missing.append(name)
+        entries[name] = metadata
+    if missing:
+        raise RuntimeError(
+            f"No waveform for {len(missing)} sounds ({', '.join(missing)}),"
+            " MP3s are decoded with ffmpeg. Is it installed?"
+        )
+    write_sidecar(sidecar, entries)
+    return entries
@@ -1,4 +1,4 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 from sqlmodel import (
     SQLModel, Field, Relationship,
@@ -10,6 +10,10 @@ class Sound(BaseModel):
     id: int
     name: str
     url: str
+    duration: Optional[float] = None
+    sample_rate: Optional[int] = None
+    channels: Optional[int] = None
+    bitrate: Optional[int] = None
 
 
 class FX(Sound):
@@ -22,12 +26,21 @@ class Song(Sound):
 
 class FXs(BaseModel):
     sound_effects: List[FX]
+    next_cursor: Optional[str] = None
 
 
 class Songs(BaseModel):
     songs: List[Song]
+    next_cursor: Optional[str] = None
 
 
 class SoundData(BaseModel):
     sound_effects: List[FX]
     songs: List[Song]
+
+
+class Peaks(BaseModel):
+    id: int
+    duration: float
+    # (min, max) of each slice of the sound, from -1 to 1.
+    peaks: List[Tuple[float, float]]
@@ -1,36 +1,26 @@
 import pytest
+import array
+import asyncio
 import json
 import os
+import wave
 
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
-from sqlmodel import (
-    Session, SQLModel, create_engine
-)
-from sqlalchemy.pool import StaticPool
-
-from api.db import get_session
 from api.sound.app import app
-
-
-@pytest.fixture(name="session")
-def session_fixture():
-    engine = create_engine(
-        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
-    )
-    SQLModel.metadata.create_all(engine)
-    with Session(engine) as session:
-        yield session
+from api.sound.cache import FileCache, cache_evictions, cache_hits
+from api.sound.files import AudioFiles
+from api.sound.library import CatalogManager
+from api.sound.metadata import (
+    build_metadata, parse_mp3, read_sidecar,
+)
+from api.sound.variants import Variants, build_variants
 
 
 @pytest.fixture(name="client")
-def client_fixture(session: Session):
-    def get_session_override():
-        return session
-
-    app.dependency_overrides[get_session] = get_session_override
-    client = TestClient(app)
-    yield client
-    app.dependency_overrides.clear()
+def client_fixture():
+    # No sound route uses the database, see api/test_db.py.
+    return TestClient(app)
 
 
 def test_files_exist(client: TestClient):
@@ -51,3 +41,391 @@ def test_files_exist(client: TestClient):
 
     for song in data["songs"]:
         assert os.path.isfile(f"""api/{song["url"]}""")
+
+
+FILE = "/files/mario/fx_pause.wav"
+
+
+def test_file_range(client: TestClient):
+    with open("api/sound/files/mario/fx_pause.wav", "rb") as f:
+        content = f.read()
+
+    resp = client.get(FILE)
+
+    assert resp.status_code == 200
+    assert resp.content == content
+    assert resp.headers["accept-ranges"] == "bytes"
+    assert resp.headers["content-type"] in ("audio/x-wav", "audio/wav")
+    assert resp.headers["cache-control"] == "public, max-age=60"
+
+    resp = client.get(FILE, headers={"Range": "bytes=100-199"})
+
+    assert resp.status_code == 206
+    assert resp.content == content[100:200]
+    assert resp.headers["content-range"] == f"bytes 100-199/{len(content)}"
+
+    resp = client.get(FILE, headers={"Range": "bytes=-10"})
+
+    assert resp.status_code == 206
+    assert resp.content == content[-10:]
+
+    resp = client.get(FILE, headers={"Range": f"bytes={len(content)}-"})
+
+    assert resp.status_code == 416
+    assert resp.headers["content-range"] == f"bytes */{len(content)}"
+
+
+def test_file_multirange(client: TestClient):
+    with open("api/sound/files/mario/fx_pause.wav", "rb") as f:
+        content = f.read()
+
+    resp = client.get(FILE, headers={"Range": "bytes=0-9, 50-59, 5-14"})
+    boundary = resp.headers["content-type"].split("boundary=")[1]
+    parts = resp.content.split(f"--{boundary}".encode())
+
+    assert resp.status_code == 206
+    assert int(resp.headers["content-length"]) == len(resp.content)
+    # Overlapping ranges are merged.
+    assert len(parts) == 4
+    assert parts[1].endswith(b"\r\n\r\n" + content[0:15] + b"\r\n")
+    assert b"content-range: bytes 50-59/" in parts[2]
+    assert parts[3] == b"--\r\n"
+
+
+def test_file_conditional(client: TestClient):
+    etag = client.get(FILE).headers["etag"]
+
+    resp = client.get(FILE, headers={"If-None-Match": etag})
+
+    assert resp.status_code == 304
+    assert resp.content == b""
+
+    resp = client.get(
+        FILE, headers={"Range": "bytes=0-9", "If-Range": '"grizelle"'}
+    )
+
+    assert resp.status_code == 200
+
+    resp = client.get("/files/../app.py")
+
+    assert resp.status_code == 404
+
+
+@pytest.fixture(name="variants_client")
+def variants_client_fixture(tmp_path):
+    files_dir, variants_dir = tmp_path / "files", tmp_path / "variants"
+    files_dir.mkdir()
+    with wave.open(str(files_dir / "beep.wav"), "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(44100)
+        f.writeframes(array.array("h", range(-2000, 2000)).tobytes() * 10)
+
+    manifest = build_variants(
+        ["/sound/files/beep.wav", "/sound/files/missing.wav"],
+        files_dir=str(files_dir),
+        variants_dir=str(variants_dir),
+    )
+    subapp = FastAPI()
+    subapp.mount("/files", AudioFiles(
+        directory=str(files_dir),
+        variants=Variants.load(str(variants_dir)),
+    ))
+    yield manifest, TestClient(subapp)
+
+
+def test_build_variants(variants_client):
+    manifest, _ = variants_client
+    lofi = next(
+        v for v in manifest["beep.wav"]["variants"] if v["format"] == "lofi"
+    )
+
+    assert list(manifest) == ["beep.wav"]
+    assert lofi["media_type"] == "audio/wav"
+    # Half the channels and half the rate.
+    assert lofi["size"] < 44 + 40000 * 2 // 4 + 64
+
+
+def test_variant_negotiation(variants_client):
+    _, client = variants_client
+
+    resp = client.get("/files/beep.wav")
+
+    assert resp.status_code == 200
+    assert resp.headers["vary"] == "Accept"
+    assert len(resp.content) > 80000
+
+    # Lossy variants of the original's own type have to be asked for.
+    resp = client.get("/files/beep.wav", headers={"Accept": "audio/wav"})
+
+    assert len(resp.content) > 80000
+
+    resp = client.get("/files/beep.wav?format=lofi")
+
+    assert resp.headers["content-type"] == "audio/wav"
+    assert len(resp.content) < 40000
+
+    resp = client.get(
+        "/files/beep.wav?format=lofi", headers={"Range": "bytes=0-3"}
+    )
+
+    assert resp.status_code == 206
+    assert resp.content == b"RIFF"
+
+    resp = client.get(
+        "/files/beep.wav?format=original", headers={"Accept": "audio/wav"}
+    )
+
+    assert len(resp.content) > 80000
+
+    resp = client.get("/files/beep.wav?format=flac")
+
+    assert resp.status_code == 406
+
+
+def test_file_cache(tmp_path):
+    for name, size in (("small.wav", 100), ("mid.wav", 1000), ("big.wav", 5000)):
+        (tmp_path / name).write_bytes(
+            bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+        )
+    cache = FileCache(max_bytes=1500, max_file=200, max_mmap=2000, name="test")
+    subapp = FastAPI()
+    subapp.mount("/files", AudioFiles(
+        directory=str(tmp_path), cache=cache, revalidate=60
+    ))
+    client = TestClient(subapp)
+
+    for _ in range(3):
+        resp = client.get("/files/small.wav")
+        assert resp.status_code == 200
+        assert resp.content == (tmp_path / "small.wav").read_bytes()
+
+    resp = client.get("/files/mid.wav", headers={"Range": "bytes=0-9,-5"})
+
+    assert resp.status_code == 206
+    assert int(resp.headers["content-length"]) == len(resp.content)
+    assert not isinstance(cache.files[next(reversed(cache.files))].data, bytes)
+
+    resp = client.get("/files/big.wav")
+
+    assert len(resp.content) == 5000
+    assert cache_hits.values[(("cache", "test"),)] == 2
+    assert cache.bytes == 1100
+
+    # Touching small.wav leaves mid.wav as the least recently used.
+    client.get("/files/small.wav")
+    (tmp_path / "other.wav").write_bytes(b"y" * 1000)
+    client.get("/files/other.wav")
+
+    assert cache_evictions.values[(("cache", "test"),)] == 1
+    assert cache.bytes == 1100
+
+
+def test_catalog(client: TestClient):
+    with open("api/sound/data/fx.json", "rt") as fx_file:
+        sound_effects = json.load(fx_file)
+
+    resp = client.get("/effects", headers={"Accept-Encoding": "gzip"})
+
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/json"
+    assert resp.headers["content-encoding"] == "gzip"
+    assert [
+        {key: fx[key] for key in sound_effects[0]}
+        for fx in resp.json()["sound_effects"]
+    ] == sound_effects
+
+    resp = client.get("/all", headers={"If-None-Match": resp.headers["etag"]})
+
+    assert resp.status_code == 200
+
+    resp = client.get("/songs")
+    etag = resp.headers["etag"]
+
+    assert len(resp.json()["songs"]) > 0
+
+    resp = client.get("/songs", headers={"If-None-Match": etag})
+
+    assert resp.status_code == 304
+
+
+def test_catalog_search(client: TestClient):
+    resp = client.get("/songs?prefix=mario&limit=3")
+    data = resp.json()
+
+    assert resp.status_code == 200
+    assert len(data["songs"]) == 3
+    assert all(song["name"].startswith("Mario") for song in data["songs"])
+
+    resp = client.get(
+        f"/songs?prefix=mario&limit=3&cursor={data['next_cursor']}"
+    )
+
+    assert resp.json()["songs"][0]["id"] > data["songs"][-1]["id"]
+
+    resp = client.get("/songs?q=UNDER")
+    names = [song["name"] for song in resp.json()["songs"]]
+
+    assert "Mario Underworld" in names
+    assert "Mario Underwater" in names
+    assert resp.json()["next_cursor"] is None
+
+    resp = client.get("/effects?category=game&q=clear")
+
+    assert [fx["name"] for fx in resp.json()["sound_effects"]] == [
+        "Stage Clear", "World Clear",
+    ]
+
+    resp = client.get("/effects?category=grizelle")
+
+    assert resp.json()["sound_effects"] == []
+
+
+def test_catalog_by_id(client: TestClient):
+    resp = client.get("/effects/4")
+
+    assert resp.status_code == 200
+    assert resp.json()["name"] == "Pause"
+
+    resp = client.get("/songs/1")
+
+    assert resp.json()["name"] == "Mario Castle"
+
+    resp = client.get("/songs/1000")
+
+    assert resp.status_code == 404
+
+
+def test_sound_metadata(tmp_path):
+    with wave.open(str(tmp_path / "beep.wav"), "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(8000)
+        # One second of silence, then one at full scale.
+        f.writeframes(b"\x00\x00" * 16000 + b"\xff\x7f" * 16000)
+
+    entries = build_metadata(
+        ["/sound/files/beep.wav"],
+        files_dir=str(tmp_path),
+        sidecar=str(tmp_path / "metadata.bin"),
+    )
+    beep = read_sidecar(str(tmp_path / "metadata.bin"))["beep.wav"]
+
+    assert beep == entries["beep.wav"]
+    assert beep.duration == 2
+    assert (beep.sample_rate, beep.channels, beep.bitrate) == (8000, 2, 256000)
+    assert beep.peaks[:2] == b"\x00\x00"
+    assert beep.peaks[-2:] == b"\x7f\x7f"
+
+
+def test_sound_metadata_needs_ffmpeg(tmp_path, monkeypatch):
+    sidecar = str(tmp_path / "metadata.bin")
+    monkeypatch.setattr("shutil.which", lambda name: None)
+
+    with pytest.raises(RuntimeError, match="mario/songs/castle.mp3"):
+        build_metadata(
+            ["/sound/files/mario/songs/castle.mp3"], sidecar=sidecar
+        )
+
+    assert not os.path.exists(sidecar)
+
+
+def test_parse_mp3():
+    with open("api/sound/files/mario/songs/castle.mp3", "rb") as f:
+        castle = parse_mp3(f.read())
+
+    assert castle.sample_rate == 44100
+    assert castle.bitrate == 128000
+    assert 68 < castle.duration < 70
+
+
+def test_peaks(client: TestClient):
+    resp = client.get("/effects/4/peaks")
+    data = resp.json()
+
+    assert resp.status_code == 200
+    assert data["duration"] == client.get("/effects/4").json()["duration"]
+    assert all(-1 <= low <= high <= 1 for low, high in data["peaks"])
+
+    # Songs are MP3s, their waveforms were decoded when indexing.
+    resp = client.get("/songs/1/peaks")
+
+    assert resp.status_code == 200
+    assert any(low < high for low, high in resp.json()["peaks"])
+
+    resp = client.get("/cats/4/peaks")
+
+    assert resp.status_code == 422
+
+    resp = client.get("/effects/1000/peaks")
+
+    assert resp.status_code == 404
+
+
+@pytest.fixture(name="catalog")
+def catalog_fixture(tmp_path):
+    data_dir, files_dir = tmp_path / "data", tmp_path / "files"
+    data_dir.mkdir()
+    files_dir.mkdir()
+    (data_dir / "fx.json").write_text(json.dumps([
+        {
+            "id": 1, "category": "game", "name": "Pause",
+            "url": "/sound/files/pause.wav",
+        },
+    ]))
+    (data_dir / "songs.json").write_text("[]")
+    files = AudioFiles(directory=str(files_dir), revalidate=60)
+    yield CatalogManager(
+        files,
+        data_dir=str(data_dir),
+        files_dir=str(files_dir),
+        sidecar=str(data_dir / "metadata.bin"),
+        variants_dir=str(tmp_path / "variants"),
+        poll=0.01,
+    )
+
+
+def test_catalog_reload(catalog, tmp_path):
+    library = catalog.current
+
+    assert not catalog.reload()
+
+    (tmp_path / "data" / "songs.json").write_text(json.dumps([
+        {
+            "id": 1, "category": "cartoon", "name": "Theme",
+            "url": "/sound/files/theme.mp3",
+        },
+    ]))
+
+    assert catalog.reload()
+    assert catalog.current.songs.get(1)["name"] == "Theme"
+    # Requests already holding the old library aren't affected.
+    assert library.songs.get(1) is None
+
+    library = catalog.current
+    (tmp_path / "data" / "songs.json").write_text("[{")
+
+    with pytest.raises(ValueError):
+        catalog.reload()
+    assert catalog.current is library
+
+    (tmp_path / "files" / "theme.mp3").write_bytes(b"")
+    (tmp_path / "data" / "songs.json").write_text("[]")
+
+    assert catalog.reload()
+    assert catalog.current.songs.get(1) is None
+
+
+def test_catalog_watch(catalog, tmp_path):
+    async def watch():
+        await catalog.start()
+        (tmp_path / "data" / "fx.json").write_text("[]")
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if not catalog.current.effects.get(1):
+                break
+        await catalog.stop()
+
+    asyncio.run(watch())
+
+    assert catalog.current.effects.get(1) is None
@@ -0,0 +1,260 @@
+import array
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import wave
+
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+VARIANTS_DIR = "api/sound/variants"
+MANIFEST = "manifest.json"
+# `format` value that always gets the file as it was uploaded.
+ORIGINAL = "original"
+
+
+class Encoder(NamedTuple):
+    media_type: str
+    extension: str
+    # Builds `dest` from `source`, returns False when it can't.
+    encode: Callable[[str, str], bool]
+    # Source extensions worth encoding, re-encoding an mp3 as mp3 isn't.
+    sources: tuple
+
+
+class Variant(NamedTuple):
+    format: str
+    path: str
+    media_type: str
+    size: int
+    hash: str
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ffmpeg(*args: str) -> Callable[[str, str], bool]:
+    def encode(source: str, dest: str) -> bool:
+        if not shutil.which("ffmpeg"):
+            return False
+        return subprocess.run(
+            [
+                "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+                "-i", source, "-vn", *args, dest,
+            ],
+        ).returncode == 0
+    return encode
+
+
+def encode_lofi(source: str, dest: str) -> bool:
+    """Downmixes a PCM WAV to mono and halves its rate, down to 22.05kHz.
+
+    Plain Python, so there is always some smaller variant to serve even
+    where no encoder is installed.
+    """
+    try:
+        with wave.open(source, "rb") as src:
+            channels, width, rate, frames = (
+                src.getnchannels(), src.getsampwidth(),
+                src.getframerate(), src.getnframes(),
+            )
+            if width != 2 or (channels == 1 and rate <= 22050):
+                return False
+            samples = array.array("h", src.readframes(frames))
+    except (wave.Error, EOFError):
+        return False
+    if sys.byteorder == "big":
+        samples.byteswap()
+
+    mono = samples
+    if channels > 1:
+        mono = array.array("h", (
+            sum(samples[i:i + channels]) // channels
+            for i in range(0, len(samples) - channels + 1, channels)
+        ))
+    step = 2 if rate > 22050 else 1
+    if step > 1:
+        # Averaging each pair is a cheap low-pass before dropping half.
+        mono = array.array("h", (
+            (mono[i] + mono[i + 1]) // 2
+            for i in range(0, len(mono) - 1, 2)
+        ))
+    if sys.byteorder == "big":
+        mono.byteswap()
+
+    with wave.open(dest, "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(rate // step)
+        out.writeframes(mono.tobytes())
+    return True
+
+
+ENCODERS: Dict[str, Encoder] = {
+    "opus": Encoder(
+        "audio/ogg", ".opus",
+        ffmpeg("-c:a", "libopus", "-b:a", "64k"),
+        (".wav", ".mp3"),
+    ),
+    "mp3": Encoder(
+        "audio/mpeg", ".mp3",
+        ffmpeg("-c:a", "libmp3lame", "-q:a", "4"),
+        (".wav",),
+    ),
+    "lofi": Encoder(
+        "audio/wav", ".lofi.wav",
+        encode_lofi,
+        (".wav",),
+    ),
+}
+
+
+def build_variants(
+    urls: List[str],
+    files_dir: str = "api/sound/files",
+    variants_dir: str = VARIANTS_DIR,
+) -> dict:
+    """Encodes every source under `files_dir` and writes the manifest.
+
+    Variants whose source hash hasn't changed since the last build are
+    kept as they are. Only variants smaller than their source are kept.
+    """
+    manifest_path = os.path.join(variants_dir, MANIFEST)
+    previous = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "rt") as f:
+            previous = json.load(f)
+
+    manifest = {}
+    for url in urls:
+        name = url.removeprefix("/sound/files/")
+        source = os.path.join(files_dir, name)
+        if not os.path.isfile(source):
+            print(f"Skipping {name!r}, it doesn't exist.")
+            continue
+        source_hash = file_hash(source)
+        if previous.get(name, {}).get("hash") == source_hash and all(
+            os.path.isfile(os.path.join(variants_dir, v["path"]))
+            for v in previous[name]["variants"]
+        ):
+            manifest[name] = previous[name]
+            continue
+
+        variants = []
+        base, extension = os.path.splitext(name)
+        for format, encoder in ENCODERS.items():
+            if extension.lower() not in encoder.sources:
+                continue
+            path = base + encoder.extension
+            dest = os.path.join(variants_dir, path)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if not encoder.encode(source, dest) or not os.path.isfile(dest):
+                continue
+            size = os.path.getsize(dest)
+            if size >= os.path.getsize(source):
+                os.remove(dest)
+                continue
+            variants.append(Variant(
+                format, path, encoder.media_type, size, file_hash(dest)
+            )._asdict())
+            print(f"{name} -> {format}: {size} bytes")
+        manifest[name] = {"hash": source_hash, "variants": variants}
+
+    os.makedirs(variants_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "wt", dir=variants_dir, delete=False
+    ) as f:
+        json.dump(manifest, f, indent=2)
+    # Temporary files are private, the app needs to read this one.
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, manifest_path)
+    return manifest
+
+
+def media_ranges(accept: str) -> Dict[str, float]:
+    """Parses an Accept header into `{media type: q}`."""
+    ranges = {}
+    for part in accept.split(","):
+        media_type, *params = part.strip().split(";")
+        q = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type:
+            ranges[media_type.strip().lower()] = q
+    return ranges
+
+
+class Variants:
+    """The variants manifest, and picking a variant for a request."""
+
+    def __init__(self, directory: str, manifest: Dict[str, List[Variant]]):
+        self.directory = os.path.realpath(directory)
+        self.manifest = manifest
+
+    @classmethod
+    def load(cls, directory: str = VARIANTS_DIR) -> "Variants":
+        manifest = {}
+        try:
+            with open(os.path.join(directory, MANIFEST), "rt") as f:
+                manifest = {
+                    name: [Variant(**v) for v in entry["variants"]]
+                    for name, entry in json.load(f).items()
+                }
+        except FileNotFoundError:
+            pass
+        return cls(directory, manifest)
+
+    def __contains__(self, name: str) -> bool:
+        return bool(self.manifest.get(name))
+
+    def choose(
+        self,
+        name: str,
+        format: Optional[str],
+        accept: str,
+    ) -> Optional[Variant]:
+        """The variant to serve for `name`, or None for the original.
+
+        An explicit `format` wins. Otherwise the smallest variant whose
+        media type the client names outright; wildcards like `*/*` and
+        `audio/*` keep getting the original, as that's what the URL says.
+        Variants of the original's own type (lofi) are only sent when
+        asked for, naming the type only means the client can play it.
+
+        Raises LookupError for a `format` the file doesn't come in.
+        """
+        variants = self.manifest.get(name, [])
+        if format:
+            if format == ORIGINAL:
+                return None
+            for variant in variants:
+                if variant.format == format:
+                    return variant
+            raise LookupError(format)
+        ranges = media_ranges(accept)
+        # By extension, mimetypes calls WAVs audio/x-wav.
+        original = os.path.splitext(name)[1]
+        acceptable = [
+            variant for variant in variants
+            if os.path.splitext(variant.path)[1] != original
+            and ranges.get(variant.media_type, 0) > 0
+        ]
+        if not acceptable:
+            return None
+        return min(
+            acceptable,
+            key=lambda v: (-ranges[v.media_type], v.size)
+        )
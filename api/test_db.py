@@ -0,0 +1,181 @@
+import asyncio
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlmodel import create_engine
+
+from api.db import (
+    ReadReplicas, get_async_read_session, get_async_session, get_session,
+    pool_options, sqlite_pool_options, use_sqlite_profile, watch_pool,
+)
+from api.metrics import render
+
+
+def test_tuned_sqlite_profile(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}")
+    use_sqlite_profile(engine, "tuned")
+
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert conn.execute(text("PRAGMA temp_store")).scalar() == 2
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+        assert conn.execute(text("PRAGMA foreign_keys")).scalar() == 1
+
+
+def test_default_sqlite_profile(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}")
+    use_sqlite_profile(engine, "default")
+
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "delete"
+
+
+def test_sqlite_pool_options():
+    assert sqlite_pool_options("sqlite+aiosqlite:///./a.sqlite", "tuned")
+    assert not sqlite_pool_options("sqlite+aiosqlite://", "tuned")
+    assert not sqlite_pool_options("sqlite+aiosqlite:///./a.sqlite", "default")
+    assert not sqlite_pool_options("sqlite:///./a.sqlite", "tuned")
+
+
+def test_pool_metrics(tmp_path):
+    url = f"sqlite:///{tmp_path / 'test.sqlite'}"
+    engine = create_engine(url, **pool_options(url, "test", pool_size=2))
+    watch_pool(engine, "test")
+
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+        rendered = render()
+        assert 'db_pool_connections{engine="test",state="checked_out"} 1' in rendered
+        assert 'db_pool_connections{engine="test",state="idle"} 0' in rendered
+
+    rendered = render()
+    assert 'db_pool_connections{engine="test",state="checked_out"} 0' in rendered
+    assert 'db_pool_connections{engine="test",state="idle"} 1' in rendered
+    assert 'db_pool_checkout_seconds_count{engine="test"} 1' in rendered
+
+
+def test_read_replicas(tmp_path):
+    engines = {}
+    for name in ("primary", "replica_a", "replica_b"):
+        sync_engine = create_engine(f"sqlite:///{tmp_path / name}.sqlite")
+        with sync_engine.begin() as conn:
+            conn.execute(text("CREATE TABLE origin (name TEXT)"))
+            conn.execute(text(f"INSERT INTO origin VALUES ('{name}')"))
+        engines[name] = create_async_engine(
+            f"sqlite+aiosqlite:///{tmp_path / name}.sqlite"
+        )
+    broken = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'missing' / 'broken.sqlite'}"
+    )
+
+    async def read_origins(replicas, count):
+        origins = []
+        for _ in range(count):
+            async with replicas.session() as session:
+                origins.append(
+                    (await session.exec(text("SELECT name FROM origin"))).scalar()
+                )
+        return origins
+
+    replicas = ReadReplicas(
+        [engines["replica_a"], broken, engines["replica_b"]],
+        engines["primary"],
+    )
+    origins = asyncio.run(read_origins(replicas, 6))
+    assert "primary" not in origins
+    assert origins.count("replica_a") == 3
+    assert origins.count("replica_b") == 3
+    assert replicas.down_until[1] > 0
+
+    replicas = ReadReplicas([broken], engines["primary"])
+    assert asyncio.run(read_origins(replicas, 2)) == ["primary", "primary"]
+
+    replicas = ReadReplicas([], engines["primary"])
+    assert asyncio.run(read_origins(replicas, 1)) == ["primary"]
+
+
+def test_replica_sessions_are_lazy(tmp_path):
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'r.sqlite'}",
+        poolclass=AsyncAdaptedQueuePool,
+    )
+    replicas = ReadReplicas([engine], engine)
+    checkouts = []
+    event.listen(
+        engine.sync_engine, "checkout", lambda *args: checkouts.append(args)
+    )
+
+    async def open_session(query: bool):
+        async with replicas.session() as session:
+            if query:
+                await session.exec(text("SELECT 1"))
+
+    asyncio.run(open_session(query=False))
+    assert checkouts == []
+    asyncio.run(open_session(query=True))
+    # One for picking the replica, whose connection the query then reuses.
+    assert len(checkouts) == 2
+    assert engine.sync_engine.pool.checkedin() == 1
+    asyncio.run(engine.dispose())
+
+
+# Routes by the session they check out, every other route has none.
+DB_ROUTES = {
+    "replica": [
+        "GET /contact/agendas",
+        "GET /contact/agendas/{slug}",
+        "GET /contact/agendas/{slug}/contacts",
+        "GET /contact/agendas/{slug}/contacts/export",
+        "GET /contact/agendas/{slug}/events",
+        "GET /todo/users",
+        "GET /todo/users/{user_name}",
+        "GET /todo/users/{user_name}/events",
+    ],
+    "primary": [
+        "DELETE /contact/agendas/{slug}",
+        "DELETE /contact/agendas/{slug}/contacts/{contact_id}",
+        "DELETE /todo/todos/{todo_id}",
+        "DELETE /todo/users/{user_name}",
+        "PATCH /todo/todos/bulk",
+        "POST /contact/agendas/{slug}",
+        "POST /contact/agendas/{slug}/contacts",
+        "POST /contact/agendas/{slug}/contacts/import",
+        "POST /todo/todos/{user_name}",
+        "POST /todo/todos/{user_name}/bulk",
+        "POST /todo/users/{user_name}",
+        "PUT /contact/agendas/{slug}/contacts/{contact_id}",
+        "PUT /todo/todos/{todo_id}",
+    ],
+}
+
+
+def test_route_sessions():
+    from main import app
+
+    sessions = {
+        get_session: "sync",
+        get_async_session: "primary",
+        get_async_read_session: "replica",
+    }
+
+    def dependencies(dependant):
+        for dependency in dependant.dependencies:
+            yield dependency.call
+            yield from dependencies(dependency)
+
+    routes = {}
+    for mount in app.routes:
+        for route in getattr(mount, "routes", []):
+            if not isinstance(route, APIRoute):
+                continue
+            for call in dependencies(route.dependant):
+                if call in sessions:
+                    for method in route.methods:
+                        routes.setdefault(sessions[call], []).append(
+                            f"{method} {mount.path}{route.path}"
+                        )
+
+    assert {name: sorted(paths) for name, paths in routes.items()} == DB_ROUTES
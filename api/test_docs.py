@@ -0,0 +1,63 @@
+import gzip
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.docs import serve_docs
+
+
+def make_app():
+    app = FastAPI(title="Grizelle API", docs_url=None, openapi_url=None)
+    docs = serve_docs(app, title="4Geeks Playground - Grizelle API")
+
+    @app.get("/cats")
+    async def read_cats():
+        return []
+
+    return app, docs
+
+
+def test_docs_built_at_startup():
+    subapp, docs = make_app()
+    main = FastAPI()
+    main.mount("/grizelle", subapp)
+
+    @main.on_event("startup")
+    async def build_docs():
+        docs.build("/grizelle")
+
+    calls = []
+    generate = subapp.openapi
+    subapp.openapi = lambda: calls.append(1) or generate()
+
+    with TestClient(main) as client:
+        assert calls == [1]
+        resp = client.get(
+            "/grizelle/openapi.json", headers={"Accept-Encoding": "gzip"}
+        )
+        client.get("/grizelle/openapi.json")
+        assert calls == [1]
+
+    assert resp.headers["content-encoding"] == "gzip"
+    assert resp.json()["servers"] == [{"url": "/grizelle"}]
+    assert "/cats" in resp.json()["paths"]
+    assert "/docs" not in resp.json()["paths"]
+
+    resp = client.get("/grizelle/docs")
+    assert "/grizelle/openapi.json" in resp.text
+    assert "4Geeks Playground - Grizelle API" in resp.text
+    assert gzip.decompress(docs.html.variants["gzip"][0]) == resp.content
+
+    resp = client.get(
+        "/grizelle/docs", headers={"If-None-Match": resp.headers["etag"]}
+    )
+    assert resp.status_code == 304
+
+
+def test_docs_built_on_first_hit():
+    subapp, docs = make_app()
+    client = TestClient(subapp)
+
+    assert docs.openapi is None
+    assert client.get("/openapi.json").json()["paths"]["/cats"]
+    assert "url: '/openapi.json'" in client.get("/docs").text
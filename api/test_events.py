@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from api.events import CLOSED, RESYNC, Broker, broker, event_stream, sse
+
+
+def test_broker():
+    async def run():
+        broker = Broker(buffer=2, max_subscribers=2)
+        subscription = broker.subscribe("todo:1")
+        other = broker.subscribe("todo:2")
+        with pytest.raises(HTTPException) as e:
+            broker.subscribe("todo:3")
+        assert e.value.status_code == 503
+
+        events = broker.events("todo:1", subscription, heartbeat=0.01)
+        # Idle streams get heartbeats.
+        assert await anext(events) is None
+
+        broker.publish("todo:1", {"type": "a"})
+        broker.publish("todo:2", {"type": "other"})
+        assert await anext(events) == {"type": "a"}
+
+        # A reader that falls behind gets a resync instead of the backlog.
+        for type in "bcd":
+            broker.publish("todo:1", {"type": type})
+        assert await anext(events) == RESYNC
+        assert other.buffer[0] == {"type": "other"}
+
+        broker.publish("todo:1", {"type": "e"})
+        broker.close("todo:1")
+        broker.publish("todo:1", {"type": "lost"})
+        assert [event async for event in events] == [{"type": "e"}, CLOSED]
+        assert broker.count == 1
+        assert "todo:1" not in broker.topics
+
+        # Releasing twice only counts once.
+        broker.unsubscribe("todo:1", subscription)
+        assert broker.count == 1
+
+    asyncio.run(run())
+
+
+def test_sse():
+    assert sse(None) == b": keepalive\n\n"
+    assert sse({"type": "todo.deleted", "id": 1}) == (
+        b'event: todo.deleted\ndata: {"type":"todo.deleted","id":1}\n\n'
+    )
+
+
+def test_event_stream_released_on_early_disconnect():
+    async def disconnected():
+        return {"type": "http.disconnect"}
+
+    async def gone(message):
+        # Before the body, so its own cleanup never runs.
+        raise OSError("Client went away.")
+
+    async def run():
+        for _ in range(3):
+            response = event_stream("todo:1")
+            # Raised as is, or in a group from the response's task group.
+            with pytest.raises(Exception):
+                await response({"type": "http"}, disconnected, gone)
+
+    count = broker.count
+    asyncio.run(run())
+
+    assert broker.count == count
+    assert "todo:1" not in broker.topics
@@ -0,0 +1,259 @@
+import threading
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.ratelimit import (
+    FixedWindow, Limiter, MemoryStorage, RateLimitMiddleware, RedisStorage,
+    SlidingWindowCounter, SQLiteStorage, parse_rate,
+)
+
+
+class FakeRedis:
+    """Just enough of a Redis client for RedisStorage."""
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+
+    def expired(self, key):
+        if self.expires.get(key, float("inf")) <= time.monotonic():
+            self.values.pop(key, None)
+            self.expires.pop(key, None)
+
+    def set(self, key, value, ex=None, nx=False):
+        self.expired(key)
+        if nx and key in self.values:
+            return None
+        self.values[key] = int(value)
+        self.expires.pop(key, None)
+        if ex is not None:
+            self.expires[key] = time.monotonic() + ex
+        return True
+
+    def incrby(self, key, amount):
+        self.expired(key)
+        self.values[key] = self.values.get(key, 0) + amount
+        return self.values[key]
+
+    def get(self, key):
+        self.expired(key)
+        value = self.values.get(key)
+        return None if value is None else str(value).encode()
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def scan_iter(self, pattern):
+        return [k for k in list(self.values) if k.startswith(pattern[:-1])]
+
+    def delete(self, key):
+        self.values.pop(key, None)
+        self.expires.pop(key, None)
+
+
+class FakePipeline:
+    """Queues commands and runs them together on `execute`."""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        return lambda *args, **kwargs: self.commands.append(
+            (method, args, kwargs)
+        )
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+
+def test_parse_rate():
+    assert parse_rate("15/minute") == (15, 60, 1, "minute")
+    assert parse_rate("100 per 2 hours") == (100, 7200, 2, "hour")
+    assert str(parse_rate("15/minute")) == "15 per 1 minute"
+    with pytest.raises(ValueError):
+        parse_rate("lots")
+
+
+@pytest.mark.parametrize("make_storage", [
+    MemoryStorage,
+    lambda: SQLiteStorage(":memory:"),
+    lambda: RedisStorage(FakeRedis()),
+])
+def test_storage(make_storage):
+    storage = make_storage()
+
+    assert storage.get("a") == 0
+    assert storage.incr("a", 60) == 1
+    assert storage.incr("a", 60, 2) == 3
+    assert storage.get("a") == 3
+
+    assert storage.incr("gone", 0) == 1
+    assert storage.get("gone") == 0
+    assert storage.incr("gone", 60) == 1
+
+    storage.clear()
+    assert storage.get("a") == 0
+
+
+def test_redis_storage_expiry():
+    client = FakeRedis()
+    storage = RedisStorage(client)
+    commands = []
+    pipeline = client.pipeline
+
+    def record_pipeline(transaction=True):
+        pipe = pipeline(transaction)
+        commands.append(transaction)
+        return pipe
+    client.pipeline = record_pipeline
+
+    storage.incr("a", 60)
+    expires_at = client.expires["ratelimit:a"]
+    storage.incr("a", 60)
+
+    # Every increment is sent with the expiry in one transaction, and
+    # only the first one sets it.
+    assert commands == [True, True]
+    assert client.expires["ratelimit:a"] == expires_at
+    assert storage.get("a") == 2
+
+
+def test_sqlite_storage_is_shared(tmp_path):
+    path = str(tmp_path / "limits.sqlite")
+    first, second = SQLiteStorage(path), SQLiteStorage(path)
+
+    first.incr("a", 60)
+    assert second.incr("a", 60) == 2
+
+
+def test_memory_storage_sweeps_expired():
+    storage = MemoryStorage()
+    for i in range(1023):
+        storage.incr(str(i), 0)
+    storage.incr("kept", 60)
+
+    assert list(storage.counters) == ["kept"]
+
+
+def test_fixed_window(monkeypatch):
+    # Pinned, so the hits can't straddle two windows.
+    monkeypatch.setattr(time, "time", lambda: 60 * 1000 + 30)
+    strategy = FixedWindow(MemoryStorage())
+    rate = parse_rate("2/minute")
+
+    assert strategy.hit("a", rate).allowed
+    assert strategy.hit("a", rate).remaining == 0
+    assert not strategy.hit("a", rate).allowed
+    assert strategy.hit("b", rate).allowed
+
+
+def test_sliding_window_counter(monkeypatch):
+    storage = MemoryStorage()
+    strategy = SlidingWindowCounter(storage)
+    rate = parse_rate("10/minute")
+    now = 60 * 1000
+
+    monkeypatch.setattr(time, "time", lambda: now + 30)
+    for _ in range(10):
+        assert strategy.hit("a", rate).allowed
+    assert not strategy.hit("a", rate).allowed
+
+    # Halfway into the next window, half of the last one's 11 hits count.
+    monkeypatch.setattr(time, "time", lambda: now + 90)
+    for _ in range(5):
+        assert strategy.hit("a", rate).allowed
+    assert not strategy.hit("a", rate).allowed
+
+
+def test_rate_limit_middleware(monkeypatch):
+    monkeypatch.setattr(time, "time", lambda: 60 * 1000 + 30)
+    limiter = Limiter(storage=MemoryStorage(), strategy="fixed-window")
+    subapp = FastAPI()
+    calls = []
+
+    @subapp.get("/things")
+    @limiter.limit("2/minute")
+    def read_things(name: str = "things"):
+        calls.append(name)
+        return {"name": name}
+
+    @subapp.get("/things/{id}")
+    @limiter.limit("5/minute")
+    @limiter.limit("1/minute")
+    async def read_thing(id: int):
+        calls.append(id)
+        return {"id": id}
+
+    @subapp.get("/free")
+    def read_free():
+        return {}
+
+    app = FastAPI()
+    app.add_middleware(RateLimitMiddleware, routes=app.routes, limiter=limiter)
+    app.mount("/sub", subapp)
+    client = TestClient(app)
+
+    resp = client.get("/sub/things", params={"name": "a"})
+    assert resp.json() == {"name": "a"}
+    assert client.get("/sub/things").status_code == 200
+    resp = client.get("/sub/things")
+    assert resp.status_code == 429
+    assert resp.json() == {"error": "Rate limit exceeded: 2 per 1 minute"}
+    assert resp.headers["retry-after"] == "30"
+    # Rejected before the endpoint ran.
+    assert calls == ["a", "things"]
+
+    # Each route counts on its own, against the tightest of its rates.
+    assert client.get("/sub/things/1").status_code == 200
+    assert client.get("/sub/things/2").json() == {
+        "error": "Rate limit exceeded: 1 per 1 minute"
+    }
+
+    for _ in range(5):
+        assert client.get("/sub/free").status_code == 200
+
+    limiter.enabled = False
+    assert client.get("/sub/things/3").status_code == 200
+
+
+@pytest.mark.parametrize("storage_class, off_loop", [
+    (MemoryStorage, False),
+    (lambda: SQLiteStorage(":memory:"), True),
+    (lambda: RedisStorage(FakeRedis()), True),
+])
+def test_rate_limit_middleware_off_the_loop(storage_class, off_loop):
+    storage = storage_class()
+    threads = {}
+    incr = storage.incr
+
+    def recording_incr(*args, **kwargs):
+        threads["storage"] = threading.get_ident()
+        return incr(*args, **kwargs)
+
+    storage.incr = recording_incr
+    limiter = Limiter(storage=storage, strategy="fixed-window")
+    app = FastAPI()
+
+    @app.get("/things")
+    @limiter.limit("5/minute")
+    async def read_things():
+        threads["loop"] = threading.get_ident()
+        return {}
+
+    app.add_middleware(RateLimitMiddleware, routes=app.routes, limiter=limiter)
+    TestClient(app).get("/things")
+
+    # SQLite waits on other workers' write locks, Redis on the network.
+    assert (threads["storage"] != threads["loop"]) is off_loop
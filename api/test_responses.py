@@ -0,0 +1,164 @@
+import gzip
+import os
+
+import brotli
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from api.responses import (
+    CompressionMiddleware, PrecompressedContent, PrecompressedStaticFiles,
+    accepted_encodings, compress_static,
+)
+
+BODY = b"<li>Grizelle</li>" * 100
+
+app = FastAPI()
+content = PrecompressedContent(BODY, media_type="text/html")
+
+
+@app.get("/")
+async def index(request: Request):
+    return content.response(request)
+
+
+client = TestClient(app)
+
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip;q=0.5, br;q=0, *") == {
+        "gzip": 0.5, "br": 0.0, "*": 1.0
+    }
+
+
+def test_precompressed_content():
+    resp = client.get("/", headers={"Accept-Encoding": "gzip, br"})
+
+    assert resp.status_code == 200
+    assert resp.headers["content-encoding"] == "br"
+    assert resp.headers["vary"] == "Accept-Encoding"
+    assert resp.headers["cache-control"] == "public, max-age=300"
+    assert resp.content == BODY
+
+    raw = client.get(
+        "/", headers={"Accept-Encoding": "gzip, br;q=0"}
+    )
+
+    assert raw.headers["content-encoding"] == "gzip"
+    assert raw.headers["etag"] != resp.headers["etag"]
+    assert gzip.decompress(content.variants["gzip"][0]) == BODY
+    assert brotli.decompress(content.variants["br"][0]) == BODY
+
+    resp = client.get("/", headers={"Accept-Encoding": "identity"})
+
+    assert "content-encoding" not in resp.headers
+    assert resp.content == BODY
+
+
+def test_precompressed_content_not_modified():
+    etag = client.get("/").headers["etag"]
+
+    resp = client.get("/", headers={"If-None-Match": f"W/{etag}"})
+
+    assert resp.status_code == 304
+    assert resp.content == b""
+    assert resp.headers["etag"] == etag
+
+    resp = client.get("/", headers={"If-None-Match": '"grizelle"'})
+
+    assert resp.status_code == 200
+
+
+def test_compression_middleware():
+    compressed = FastAPI()
+    compressed.add_middleware(CompressionMiddleware)
+
+    @compressed.get("/json")
+    async def read_json():
+        return {"names": ["Grizelle"] * 100}
+
+    @compressed.get("/small")
+    async def read_small():
+        return {"name": "Grizelle"}
+
+    @compressed.get("/audio")
+    async def read_audio():
+        return Response(b"RIFF" * 100, media_type="audio/wav")
+
+    @compressed.get("/export")
+    async def read_export():
+        async def rows():
+            for i in range(3):
+                yield f'{{"name": "Cat #{i}"}}\n'.encode() * 50
+
+        return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+    @compressed.get("/precompressed")
+    async def read_precompressed(request: Request):
+        return content.response(request)
+
+    client = TestClient(compressed)
+
+    resp = client.get("/json", headers={"Accept-Encoding": "br"})
+    assert resp.headers["content-encoding"] == "br"
+    assert resp.headers["vary"] == "Accept-Encoding"
+    assert int(resp.headers["content-length"]) < 100
+    assert resp.json() == {"names": ["Grizelle"] * 100}
+
+    resp = client.get("/json", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in resp.headers
+    assert resp.headers["vary"] == "Accept-Encoding"
+
+    for url in ("/small", "/audio"):
+        resp = client.get(url, headers={"Accept-Encoding": "gzip, br"})
+        assert "content-encoding" not in resp.headers
+
+    resp = client.get("/export", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["content-encoding"] == "gzip"
+    assert "content-length" not in resp.headers
+    assert resp.text.count("Cat #2") == 50
+
+    # Already compressed, once.
+    resp = client.get("/precompressed", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["content-encoding"] == "gzip"
+    assert resp.content == BODY
+
+
+def test_precompressed_static_files(tmp_path):
+    (tmp_path / "site.css").write_bytes(b"body { color: red; }" * 100)
+    (tmp_path / "tiny.css").write_bytes(b"a {}")
+    assert compress_static(str(tmp_path)) == 2
+    assert not (tmp_path / "tiny.css.gz").exists()
+
+    static = FastAPI()
+    static.mount("/static", PrecompressedStaticFiles(directory=tmp_path))
+    client = TestClient(static)
+
+    resp = client.get("/static/site.css", headers={"Accept-Encoding": "br"})
+    assert resp.headers["content-encoding"] == "br"
+    assert resp.headers["content-type"].startswith("text/css")
+    assert resp.headers["content-length"] == str(
+        os.path.getsize(tmp_path / "site.css.br")
+    )
+    assert resp.content == b"body { color: red; }" * 100
+
+    resp = client.get(
+        "/static/site.css",
+        headers={
+            "Accept-Encoding": "br",
+            "If-None-Match": resp.headers["etag"],
+        },
+    )
+    assert resp.status_code == 304
+
+    resp = client.get("/static/site.css", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["content-encoding"] == "gzip"
+
+    resp = client.get("/static/tiny.css", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in resp.headers
+    assert resp.headers["vary"] == "Accept-Encoding"
+
+    # A sibling older than its file is stale, and ignored.
+    os.utime(tmp_path / "site.css.gz", (0, 0))
+    resp = client.get("/static/site.css", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in resp.headers
@@ -3,31 +3,42 @@ import os
 from typing import List, Optional, Annotated
 
 from fastapi import (
-    FastAPI, Request, Response, HTTPException,
-    Query, Depends, Path, status,
+    FastAPI, Request, Response, HTTPException, WebSocket,
+    Body, Query, Depends, Path, status,
 )
-from fastapi.openapi.docs import get_swagger_ui_html
+from fastapi.responses import StreamingResponse
 
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
+from api.docs import serve_docs
+from api.ratelimit import limiter
 
-from sqlmodel import (
-    Session, select
-)
+from sqlalchemy import delete, literal, update
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import StaleDataError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from .models import (
     TodoUser, TodoUserRead, TodoUserReadWithItems,
     TodoItem, TodoItemCreate, TodoItemRead, TodoItemUpdate,
-    TodoUserList
+    TodoItemBulkUpdate, TodoItemList, TodoUserList
+)
+from api.db import (
+    get_async_session, get_async_read_session, insert, served_by_replica,
 )
-from api.db import get_session
+from api.events import broker, event_stream, websocket_stream
+from api.pagination import decode_cursor, paginate
+from api.responses import etag_matches
+from api.todo.cache import user_cache
+from api.versions import at_versions, if_match_versions, version_etag
 
+# Most items a bulk request may carry.
+BULK_LIMIT = 1000
 
 app = FastAPI(
     title="Todo API",
     description="An API for storing Todo Lists.",
     docs_url=None,
+    openapi_url=None,
     openapi_tags=[
         {
             "name": "User operations",
@@ -40,22 +51,51 @@ app = FastAPI(
     ]
 )
 
-limiter = Limiter(key_func=get_remote_address)
-# Limiter requires the request to be in the args for your routes!
+# Limits are counted by RateLimitMiddleware on the main app.
 app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+serve_docs(app, title="4Geeks Playground - Todo API")
 
 
-@app.get("/docs", include_in_schema=False)
-async def swagger_ui_html():
-    return get_swagger_ui_html(
-        title="4Geeks Playground - Todo API",
-        openapi_url="/todo/openapi.json",
-        swagger_favicon_url="/favicon.ico",
-        # swagger_css_url="/static/swagger-ui.css",
+def user_changed(user_name: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_412_PRECONDITION_FAILED,
+        detail=f"User {user_name} has changed since it was read.",
     )
 
 
+def publish(user_id: int, type: str, **data):
+    """Tells the user's event streams what changed."""
+    broker.publish(f"todo:{user_id}", {"type": type, **data})
+
+
+def todo_changed(todo_id: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_412_PRECONDITION_FAILED,
+        detail=f"The list of Todo #{todo_id} has changed since it was read.",
+    )
+
+
+def owned_at_versions(versions):
+    """Todos whose user matches an If-Match, if one was sent."""
+    if versions is None:
+        return ()
+    return (TodoItem.user_id.in_(
+        select(TodoUser.id).where(at_versions(TodoUser, versions))
+    ),)
+
+
+@app.on_event("startup")
+async def listen_for_invalidations():
+    if user_cache.channel:
+        await user_cache.channel.start()
+
+
+@app.on_event("shutdown")
+async def stop_listening_for_invalidations():
+    if user_cache.channel:
+        await user_cache.channel.stop()
+
+
 @app.post(
     "/users/{user_name}",
     status_code=status.HTTP_201_CREATED,
@@ -65,24 +105,24 @@ async def swagger_ui_html():
     description="Creates a new User.",
 )
 @limiter.limit("15/minute")
-def create_user(
+async def create_user(
     user_name: Annotated[str, Path(title="username")],
     request: Request,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ) -> None:
-    user_exists = session.exec(select(TodoUser).where(
-        TodoUser.name == user_name)).first()
-    if user_exists:
+    db_user = (await session.exec(
+        insert(session, TodoUser).values(
+            name=user_name
+        ).on_conflict_do_nothing(
+            index_elements=[TodoUser.name]
+        ).returning(TodoUser)
+    )).scalar_one_or_none()
+    if not db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="User already exists."
         )
-    db_user = TodoUser.model_validate({
-        "name": user_name
-    })
-    session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
+    await session.commit()
     return db_user
 
 
@@ -93,21 +133,32 @@ def create_user(
     description="Deletes a User from the database.",
 )
 @limiter.limit("15/minute")
-def delete_user(
+async def delete_user(
     request: Request,
     user_name: Annotated[str, Path(title="username")],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    user = session.exec(select(TodoUser).where(
-        TodoUser.name == user_name)
-    ).first()
-    if not user:
+    versions = if_match_versions(request.headers.get("if-match"))
+    # The user's todos go with it, through ON DELETE CASCADE.
+    user_id = (await session.exec(
+        delete(TodoUser).where(
+            TodoUser.name == user_name,
+            at_versions(TodoUser, versions),
+        ).returning(TodoUser.id)
+    )).scalar_one_or_none()
+    if not user_id:
+        if versions is not None and (await session.exec(
+            select(TodoUser.id).where(TodoUser.name == user_name)
+        )).first():
+            raise user_changed(user_name)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"User {user_name} doesn't exist."
         )
-    session.delete(user)
-    session.commit()
+    await session.commit()
+    user_cache.invalidate(names=[user_name])
+    publish(user_id, "user.deleted")
+    broker.close(f"todo:{user_id}")
     return Response(
         status_code=status.HTTP_204_NO_CONTENT
     )
@@ -119,16 +170,23 @@ def delete_user(
     tags=["User operations"],
 )
 @limiter.limit("120/minute")
-def read_users(
+async def read_users(
     request: Request,
     offset: int = 0,
-    limit: int = Query(default=100, le=100),
-    session: Session = Depends(get_session)
+    limit: int = Query(default=100, ge=1, le=100),
+    cursor: Optional[str] = None,
+    session: AsyncSession = Depends(get_async_read_session)
 ):
+    # Seeking past the cursor's id stays on the primary key index, where
+    # a large offset would walk every row before it.
+    users, next_cursor = paginate((await session.exec(
+        select(TodoUser).where(
+            TodoUser.id > decode_cursor(cursor)
+        ).order_by(TodoUser.id).offset(offset).limit(limit + 1)
+    )).all(), limit)
     return {
-        "users": session.exec(
-            select(TodoUser).offset(offset).limit(limit)
-        ).all()
+        "users": users,
+        "next_cursor": next_cursor,
     }
 
 
@@ -138,20 +196,111 @@ def read_users(
     tags=["User operations"],
 )
 @limiter.limit("120/minute")
-def read_user(
+async def read_user(
     request: Request,
     user_name: Annotated[str, Path(title="username")],
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_read_session)
 ):
-    user = session.exec(select(TodoUser).where(
-        TodoUser.name == user_name)
-    ).first()
+    if_none_match = request.headers.get("if-none-match")
+    # Frontends poll this after every change, most reads are hits and
+    # never check out a connection.
+    cached = user_cache.get(user_name)
+    if cached:
+        if etag_matches(if_none_match, [cached.etag]):
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers={"ETag": cached.etag},
+            )
+        return Response(
+            cached.payload,
+            media_type="application/json",
+            headers={"ETag": cached.etag},
+        )
+    generation = user_cache.generation
+    if if_none_match:
+        # One indexed lookup, the todos are only loaded if they changed.
+        current = (await session.exec(
+            select(TodoUser.id, TodoUser.version).where(
+                TodoUser.name == user_name
+            )
+        )).first()
+        if current and etag_matches(if_none_match, [version_etag(*current)]):
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers={"ETag": version_etag(*current)},
+            )
+    # Join the todos in, so the whole list costs one round-trip.
+    user = (await session.exec(select(TodoUser).where(
+        TodoUser.name == user_name
+    ).options(joinedload(TodoUser.todos)))).unique().first()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"User {user_name} doesn't exist."
         )
-    return user
+    payload = TodoUserReadWithItems.model_validate(
+        user
+    ).model_dump_json().encode()
+    etag = version_etag(user.id, user.version)
+    # A lagging replica's list would be served for the whole TTL, after
+    # the invalidation it missed.
+    if not served_by_replica(session):
+        user_cache.put(user_name, user.id, payload, etag, generation)
+    return Response(
+        payload,
+        media_type="application/json",
+        headers={"ETag": etag},
+    )
+
+
+async def user_id_or_404(session: AsyncSession, user_name: str) -> int:
+    user_id = (await session.exec(
+        select(TodoUser.id).where(TodoUser.name == user_name)
+    )).first()
+    if not user_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"User {user_name} doesn't exist."
+        )
+    return user_id
+
+
+@app.get(
+    "/users/{user_name}/events",
+    tags=["User operations"],
+    summary="Stream User Changes.",
+    description=(
+        "Server-sent events for every change to a User's Todos, instead "
+        "of polling. `resync` means events were missed, reload the User."
+    ),
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}}},
+)
+@limiter.limit("30/minute")
+async def stream_user_events(
+    request: Request,
+    user_name: Annotated[str, Path(title="username")],
+    session: AsyncSession = Depends(get_async_read_session)
+):
+    # The session is closed before the stream starts.
+    return event_stream(f"todo:{await user_id_or_404(session, user_name)}")
+
+
+@app.websocket("/users/{user_name}/events")
+async def websocket_user_events(
+    websocket: WebSocket,
+    user_name: Annotated[str, Path(title="username")],
+    session: AsyncSession = Depends(get_async_read_session)
+):
+    try:
+        user_id = await user_id_or_404(session, user_name)
+    except HTTPException:
+        await websocket.close()
+        return
+    # Dependencies of a websocket live as long as it does, don't hold
+    # on to a connection for that long.
+    await session.close()
+    await websocket_stream(websocket, f"todo:{user_id}")
 
 
 @app.post(
@@ -161,54 +310,182 @@ def read_user(
     tags=["Todo operations"],
 )
 @limiter.limit("60/minute")
-def create_user_todo(
+async def create_user_todo(
     request: Request,
     user_name: Annotated[str, Path(title="username")],
     todo_item: TodoItemCreate,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
-    user = session.exec(select(TodoUser).where(
-        TodoUser.name == user_name)
-    ).first()
-    if not user:
+    # INSERT ... SELECT, so a missing user just inserts nothing.
+    db_todo = (await session.exec(
+        insert(session, TodoItem).from_select(
+            ["label", "is_done", "user_id"],
+            select(
+                literal(todo_item.label),
+                literal(todo_item.is_done),
+                TodoUser.id,
+            ).where(TodoUser.name == user_name)
+        ).returning(TodoItem)
+    )).scalar_one_or_none()
+    if not db_todo:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"""User "{user_name}" doesn't exist."""
         )
-    db_todo = TodoItem.model_validate({
-        **todo_item.model_dump(),
-        "user_id": user.id
-    })
-    session.add(db_todo)
-    session.commit()
-    session.refresh(db_todo)
+    await session.commit()
+    user_cache.invalidate(names=[user_name])
+    publish(
+        db_todo.user_id, "todo.created",
+        todo=TodoItemRead.model_validate(db_todo).model_dump(),
+    )
     return db_todo
 
 
+@app.post(
+    "/todos/{user_name}/bulk",
+    response_model=TodoItemList,
+    status_code=status.HTTP_201_CREATED,
+    tags=["Todo operations"],
+    summary="Create User Todos.",
+    description=f"Creates up to {BULK_LIMIT} Todos for a User at once.",
+)
+@limiter.limit("15/minute")
+async def create_user_todos(
+    request: Request,
+    user_name: Annotated[str, Path(title="username")],
+    todo_items: Annotated[
+        List[TodoItemCreate], Body(max_length=BULK_LIMIT)
+    ],
+    session: AsyncSession = Depends(get_async_session)
+):
+    user_id = (await session.exec(
+        select(TodoUser.id).where(TodoUser.name == user_name)
+    )).first()
+    if not user_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"""User "{user_name}" doesn't exist."""
+        )
+    if not todo_items:
+        return TodoItemList(todos=[])
+    # A single executemany, which SQLAlchemy sends as multi-row INSERTs.
+    # Asking it to keep the parameter order would make SQLite fall back to
+    # one INSERT per row, the ids give that order back anyway.
+    todos = (await session.exec(
+        insert(session, TodoItem).returning(TodoItem),
+        params=[
+            {**todo_item.model_dump(), "user_id": user_id}
+            for todo_item in todo_items
+        ]
+    )).scalars().all()
+    await session.commit()
+    user_cache.invalidate(names=[user_name])
+    todos = sorted(todos, key=lambda todo: todo.id)
+    publish(
+        user_id, "todos.created",
+        todos=[
+            TodoItemRead.model_validate(todo).model_dump() for todo in todos
+        ],
+    )
+    return TodoItemList(todos=todos)
+
+
+@app.patch(
+    "/todos/bulk",
+    response_model=TodoItemList,
+    tags=["Todo operations"],
+    summary="Update Todos.",
+    description=f"Updates up to {BULK_LIMIT} Todos at once, by id.",
+)
+@limiter.limit("15/minute")
+async def update_user_todos(
+    request: Request,
+    todo_data: Annotated[
+        List[TodoItemBulkUpdate], Body(max_length=BULK_LIMIT)
+    ],
+    session: AsyncSession = Depends(get_async_session)
+):
+    ids = [todo.id for todo in todo_data]
+    values = [
+        todo.model_dump(exclude_none=True)
+        for todo in todo_data
+    ]
+    # Ids alone have nothing to SET.
+    values = [todo for todo in values if len(todo) > 1]
+    found = select(TodoItem).where(TodoItem.id.in_(ids))
+    try:
+        if values:
+            await session.exec(update(TodoItem), params=values)
+        todos = (await session.exec(
+            found.execution_options(populate_existing=True)
+        )).all()
+    except StaleDataError:
+        # Some ids matched no row, roll back and find out which.
+        await session.rollback()
+        todos = (await session.exec(found)).all()
+    missing = set(ids) - {todo.id for todo in todos}
+    if missing:
+        await session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Todos {sorted(missing)} don't exist."
+        )
+    await session.commit()
+    user_cache.invalidate(user_ids={todo.user_id for todo in todos})
+    by_user = {}
+    for todo in todos:
+        by_user.setdefault(todo.user_id, []).append(
+            TodoItemRead.model_validate(todo).model_dump()
+        )
+    for user_id, updated in by_user.items():
+        publish(user_id, "todos.updated", todos=updated)
+    by_id = {todo.id: todo for todo in todos}
+    return TodoItemList(
+        todos=[by_id[todo_id] for todo_id in dict.fromkeys(ids)]
+    )
+
+
 @app.put(
     "/todos/{todo_id}",
     response_model=TodoItemRead,
     tags=["Todo operations"],
 )
 @limiter.limit("120/minute")
-def update_user_todo(
+async def update_user_todo(
     request: Request,
     todo_id: Annotated[int, Path(title="username")],
     todo_data: TodoItemUpdate,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
-    todo = session.get(TodoItem, todo_id)
+    versions = if_match_versions(request.headers.get("if-match"))
+    values = todo_data.model_dump(exclude_none=True)
+    if values:
+        todo = (await session.exec(
+            update(TodoItem).where(
+                TodoItem.id == todo_id,
+                *owned_at_versions(versions),
+            ).values(**values).returning(TodoItem)
+        )).scalar_one_or_none()
+    elif versions is None:
+        todo = await session.get(TodoItem, todo_id)
+    else:
+        todo = (await session.exec(select(TodoItem).where(
+            TodoItem.id == todo_id,
+            *owned_at_versions(versions),
+        ))).first()
     if not todo:
+        if versions is not None and await session.get(TodoItem, todo_id):
+            raise todo_changed(todo_id)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Todo #{todo_id} doesn't exist."
         )
-    for k, v in todo_data:
-        if v is not None:
-            setattr(todo, k, v)
-    session.add(todo)
-    session.commit()
-    session.refresh(todo)
+    await session.commit()
+    user_cache.invalidate(user_ids=[todo.user_id])
+    publish(
+        todo.user_id, "todo.updated",
+        todo=TodoItemRead.model_validate(todo).model_dump(),
+    )
     return todo
 
 
@@ -217,19 +494,28 @@ def update_user_todo(
     tags=["Todo operations"],
 )
 @limiter.limit("120/minute")
-def delete_user_todo(
+async def delete_user_todo(
     request: Request,
     todo_id: Annotated[int, Path(title="todo id")],
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
-    todo = session.get(TodoItem, todo_id)
-    if not todo:
+    versions = if_match_versions(request.headers.get("if-match"))
+    user_id = (await session.exec(
+        delete(TodoItem).where(
+            TodoItem.id == todo_id,
+            *owned_at_versions(versions),
+        ).returning(TodoItem.user_id)
+    )).scalar_one_or_none()
+    if not user_id:
+        if versions is not None and await session.get(TodoItem, todo_id):
+            raise todo_changed(todo_id)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Todo #{todo_id} doesn't exist."
         )
-    session.delete(todo)
-    session.commit()
+    await session.commit()
+    user_cache.invalidate(user_ids=[user_id])
+    publish(user_id, "todo.deleted", id=todo_id)
     return Response(
         status_code=status.HTTP_204_NO_CONTENT
     )
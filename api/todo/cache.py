@@ -0,0 +1,331 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import anyio
+
+from api.metrics import Counter, Gauge, Histogram
+
+# Users whose todo lists are kept serialized in memory.
+TODO_CACHE_SIZE = int(os.getenv("TODO_CACHE_SIZE", 1024))
+# Seconds a cached list is served before it's read again. Writes through
+# this worker invalidate it right away, this bounds everything else.
+TODO_CACHE_TTL = float(os.getenv("TODO_CACHE_TTL", 30))
+# Where workers tell each other about writes, unset keeps it per worker.
+TODO_CACHE_CHANNEL_URL = os.getenv("TODO_CACHE_CHANNEL_URL", "")
+# Seconds between checks of a polled channel.
+TODO_CACHE_CHANNEL_POLL = float(os.getenv("TODO_CACHE_CHANNEL_POLL", 0.5))
+
+logger = logging.getLogger(__name__)
+
+cache_hits = Counter(
+    "todo_user_cache_hits_total",
+    "Todo list reads served from memory.",
+)
+cache_misses = Counter(
+    "todo_user_cache_misses_total",
+    "Todo list reads that went to the database.",
+)
+cache_invalidations = Counter(
+    "todo_user_cache_invalidations_total",
+    "Cached todo lists dropped, by where the write came from.",
+)
+cache_entries = Gauge(
+    "todo_user_cache_entries",
+    "Todo lists held in memory.",
+)
+cache_age = Histogram(
+    "todo_user_cache_age_seconds",
+    "Age of the cached todo lists served, how stale a hit can be.",
+    (.1, .5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+
+
+class Entry(NamedTuple):
+    payload: bytes
+    etag: str
+    user_id: int
+    stored_at: float
+
+
+class UserCache:
+    """A bounded LRU of serialized todo lists, keyed by user name.
+
+    Entries also expire after `ttl`, which bounds staleness from writes
+    this worker never hears about. Writes made between a miss and its
+    fill bump `generation`, and the stale fill is dropped.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = TODO_CACHE_SIZE,
+        ttl: float = TODO_CACHE_TTL,
+        name: str = "users",
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.name = name
+        self.entries: OrderedDict[str, Entry] = OrderedDict()
+        self.names: Dict[int, str] = {}
+        self.generation = 0
+        self.channel: Optional["Channel"] = None
+        cache_entries.watch(lambda: len(self.entries), cache=name)
+
+    def get(self, name: str) -> Optional[Entry]:
+        entry = self.entries.get(name)
+        if entry:
+            age = time.monotonic() - entry.stored_at
+            if age < self.ttl:
+                self.entries.move_to_end(name)
+                cache_hits.inc(cache=self.name)
+                cache_age.observe(age, cache=self.name)
+                return entry
+            self.drop(name)
+        cache_misses.inc(cache=self.name)
+        return None
+
+    def put(
+        self,
+        name: str,
+        user_id: int,
+        payload: bytes,
+        etag: str,
+        generation: int,
+    ):
+        if generation != self.generation or self.max_entries <= 0:
+            return
+        self.drop(name)
+        self.entries[name] = Entry(payload, etag, user_id, time.monotonic())
+        self.names[user_id] = name
+        while len(self.entries) > self.max_entries:
+            self.drop(next(iter(self.entries)))
+
+    def drop(self, name: str) -> bool:
+        entry = self.entries.pop(name, None)
+        if entry:
+            self.names.pop(entry.user_id, None)
+        return entry is not None
+
+    def invalidate(
+        self,
+        names: Iterable[str] = (),
+        user_ids: Iterable[int] = (),
+        source: str = "local",
+    ):
+        """Drops the lists of users that were written to.
+
+        Other workers are told about the ids as well as the names, as
+        they may have cached a user this worker can't name.
+        """
+        names, user_ids = set(names), set(user_ids)
+        self.generation += 1
+        for name in names | {
+            self.names[user_id] for user_id in user_ids
+            if user_id in self.names
+        }:
+            if self.drop(name):
+                cache_invalidations.inc(cache=self.name, source=source)
+        if self.channel and source == "local" and (names or user_ids):
+            self.channel.publish(names, user_ids)
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+        self.names.clear()
+
+
+class Channel:
+    """Carries invalidated user names and ids between workers."""
+
+    def __init__(self, cache: UserCache):
+        self.cache = cache
+        self.task: Optional[asyncio.Task] = None
+        self.pending: List[Tuple[List[str], List[int]]] = []
+        self.sending: Optional[asyncio.Task] = None
+
+    def publish(self, names: Iterable[str], user_ids: Iterable[int]):
+        """Queues invalidations, sent in the background.
+
+        A write shouldn't wait on other workers, let alone on a lock
+        they hold. Whatever queues up while sending goes out together.
+        """
+        self.pending.append((list(names), list(user_ids)))
+        if not self.sending:
+            self.sending = asyncio.get_running_loop().create_task(
+                self.flush()
+            )
+
+    async def flush(self):
+        try:
+            while self.pending:
+                pending, self.pending = self.pending, []
+                names = {name for names, _ in pending for name in names}
+                user_ids = {
+                    user_id for _, user_ids in pending for user_id in user_ids
+                }
+                try:
+                    await self.send(names, user_ids)
+                except Exception:
+                    logger.exception("Couldn't send todo cache invalidations.")
+        finally:
+            self.sending = None
+
+    async def send(self, names: Iterable[str], user_ids: Iterable[int]):
+        raise NotImplementedError
+
+    async def listen(self):
+        raise NotImplementedError
+
+    async def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.sending:
+            await self.sending
+
+
+class SQLiteChannel(Channel):
+    """An append-only log in a SQLite file, for workers on one host.
+
+    Each worker polls for rows past the last one it saw; rows older than
+    the cache's TTL can't matter to anyone and are pruned.
+    """
+
+    def __init__(
+        self,
+        cache: UserCache,
+        path: str,
+        poll: float = TODO_CACHE_CHANNEL_POLL,
+    ):
+        super().__init__(cache)
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=5
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # Each row names a user or gives their id, not both.
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS todo_cache_invalidations ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " name TEXT,"
+            " user_id INTEGER,"
+            " at REAL NOT NULL"
+            ")"
+        )
+        self.published = set()
+        self.last_id, = self.connection.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM todo_cache_invalidations"
+        ).fetchone()
+
+    async def send(self, names: Iterable[str], user_ids: Iterable[int]):
+        await anyio.to_thread.run_sync(self.write, names, user_ids)
+
+    def write(self, names: Iterable[str], user_ids: Iterable[int]):
+        now = time.time()
+        rows = [(name, None) for name in names]
+        rows += [(None, user_id) for user_id in user_ids]
+        with self.lock:
+            for name, user_id in rows:
+                # Our own rows come back when polling, no need to drop twice.
+                self.published.add(self.connection.execute(
+                    "INSERT INTO todo_cache_invalidations (name, user_id, at)"
+                    " VALUES (?, ?, ?)",
+                    (name, user_id, now),
+                ).lastrowid)
+
+    def receive(self) -> Tuple[List[str], List[int]]:
+        """Names and ids invalidated by other workers since the last call."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, name, user_id FROM todo_cache_invalidations"
+                " WHERE id > ? ORDER BY id",
+                (self.last_id,),
+            ).fetchall()
+            if not rows:
+                return [], []
+            self.last_id = rows[-1][0]
+            theirs = [row for row in rows if row[0] not in self.published]
+            self.published.difference_update(row[0] for row in rows)
+            self.connection.execute(
+                "DELETE FROM todo_cache_invalidations WHERE at < ?",
+                (time.time() - self.cache.ttl - 60,),
+            )
+        return (
+            [name for _, name, _ in theirs if name is not None],
+            [user_id for _, _, user_id in theirs if user_id is not None],
+        )
+
+    async def listen(self):
+        while True:
+            await asyncio.sleep(self.poll)
+            try:
+                names, user_ids = await anyio.to_thread.run_sync(self.receive)
+                if names or user_ids:
+                    self.cache.invalidate(names, user_ids, source="channel")
+            except Exception:
+                logger.exception("Couldn't read todo cache invalidations.")
+
+
+class RedisChannel(Channel):
+    """Redis pub/sub, for workers on any number of hosts."""
+
+    # Renamed along with the message format, old workers ignore it.
+    key = "todo-cache:invalidations"
+
+    def __init__(self, cache: UserCache, url: str):
+        super().__init__(cache)
+        # Only needed when invalidations go through Redis.
+        import redis.asyncio
+        self.client = redis.asyncio.Redis.from_url(url)
+        self.sender = os.urandom(8).hex()
+
+    async def send(self, names: Iterable[str], user_ids: Iterable[int]):
+        await self.client.publish(
+            self.key, json.dumps({
+                "sender": self.sender,
+                "names": list(names),
+                "user_ids": list(user_ids),
+            })
+        )
+
+    async def listen(self):
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(self.key)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                data = json.loads(message["data"])
+                if data["sender"] != self.sender:
+                    self.cache.invalidate(
+                        data["names"], data["user_ids"], source="channel"
+                    )
+        finally:
+            await pubsub.aclose()
+
+
+def channel_from_url(cache: UserCache, url: str) -> Optional[Channel]:
+    """`sqlite:///path/to/file` or `redis://host:port/db`, if any."""
+    if not url:
+        return None
+    if url.startswith("sqlite:///"):
+        return SQLiteChannel(cache, url.removeprefix("sqlite:///"))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisChannel(cache, url)
+    raise ValueError(f"Unknown todo cache channel {url!r}.")
+
+
+user_cache = UserCache()
+user_cache.channel = channel_from_url(user_cache, TODO_CACHE_CHANNEL_URL)
@@ -1,10 +1,13 @@
 from typing import List, Optional
 
+from sqlalchemy import ForeignKey
 from sqlmodel import (
     SQLModel, Field, Relationship,
 )
 from pydantic import BaseModel
 
+from api.versions import bump_version_on_change
+
 
 class TodoUserBase(SQLModel):
     name: str = Field(
@@ -18,9 +21,19 @@ class TodoUser(TodoUserBase, table=True):
         default=None,
         primary_key=True,
     )
+    # Bumped by the database whenever one of its todos changes, and
+    # served as the ETag of its lists.
+    version: int = Field(
+        default=0,
+        sa_column_kwargs={"server_default": "0"},
+    )
+    # The database deletes a user's todos, see `TodoItem.user_id`.
     todos: List["TodoItem"] = Relationship(
         back_populates="user",
-        sa_relationship_kwargs={"cascade": "delete"}
+        sa_relationship_kwargs={
+            "cascade": "delete",
+            "passive_deletes": True,
+        }
     )
 
 
@@ -45,11 +58,15 @@ class TodoItem(TodoItemBase, table=True):
     )
     label: str
     user_id: int = Field(
-        foreign_key="todouser.id"
+        index=True,
+        sa_column_args=[ForeignKey("todouser.id", ondelete="CASCADE")],
     )
     user: Optional["TodoUser"] = Relationship(back_populates="todos")
 
 
+bump_version_on_change(TodoItem.__table__, "user_id", "todouser")
+
+
 class TodoItemCreate(TodoItemBase):
     pass
 
@@ -65,6 +82,10 @@ class TodoItemUpdate(TodoItemBase):
     is_done: Optional[bool] = None
 
 
+class TodoItemBulkUpdate(TodoItemUpdate):
+    id: int
+
+
 # Models with relationships
 
 class TodoUserReadWithItems(TodoUserBase):
@@ -75,7 +96,8 @@ class TodoUserReadWithItems(TodoUserBase):
 
 class TodoUserList(BaseModel):
     users: List[TodoUserRead]
+    next_cursor: Optional[str] = None
 
 
 class TodoItemList(BaseModel):
-    todos: List[TodoItem]
+    todos: List[TodoItemRead]
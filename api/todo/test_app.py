@@ -1,39 +1,91 @@
+import asyncio
+import threading
+
 import pytest
 from fastapi.testclient import TestClient
 from sqlmodel import (
     Session, SQLModel, create_engine, select
 )
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.pool import StaticPool
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from api.db import get_session
+import api.db
+from api.db import (
+    ReadReplicas, async_url, get_async_session, get_async_read_session,
+    use_sqlite_profile,
+)
+from api.pagination import encode_cursor
 from api.todo.app import app
+from api.todo.cache import SQLiteChannel, UserCache, user_cache
 from api.todo.models import (
     TodoUser, TodoItem
 )
 
 
+@pytest.fixture(name="db_url")
+def db_url_fixture(tmp_path):
+    # The app and the test talk to the same database through different
+    # drivers, so it has to live in a file instead of in memory.
+    return f"sqlite:///{tmp_path / 'test.sqlite'}"
+
+
 @pytest.fixture(name="session")
-def session_fixture():
+def session_fixture(db_url: str):
     engine = create_engine(
-        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+        db_url, connect_args={"check_same_thread": False}, poolclass=StaticPool
     )
     SQLModel.metadata.create_all(engine)
     with Session(engine) as session:
         yield session
 
 
-@pytest.fixture(name="client")
-def client_fixture(session: Session):
-    def get_session_override():
-        return session
+@pytest.fixture(name="async_engine")
+def async_engine_fixture(db_url: str):
+    async_engine = create_async_engine(async_url(db_url), poolclass=StaticPool)
+    use_sqlite_profile(async_engine)
+    yield async_engine
+    asyncio.run(async_engine.dispose())
 
-    app.dependency_overrides[get_session] = get_session_override
-    client = TestClient(app)
-    yield client
+
+@pytest.fixture(name="client")
+def client_fixture(session: Session, async_engine):
+    async def get_async_session_override():
+        async with AsyncSession(
+            async_engine, expire_on_commit=False
+        ) as async_session:
+            yield async_session
+        # The app committed through its own connection, make the test
+        # session reload instead of trusting its identity map.
+        session.expunge_all()
+
+    app.dependency_overrides[get_async_session] = get_async_session_override
+    app.dependency_overrides[get_async_read_session] = get_async_session_override
+    # Every test starts on a fresh database, with names used before.
+    user_cache.clear()
+    with TestClient(app) as client:
+        yield client
     app.dependency_overrides.clear()
 
 
-def test_create_user(client: TestClient):
+@pytest.fixture(name="queries")
+def queries_fixture(async_engine):
+    queries = []
+
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(
+        async_engine.sync_engine, "before_cursor_execute", record_query
+    )
+    yield queries
+    event.remove(
+        async_engine.sync_engine, "before_cursor_execute", record_query
+    )
+
+
+def test_create_user(client: TestClient, queries: list):
     response = client.post(
         "/users/grizelle"
     )
@@ -42,6 +94,13 @@ def test_create_user(client: TestClient):
     assert response.status_code == 201
     assert data["name"] == "grizelle"
     assert data["id"] is not None
+    assert len(queries) == 1
+
+    response = client.post(
+        "/users/grizelle"
+    )
+
+    assert response.status_code == 400
 
 
 def test_get_users(session: Session, client: TestClient):
@@ -65,7 +124,7 @@ def test_get_users(session: Session, client: TestClient):
     assert "sombra" in [user["name"] for user in data["users"]]
 
 
-def test_post_todos(session: Session, client: TestClient):
+def test_post_todos(session: Session, client: TestClient, queries: list):
     sombra = TodoUser(name="sombra")
     session.add(sombra)
     session.commit()
@@ -84,6 +143,7 @@ def test_post_todos(session: Session, client: TestClient):
     ).first()
 
     assert resp.status_code == 201
+    assert len(queries) == 1
     assert len(sombra.todos) == 1
     assert data["label"] == "Meow for food at 6 AM"
     assert data["is_done"] == True
@@ -147,7 +207,7 @@ def test_delete_todos(session: Session, client: TestClient):
     assert todo is None
 
 
-def test_delete_user(session: Session, client: TestClient):
+def test_delete_user(session: Session, client: TestClient, queries: list):
     sombra = TodoUser(name="sombra")
     session.add(sombra)
     session.commit()
@@ -176,15 +236,401 @@ def test_delete_user(session: Session, client: TestClient):
     session.refresh(todo)
     session.refresh(grizelle)
 
+    sombra_id = sombra.id
     resp = client.delete(
         "/users/sombra"
     )
 
-    sombra = session.get(TodoUser, sombra.id)
+    sombra = session.get(TodoUser, sombra_id)
     todos = session.exec(select(TodoItem)).all()
     users = session.exec(select(TodoUser)).all()
 
     assert resp.status_code == 204
+    assert len(queries) == 1
     assert sombra is None
     assert len(todos) == 1
     assert len(users) == 1
+
+
+def test_get_user(session: Session, client: TestClient, queries: list):
+    sombra = TodoUser(name="sombra")
+    session.add(sombra)
+    session.commit()
+    session.refresh(sombra)
+    session.add(TodoItem(label="Nap", user_id=sombra.id))
+    session.add(TodoItem(label="Knock things over", user_id=sombra.id))
+    session.commit()
+
+    resp = client.get(
+        "/users/sombra"
+    )
+    data = resp.json()
+
+    assert resp.status_code == 200
+    assert data["name"] == "sombra"
+    assert len(data["todos"]) == 2
+    assert len(queries) == 1
+    assert "Nap" in [todo["label"] for todo in data["todos"]]
+
+    resp = client.get(
+        "/users/grizelle"
+    )
+
+    assert resp.status_code == 404
+
+
+def test_post_todos_missing_user(client: TestClient):
+    resp = client.post(
+        "/todos/sombra",
+        json={
+            "label": "Meow for food at 6 AM",
+        }
+    )
+
+    assert resp.status_code == 404
+
+
+def test_post_todos_bulk(session: Session, client: TestClient, queries: list):
+    sombra = TodoUser(name="sombra")
+    session.add(sombra)
+    session.commit()
+
+    resp = client.post(
+        "/todos/sombra/bulk",
+        json=[
+            {"label": f"Nap #{i}", "is_done": i % 2 == 0}
+            for i in range(500)
+        ]
+    )
+    data = resp.json()
+
+    sombra = session.exec(select(TodoUser).where(
+        TodoUser.name == "sombra")
+    ).first()
+
+    assert resp.status_code == 201
+    assert len(data["todos"]) == 500
+    assert [todo["label"] for todo in data["todos"]] == [
+        f"Nap #{i}" for i in range(500)
+    ]
+    assert all(todo["id"] is not None for todo in data["todos"])
+    assert len(sombra.todos) == 500
+    # The user lookup, then one multi-row INSERT.
+    assert len(queries) == 2
+
+    resp = client.post(
+        "/todos/grizelle/bulk",
+        json=[{"label": "Nap"}]
+    )
+
+    assert resp.status_code == 404
+
+
+def test_patch_todos_bulk(session: Session, client: TestClient):
+    sombra = TodoUser(name="sombra")
+    session.add(sombra)
+    session.commit()
+    session.refresh(sombra)
+    todos = [
+        TodoItem(label=f"Nap #{i}", is_done=False, user_id=sombra.id)
+        for i in range(3)
+    ]
+    for todo in todos:
+        session.add(todo)
+    session.commit()
+    ids = [todo.id for todo in todos]
+
+    resp = client.patch(
+        "/todos/bulk",
+        json=[
+            {"id": ids[0], "is_done": True},
+            {"id": ids[1], "label": "Knock things over"},
+            {"id": ids[2]},
+        ]
+    )
+    data = resp.json()
+
+    assert resp.status_code == 200
+    assert [todo["id"] for todo in data["todos"]] == ids
+    assert data["todos"][0]["is_done"] == True
+    assert data["todos"][0]["label"] == "Nap #0"
+    assert data["todos"][1]["label"] == "Knock things over"
+    assert data["todos"][1]["is_done"] == False
+    assert data["todos"][2]["label"] == "Nap #2"
+
+    resp = client.patch(
+        "/todos/bulk",
+        json=[
+            {"id": ids[0], "label": "Never mind"},
+            {"id": ids[2] + 1, "label": "Ghost"},
+        ]
+    )
+
+    assert resp.status_code == 404
+    assert session.get(TodoItem, ids[0]).label == "Nap #0"
+
+
+def test_get_users_cursor(session: Session, client: TestClient):
+    for i in range(5):
+        session.add(TodoUser(name=f"cat{i}"))
+    session.commit()
+
+    names, cursor = [], None
+    while True:
+        resp = client.get(
+            "/users",
+            params={"limit": 2, **({"cursor": cursor} if cursor else {})}
+        )
+        data = resp.json()
+        assert resp.status_code == 200
+        names += [user["name"] for user in data["users"]]
+        cursor = data["next_cursor"]
+        if not cursor:
+            break
+
+    assert names == [f"cat{i}" for i in range(5)]
+
+    resp = client.get(
+        "/users?offset=4&limit=2"
+    )
+
+    assert [user["name"] for user in resp.json()["users"]] == ["cat4"]
+    assert resp.json()["next_cursor"] is None
+
+    resp = client.get(
+        "/users?cursor=grizelle"
+    )
+
+    assert resp.status_code == 400
+
+    for last_id in (-1, 2 ** 63, 10 ** 20):
+        resp = client.get(
+            "/users", params={"cursor": encode_cursor(last_id)}
+        )
+
+        assert resp.status_code == 400
+        assert resp.json()["detail"] == "Invalid cursor."
+
+
+def test_get_user_cached(client: TestClient, queries: list):
+    client.post("/users/sombra")
+    todo = client.post(
+        "/todos/sombra", json={"label": "Nap", "is_done": False}
+    ).json()
+
+    first = client.get("/users/sombra")
+    queries.clear()
+    second = client.get("/users/sombra")
+
+    assert second.status_code == 200
+    assert second.json() == first.json()
+    assert queries == []
+
+    client.put(f"/todos/{todo['id']}", json={"is_done": True})
+    assert client.get("/users/sombra").json()["todos"][0]["is_done"] is True
+
+    client.patch("/todos/bulk", json=[{"id": todo["id"], "label": "Naps"}])
+    assert client.get("/users/sombra").json()["todos"][0]["label"] == "Naps"
+
+    client.post("/todos/sombra/bulk", json=[{"label": "Eat"}])
+    assert len(client.get("/users/sombra").json()["todos"]) == 2
+
+    client.delete(f"/todos/{todo['id']}")
+    assert [
+        todo["label"] for todo in client.get("/users/sombra").json()["todos"]
+    ] == ["Eat"]
+
+    client.delete("/users/sombra")
+    assert client.get("/users/sombra").status_code == 404
+
+
+def test_user_cache():
+    cache = UserCache(max_entries=2, ttl=60, name="test")
+
+    cache.put("a", 1, b"a", '"1.0"', cache.generation)
+    cache.put("b", 2, b"b", '"2.0"', cache.generation)
+    assert cache.get("a").payload == b"a"
+    cache.put("c", 3, b"c", '"3.0"', cache.generation)
+    # "b" was the least recently used.
+    assert list(cache.entries) == ["a", "c"]
+
+    cache.invalidate(user_ids=[3])
+    assert cache.get("c") is None
+
+    # A write between the miss and the fill keeps the stale fill out.
+    generation = cache.generation
+    cache.invalidate(names=["d"])
+    cache.put("d", 4, b"stale", '"4.0"', generation)
+    assert cache.get("d") is None
+
+    cache.ttl = 0
+    assert cache.get("a") is None
+
+
+def invalidate(cache: UserCache, **kwargs):
+    # From inside a loop, as handlers do, waiting for it to be sent.
+    async def run():
+        cache.invalidate(**kwargs)
+        await cache.channel.sending
+    asyncio.run(run())
+
+
+def test_sqlite_channel(tmp_path):
+    path = str(tmp_path / "channel.sqlite")
+    first, second = UserCache(name="first"), UserCache(name="second")
+    first.channel = SQLiteChannel(first, path)
+    second.channel = SQLiteChannel(second, path)
+    first.put("sombra", 1, b"{}", '"1.0"', first.generation)
+    second.put("sombra", 1, b"{}", '"1.0"', second.generation)
+
+    invalidate(first, names=["sombra"])
+
+    assert first.channel.receive() == ([], [])
+    assert second.channel.receive() == (["sombra"], [])
+    assert second.channel.receive() == ([], [])
+
+    # By id, from a worker that never cached the user.
+    second.put("sombra", 1, b"{}", '"1.1"', second.generation)
+    third = UserCache(name="third")
+    third.channel = SQLiteChannel(third, path)
+    first.channel.receive()
+    invalidate(third, user_ids=[1])
+
+    names, user_ids = second.channel.receive()
+    assert (names, user_ids) == ([], [1])
+    second.invalidate(names, user_ids, source="channel")
+    assert second.get("sombra") is None
+
+
+def test_sqlite_channel_publish_off_the_loop(tmp_path, monkeypatch):
+    cache = UserCache(name="first")
+    cache.channel = SQLiteChannel(cache, str(tmp_path / "channel.sqlite"))
+    written = []
+    write = cache.channel.write
+
+    def record_write(names, user_ids):
+        written.append((threading.get_ident(), set(names), set(user_ids)))
+        write(names, user_ids)
+    monkeypatch.setattr(cache.channel, "write", record_write)
+
+    async def run():
+        # Queued together while nothing has been sent yet.
+        cache.invalidate(names=["sombra"])
+        cache.invalidate(user_ids=[2])
+        await cache.channel.sending
+        return threading.get_ident()
+    loop_thread = asyncio.run(run())
+
+    assert len(written) == 1
+    thread, names, user_ids = written[0]
+    assert thread != loop_thread
+    assert (names, user_ids) == ({"sombra"}, {2})
+
+
+def test_get_user_from_replica_not_cached(
+    session: Session, client: TestClient, async_engine, monkeypatch
+):
+    # Another engine on the same file stands in for a replica.
+    replica = create_async_engine(async_engine.url)
+    monkeypatch.setattr(
+        api.db, "read_replicas", ReadReplicas([replica], async_engine)
+    )
+    del app.dependency_overrides[get_async_read_session]
+    client.post("/users/sombra")
+
+    assert client.get("/users/sombra").status_code == 200
+    assert user_cache.get("sombra") is None
+
+    asyncio.run(replica.dispose())
+
+
+def test_user_etags(client: TestClient, queries: list):
+    client.post("/users/sombra")
+    todo = client.post("/todos/sombra", json={"label": "Nap"}).json()
+
+    resp = client.get("/users/sombra")
+    etag = resp.headers["etag"]
+    user_cache.clear()
+    queries.clear()
+    resp = client.get("/users/sombra", headers={"If-None-Match": etag})
+
+    assert resp.status_code == 304
+    assert resp.headers["etag"] == etag
+    # Just the version, the todos weren't loaded.
+    assert len(queries) == 1
+    # And from the cache, the database isn't asked at all.
+    client.get("/users/sombra")
+    queries.clear()
+    assert client.get(
+        "/users/sombra", headers={"If-None-Match": etag}
+    ).status_code == 304
+    assert queries == []
+
+    # Writes bump the version, so stale If-Matches fail.
+    client.put(f"/todos/{todo['id']}", json={"is_done": True})
+    resp = client.put(
+        f"/todos/{todo['id']}", json={"label": "Naps"},
+        headers={"If-Match": etag},
+    )
+    assert resp.status_code == 412
+    assert client.delete(
+        f"/todos/{todo['id']}", headers={"If-Match": etag}
+    ).status_code == 412
+    assert client.delete(
+        "/users/sombra", headers={"If-Match": etag}
+    ).status_code == 412
+
+    resp = client.get("/users/sombra", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.json()["todos"][0]["is_done"] is True
+    etag = resp.headers["etag"]
+
+    resp = client.put(
+        f"/todos/{todo['id']}", json={"label": "Naps"},
+        headers={"If-Match": etag},
+    )
+    assert resp.status_code == 200
+    assert client.put(
+        "/todos/12345", json={"label": "Naps"}, headers={"If-Match": etag}
+    ).status_code == 404
+    etag = client.get("/users/sombra").headers["etag"]
+    assert client.delete(
+        "/users/sombra", headers={"If-Match": etag}
+    ).status_code == 204
+
+
+def test_user_events(client: TestClient):
+    client.post("/users/sombra")
+
+    with client.websocket_connect("/users/sombra/events") as websocket:
+        todo = client.post("/todos/sombra", json={"label": "Nap"}).json()
+        assert websocket.receive_json() == {
+            "type": "todo.created", "todo": todo
+        }
+
+        todos = client.post("/todos/sombra/bulk", json=[{"label": "Eat"}])
+        assert websocket.receive_json() == {
+            "type": "todos.created", "todos": todos.json()["todos"]
+        }
+
+        todo = client.put(
+            f"/todos/{todo['id']}", json={"is_done": True}
+        ).json()
+        assert websocket.receive_json() == {
+            "type": "todo.updated", "todo": todo
+        }
+
+        client.delete(f"/todos/{todo['id']}")
+        assert websocket.receive_json() == {
+            "type": "todo.deleted", "id": todo["id"]
+        }
+
+        client.delete("/users/sombra")
+        assert websocket.receive_json() == {"type": "user.deleted"}
+        # So clients know not to reconnect.
+        assert websocket.receive_json() == {"type": "closed"}
+        assert websocket.receive()["type"] == "websocket.close"
+
+
+def test_user_events_missing_user(client: TestClient):
+    assert client.get("/users/sombra/events").status_code == 404
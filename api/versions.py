@@ -0,0 +1,89 @@
+from typing import List, Optional, Tuple
+
+from sqlalchemy import DDL, Table, and_, event, false, or_, true
+
+# (parent id, version) pairs, as named by a request's If-Match.
+Versions = Optional[List[Tuple[int, int]]]
+
+
+def version_etag(id: int, version: int) -> str:
+    return f'"{id}.{version}"'
+
+
+def if_match_versions(if_match: Optional[str]) -> Versions:
+    """The versions an If-Match header names, None when any will do.
+
+    Weak and malformed tags are left out, so they never match.
+    """
+    if not if_match or if_match.strip() == "*":
+        return None
+    versions = []
+    for tag in if_match.split(","):
+        tag = tag.strip()
+        if not (tag.startswith('"') and tag.endswith('"')):
+            continue
+        id, _, version = tag[1:-1].partition(".")
+        if id.isdigit() and version.isdigit():
+            versions.append((int(id), int(version)))
+    return versions
+
+
+def at_versions(model, versions: Versions):
+    """A WHERE clause for rows of `model` still at one of `versions`."""
+    if versions is None:
+        return true()
+    if not versions:
+        return false()
+    return or_(*(
+        and_(model.id == id, model.version == version)
+        for id, version in versions
+    ))
+
+
+def version_triggers(child: str, column: str, parent: str) -> dict:
+    """Triggers bumping `parent.version` whenever a `child` row changes.
+
+    In the database, so bulk statements and cascades bump it too, and
+    writes don't need a second statement. Keyed by dialect name.
+    """
+    function = f"bump_{parent}_version_from_{child}"
+    bump = f"UPDATE {parent} SET version = version + 1 WHERE id"
+    return {
+        "sqlite": [
+            f"CREATE TRIGGER {child}_insert_bumps_{parent} "
+            f"AFTER INSERT ON {child} "
+            f"BEGIN {bump} = NEW.{column}; END",
+            f"CREATE TRIGGER {child}_update_bumps_{parent} "
+            f"AFTER UPDATE ON {child} "
+            f"BEGIN {bump} IN (OLD.{column}, NEW.{column}); END",
+            f"CREATE TRIGGER {child}_delete_bumps_{parent} "
+            f"AFTER DELETE ON {child} "
+            f"BEGIN {bump} = OLD.{column}; END",
+        ],
+        "postgresql": [
+            f"CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$ "
+            f"BEGIN "
+            f"IF TG_OP <> 'DELETE' THEN {bump} = NEW.{column}; END IF; "
+            f"IF TG_OP = 'DELETE' THEN {bump} = OLD.{column}; "
+            f"ELSIF TG_OP = 'UPDATE' THEN "
+            f"IF OLD.{column} <> NEW.{column} THEN {bump} = OLD.{column}; "
+            f"END IF; END IF; "
+            f"RETURN NULL; "
+            f"END $$ LANGUAGE plpgsql",
+            f"CREATE TRIGGER {child}_bumps_{parent} "
+            f"AFTER INSERT OR UPDATE OR DELETE ON {child} "
+            f"FOR EACH ROW EXECUTE FUNCTION {function}()",
+        ],
+    }
+
+
+def bump_version_on_change(child: Table, column: str, parent: str):
+    """Creates the version triggers along with `child`, see migrations too."""
+    for dialect, statements in version_triggers(
+        child.name, column, parent
+    ).items():
+        for statement in statements:
+            event.listen(
+                child, "after_create",
+                DDL(statement).execute_if(dialect=dialect),
+            )
@@ -0,0 +1,90 @@
+"""Thousands of idle event streams on one worker.
+
+Opens `--subscribers` streams through the same generator the SSE
+endpoints send, spread over `--topics` users, then publishes to them.
+Reports the memory each idle stream holds, how long a publish takes to
+reach every stream of a topic, and what a stream that stops reading
+costs once its buffer is full.
+
+    pipenv run python -m benchmarks.events_load --subscribers 10000
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from api.events import broker, event_stream
+
+
+async def read(stream, received, stalled=False):
+    async for chunk in stream.body_iterator:
+        if stalled:
+            # Connected, then never reads again.
+            await asyncio.Event().wait()
+        if chunk.startswith(b"event: "):
+            received.append(time.perf_counter())
+
+
+async def run(subscribers, topics, events):
+    broker.max_subscribers = subscribers + 1
+    received = []
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tasks = [
+        asyncio.create_task(read(event_stream(f"todo:{i % topics}"), received))
+        for i in range(subscribers)
+    ]
+    # Every stream sends its first comment and waits for events.
+    await asyncio.sleep(0.5)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    memory = sum(
+        stat.size_diff for stat in after.compare_to(before, "filename")
+    )
+
+    latencies = []
+    for i in range(events):
+        received.clear()
+        start = time.perf_counter()
+        broker.publish(f"todo:{i % topics}", {"type": "todo.deleted", "id": i})
+        while len(received) < subscribers // topics:
+            await asyncio.sleep(0)
+        latencies.append(max(received) - start)
+
+    stalled = asyncio.create_task(
+        read(event_stream("todo:stalled"), [], stalled=True)
+    )
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    for i in range(events * 100):
+        broker.publish("todo:stalled", {"type": "todo.deleted", "id": i})
+    stalled_publish = (time.perf_counter() - start) / (events * 100)
+
+    for task in (*tasks, stalled):
+        task.cancel()
+    await asyncio.gather(*tasks, stalled, return_exceptions=True)
+    return memory, sorted(latencies), stalled_publish
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subscribers", type=int, default=10000)
+    parser.add_argument("--topics", type=int, default=100)
+    parser.add_argument("--events", type=int, default=200)
+    args = parser.parse_args()
+
+    memory, latencies, stalled_publish = asyncio.run(
+        run(args.subscribers, args.topics, args.events)
+    )
+    print(f"idle streams          {args.subscribers:>10}")
+    print(f"memory per stream     {memory / args.subscribers / 1024:>9.1f}K")
+    print(
+        f"fan-out to {args.subscribers // args.topics:<6} p50 "
+        f"{latencies[len(latencies) // 2] * 1000:>7.2f}ms"
+    )
+    print(
+        f"{'':<17} p99 "
+        f"{latencies[int(len(latencies) * .99)] * 1000:>7.2f}ms"
+    )
+    print(f"publish, stalled      {stalled_publish * 1e6:>8.2f}us")
@@ -0,0 +1,97 @@
+"""Seek-heavy audio playback against StaticFiles and AudioFiles.
+
+Each listener starts a file, seeks around it a few times, then replays
+it with the ETag from the first play, the way an `<audio>` element does.
+
+    pipenv run python -m benchmarks.sound_seek --listeners 64
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import httpx
+from fastapi import FastAPI
+from fastapi.staticfiles import StaticFiles
+
+from api.sound.files import AudioFiles
+
+DIRECTORY = "api/sound/files"
+# Browsers ask for the rest of the file from wherever the user seeks to.
+SEEKS = 8
+
+
+def make_app(files) -> FastAPI:
+    app = FastAPI()
+    app.mount("/files", files)
+    return app
+
+
+def load_urls():
+    urls = []
+    for name in ("fx", "songs"):
+        with open(f"api/sound/data/{name}.json", "rt") as f:
+            urls += [
+                item["url"].removeprefix("/sound")
+                for item in json.load(f)
+            ]
+    return urls
+
+
+async def listen(client, url, sizes, stats):
+    resp = await client.get(url, headers={"Range": "bytes=0-"})
+    if resp.status_code not in (200, 206):
+        stats["errors"] += 1
+        return
+    stats["requests"] += 1
+    stats["bytes"] += len(resp.content)
+    size = sizes.setdefault(url, len(resp.content))
+    etag = resp.headers.get("etag")
+
+    for _ in range(SEEKS):
+        start = random.randrange(size)
+        resp = await client.get(url, headers={"Range": f"bytes={start}-"})
+        stats["requests"] += 1
+        stats["bytes"] += len(resp.content)
+
+    resp = await client.get(url, headers={"If-None-Match": etag or ""})
+    stats["requests"] += 1
+    stats["bytes"] += len(resp.content)
+
+
+async def run(app, urls, listeners):
+    stats = {"requests": 0, "bytes": 0, "errors": 0}
+    sizes = {}
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app),
+        base_url="http://bench",
+    ) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            listen(client, random.choice(urls), sizes, stats)
+            for _ in range(listeners)
+        ))
+        return time.perf_counter() - start, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--listeners", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    urls = load_urls()
+    servers = {
+        "StaticFiles": make_app(StaticFiles(directory=DIRECTORY)),
+        "AudioFiles": make_app(AudioFiles(directory=DIRECTORY)),
+    }
+
+    print(f"{'server':<14}{'req/s':>10}{'MB sent':>10}{'errors':>8}")
+    for name, app in servers.items():
+        random.seed(args.seed)
+        elapsed, stats = asyncio.run(run(app, urls, args.listeners))
+        print(
+            f"{name:<14}{stats['requests'] / elapsed:>10.0f}"
+            f"{stats['bytes'] / 1e6:>10.1f}{stats['errors']:>8}"
+        )
@@ -0,0 +1,105 @@
+"""Write throughput of the default and tuned SQLite profiles.
+
+Hammers `create_user_todo` and `create_agenda_contact` with concurrent
+requests against a throwaway database file for each profile.
+
+    pipenv run python -m benchmarks.sqlite_profile --requests 2000
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+
+import httpx
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from api.db import (
+    async_url, get_async_session,
+    sqlite_pool_options, use_sqlite_profile,
+)
+from api.contact.app import app as contact_app
+from api.todo.app import app as todo_app
+
+PROFILES = ("default", "tuned")
+
+TARGETS = {
+    "create_user_todo": (
+        todo_app, "/users/bench", "/todos/bench",
+        {"label": "Benchmark", "is_done": False},
+    ),
+    "create_agenda_contact": (
+        contact_app, "/agendas/bench", "/agendas/bench/contacts",
+        {"name": "Benchmark", "email": "bench@4geeks.com"},
+    ),
+}
+
+
+async def run(app, setup_url, url, payload, requests, concurrency):
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app, raise_app_exceptions=False),
+        base_url="http://bench",
+    ) as client:
+        await client.post(setup_url)
+        pending = iter(range(requests))
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            for _ in pending:
+                resp = await client.post(url, json=payload)
+                if resp.status_code != 201:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - start, errors
+
+
+def bench(profile, target, requests, concurrency):
+    app, setup_url, url, payload = TARGETS[target]
+    with tempfile.TemporaryDirectory() as tmp:
+        db_url = f"sqlite:///{tmp}/bench.sqlite"
+        SQLModel.metadata.create_all(create_engine(db_url))
+        async_engine = create_async_engine(
+            async_url(db_url),
+            **sqlite_pool_options(async_url(db_url), profile)
+        )
+        use_sqlite_profile(async_engine, profile)
+
+        async def get_async_session_override():
+            async with AsyncSession(
+                async_engine, expire_on_commit=False
+            ) as session:
+                yield session
+
+        app.dependency_overrides[get_async_session] = get_async_session_override
+        app.state.limiter.enabled = False
+        try:
+            elapsed, errors = asyncio.run(
+                run(app, setup_url, url, payload, requests, concurrency)
+            )
+        finally:
+            app.dependency_overrides.clear()
+            app.state.limiter.enabled = True
+            asyncio.run(async_engine.dispose())
+    return elapsed, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    print(f"{'path':<24}{'profile':<10}{'req/s':>10}{'errors':>8}")
+    for target in TARGETS:
+        for profile in PROFILES:
+            elapsed, errors = bench(
+                profile, target, args.requests, args.concurrency
+            )
+            print(
+                f"{target:<24}{profile:<10}"
+                f"{args.requests / elapsed:>10.0f}{errors:>8}"
+            )
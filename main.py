@@ -1,15 +1,17 @@
 import re
 
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.routing import Mount
 
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
+from api.ratelimit import RateLimitMiddleware, limiter
 
 import api
+import api.metrics
+from api.responses import (
+    CompressionMiddleware, PrecompressedContent, PrecompressedStaticFiles,
+)
 
 template = None
 with open("./static/index.html", "r") as f:
@@ -20,6 +22,9 @@ app = FastAPI(
     title="4Geeks Playground",
 )
 
+# Added before CORS so that 429s still carry the CORS headers. The
+# routes list is read when the middleware stack is built, mounts included.
+app.add_middleware(RateLimitMiddleware, routes=app.routes, limiter=limiter)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -27,6 +32,8 @@ app.add_middleware(
     allow_headers=['*'],
     allow_credentials=['*'],
 )
+# Outermost, so everything above is compressed once on the way out.
+app.add_middleware(CompressionMiddleware)
 
 for mod in api.__all__:
     if re.search("pycache", mod.__name__):
@@ -38,28 +45,57 @@ for mod in api.__all__:
     }
     app.mount(f"""/{name}""", subapp, name)
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount(
+    "/static", PrecompressedStaticFiles(directory="static"), name="static"
+)
+
+
+# Mounted apps don't get lifespan events of their own, so pass them on.
+@app.on_event("startup")
+async def start_subapps():
+    for route in app.routes:
+        if isinstance(route, Mount) and isinstance(route.app, FastAPI):
+            # Rendered now, rather than by the first student to open them.
+            if docs := getattr(route.app.state, "docs", None):
+                docs.build(route.path)
+            await route.app.router.startup()
+
+
+@app.on_event("shutdown")
+async def stop_subapps():
+    for route in app.routes:
+        if isinstance(route, Mount) and isinstance(route.app, FastAPI):
+            await route.app.router.shutdown()
 
-limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 
-@app.get("/", include_in_schema=False)
-async def app_root(request: Request):
+def render_index() -> bytes:
     routes = ""
-    for mod in api.__all__:
-        if re.search("pycache", mod.__name__):
+    for route in app.routes:
+        if not isinstance(route, Mount) or not isinstance(route.app, FastAPI):
             continue
-        name = re.sub("api\.", "", mod.__name__)
-        mod_app = getattr(mod, "app", dict())
-        routes += f"""<li><a href="/{name}/docs">{getattr(mod_app, "title", "")}</a> - {getattr(mod_app, "description", "")}</li>"""
-    return HTMLResponse(
-        content=re.sub(
-            r"{{ content }}",
-            f"{routes}",
-            template
-        )
+        routes += f"""<li><a href="{route.path}/docs">{route.app.title}</a> - {route.app.description}</li>"""
+    return template.replace("{{ content }}", routes).encode()
+
+
+# Every sub-app is mounted by now, so the page can't change until restart.
+index = PrecompressedContent(
+    render_index(),
+    media_type="text/html",
+)
+
+
+@app.get("/", include_in_schema=False)
+async def app_root(request: Request):
+    return index.response(request)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(
+        api.metrics.render(),
+        media_type="text/plain; version=0.0.4",
     )
 
 
@@ -0,0 +1,68 @@
+"""cascade deletes
+
+Revision ID: 189c008b2ee1
+Revises: 36d54be01533
+Create Date: 2026-10-17 23:40:12.118402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+revision: str = '189c008b2ee1'
+down_revision: Union[str, None] = '36d54be01533'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (table, column, referred table)
+FOREIGN_KEYS = (
+    ("todoitem", "user_id", "todouser"),
+    ("contact", "agenda_id", "agenda"),
+)
+
+# SQLite doesn't name foreign keys, batch mode needs one to drop them.
+NAMING_CONVENTION = {
+    "fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s",
+}
+
+
+def fk_name(table: str, column: str, referred: str) -> str:
+    if op.get_bind().dialect.name == "postgresql":
+        return f"{table}_{column}_fkey"
+    return f"fk_{table}_{column}_{referred}"
+
+
+def upgrade() -> None:
+    for table, column, referred in FOREIGN_KEYS:
+        with op.batch_alter_table(
+            table, naming_convention=NAMING_CONVENTION
+        ) as batch_op:
+            batch_op.drop_constraint(
+                fk_name(table, column, referred), type_="foreignkey"
+            )
+            batch_op.create_foreign_key(
+                fk_name(table, column, referred),
+                referred, [column], ["id"],
+                ondelete="CASCADE",
+            )
+            batch_op.create_index(
+                op.f(f"ix_{table}_{column}"), [column], unique=False
+            )
+
+
+def downgrade() -> None:
+    for table, column, referred in FOREIGN_KEYS:
+        with op.batch_alter_table(
+            table, naming_convention=NAMING_CONVENTION
+        ) as batch_op:
+            batch_op.drop_index(op.f(f"ix_{table}_{column}"))
+            batch_op.drop_constraint(
+                fk_name(table, column, referred), type_="foreignkey"
+            )
+            batch_op.create_foreign_key(
+                fk_name(table, column, referred),
+                referred, [column], ["id"],
+            )
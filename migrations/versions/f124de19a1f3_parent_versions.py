@@ -0,0 +1,89 @@
+"""parent versions
+
+Revision ID: f124de19a1f3
+Revises: 189c008b2ee1
+Create Date: 2026-10-17 18:02:44.512907
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+revision: str = 'f124de19a1f3'
+down_revision: Union[str, None] = '189c008b2ee1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (child table, column, parent table whose version it bumps)
+VERSIONED = (
+    ("todoitem", "user_id", "todouser"),
+    ("contact", "agenda_id", "agenda"),
+)
+
+
+def create_triggers(child: str, column: str, parent: str) -> None:
+    bump = f"UPDATE {parent} SET version = version + 1 WHERE id"
+    if op.get_bind().dialect.name == "postgresql":
+        function = f"bump_{parent}_version_from_{child}"
+        op.execute(
+            f"CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$ "
+            f"BEGIN "
+            f"IF TG_OP <> 'DELETE' THEN {bump} = NEW.{column}; END IF; "
+            f"IF TG_OP = 'DELETE' THEN {bump} = OLD.{column}; "
+            f"ELSIF TG_OP = 'UPDATE' THEN "
+            f"IF OLD.{column} <> NEW.{column} THEN {bump} = OLD.{column}; "
+            f"END IF; END IF; "
+            f"RETURN NULL; "
+            f"END $$ LANGUAGE plpgsql"
+        )
+        op.execute(
+            f"CREATE TRIGGER {child}_bumps_{parent} "
+            f"AFTER INSERT OR UPDATE OR DELETE ON {child} "
+            f"FOR EACH ROW EXECUTE FUNCTION {function}()"
+        )
+        return
+    op.execute(
+        f"CREATE TRIGGER {child}_insert_bumps_{parent} "
+        f"AFTER INSERT ON {child} "
+        f"BEGIN {bump} = NEW.{column}; END"
+    )
+    op.execute(
+        f"CREATE TRIGGER {child}_update_bumps_{parent} "
+        f"AFTER UPDATE ON {child} "
+        f"BEGIN {bump} IN (OLD.{column}, NEW.{column}); END"
+    )
+    op.execute(
+        f"CREATE TRIGGER {child}_delete_bumps_{parent} "
+        f"AFTER DELETE ON {child} "
+        f"BEGIN {bump} = OLD.{column}; END"
+    )
+
+
+def drop_triggers(child: str, parent: str) -> None:
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute(f"DROP TRIGGER IF EXISTS {child}_bumps_{parent} ON {child}")
+        op.execute(
+            f"DROP FUNCTION IF EXISTS bump_{parent}_version_from_{child}()"
+        )
+        return
+    for event in ("insert", "update", "delete"):
+        op.execute(f"DROP TRIGGER IF EXISTS {child}_{event}_bumps_{parent}")
+
+
+def upgrade() -> None:
+    for child, column, parent in VERSIONED:
+        with op.batch_alter_table(parent) as batch_op:
+            batch_op.add_column(sa.Column(
+                "version", sa.Integer(), nullable=False, server_default="0"
+            ))
+        create_triggers(child, column, parent)
+
+
+def downgrade() -> None:
+    for child, column, parent in VERSIONED:
+        drop_triggers(child, parent)
+        with op.batch_alter_table(parent) as batch_op:
+            batch_op.drop_column("version")
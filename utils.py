@@ -1,4 +1,5 @@
 import argparse
+import json
 import os
 import re
 
@@ -22,11 +23,9 @@ from fastapi import (
     FastAPI, Request, Response, HTTPException,
     Query, Depends, Path, status,
 )
-from fastapi.openapi.docs import get_swagger_ui_html
 
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
+from api.docs import serve_docs
+from api.ratelimit import limiter
 
 from sqlmodel import (
     Session, select
@@ -41,21 +40,12 @@ app = FastAPI(
     title="{name.title()} API",
     description="An API that you should describe.",
     docs_url=None,
+    openapi_url=None,
 )
 
-limiter = Limiter(key_func=get_remote_address)
-# Limiter requires the request to be in the args for your routes!
+# Limits are counted by RateLimitMiddleware on the main app.
 app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-
-
-@app.get("/docs", include_in_schema=False)
-async def swagger_ui_html():
-    return get_swagger_ui_html(
-        title="4Geeks Playground - {name.title()} API",
-        openapi_url="/{f_name}/openapi.json",
-        swagger_favicon_url="/favicon.ico",
-    )
+serve_docs(app, title="4Geeks Playground - {name.title()} API")
 
 
 @app.get(
@@ -179,6 +169,40 @@ def reset_db():
     print("Database reset.")
 
 
+def sound_urls():
+    urls = []
+    for name in ("fx", "songs"):
+        with open(f"./api/sound/data/{name}.json", "rt") as f:
+            urls += [item["url"] for item in json.load(f)]
+    return urls
+
+
+def build_sound_variants():
+    from api.sound.variants import build_variants
+
+    manifest = build_variants(sound_urls())
+    print(
+        f"Built {sum(len(e['variants']) for e in manifest.values())} "
+        f"variants for {len(manifest)} sounds."
+    )
+
+
+def build_sound_metadata():
+    from api.sound.metadata import build_metadata
+
+    entries = build_metadata(sound_urls())
+    print(
+        f"Indexed {len(entries)} sounds, "
+        f"{sum(bool(e.peaks) for e in entries.values())} with waveforms."
+    )
+
+
+def build_static():
+    from api.responses import compress_static
+
+    print(f"Compressed {compress_static('./static')} static files.")
+
+
 parser = argparse.ArgumentParser()
 subparsers = parser.add_subparsers()
 
@@ -196,6 +220,15 @@ reset_parser = subparsers.add_parser(
 )
 reset_parser.set_defaults(op="reset_db", func=reset_db)
 
+variants_parser = subparsers.add_parser("variants")
+variants_parser.set_defaults(op="build_variants", func=build_sound_variants)
+
+metadata_parser = subparsers.add_parser("metadata")
+metadata_parser.set_defaults(op="build_metadata", func=build_sound_metadata)
+
+static_parser = subparsers.add_parser("static")
+static_parser.set_defaults(op="build_static", func=build_static)
+
 
 if __name__ == "__main__":
     args = parser.parse_args()
@@ -205,5 +238,7 @@ if __name__ == "__main__":
             args.func(args.name)
         case "reset_db":
             args.func()
+        case "build_variants" | "build_metadata" | "build_static":
+            args.func()
         case _:
             print("How did you even get here?")